@@ -1,24 +1,32 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, make_response
 from flask_cors import CORS
-from flask_migrate import Migrate
-from models import User, Score, NoteData, PerformanceAnalysis  # Add this line
+from models import User, Score, ScoreMeasure, NoteData, PerformanceAnalysis, AnalysisJob
+from sqlalchemy.exc import IntegrityError
 
 import os
 from models import db
 from werkzeug.utils import secure_filename
-from templates.notedetection import detect_notes, detect_notes_from_musicxml, detect_notes_from_midi
-from collections import defaultdict
 from datetime import datetime
-import librosa
-import numpy as np
-from scipy.signal import find_peaks
-import soundfile as sf
-from pydub import AudioSegment
 from flask_bcrypt import Bcrypt
 import io
+import hashlib
+import json
 import logging
 from flask_login import UserMixin, login_user, login_required, current_user, logout_user, LoginManager
-from extensions import db, bcrypt, login_manager, migrate
+from extensions import db, bcrypt, login_manager
+from jobs import analysis_queue, QueueFull, RecordingUnreadable
+from notestore import (TUNING_TOLERANCE_CENTS, load_note_array, note_names, render_order, store_score_notes,
+                       vexflow_durations)
+from parsecache import parse_cache, content_hash
+from references import reference_store
+from resultcache import result_cache
+from warmup import import_warmer, measure_import, REPORT_MODULES
+from importer import import_scores
+from metrics import metrics, registry, stage
+from livesessions import live_sessions, LiveSessionError
+from identity import identity_cache, password_hasher, LoginBusy
+import progress
+import click
 from models import User
 
 # Set up logging
@@ -43,17 +51,43 @@ def create_app():
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         UPLOAD_FOLDER='uploads/',
         ALLOWED_EXTENSIONS={'png', 'jpg', 'jpeg', 'xml', 'musicxml', 'mid', 'midi'},
-        MAX_CONTENT_LENGTH=16 * 1024 * 1024
+        MAX_CONTENT_LENGTH=16 * 1024 * 1024,
+        # Also write one normalized note_data row per note alongside the
+        # packed array on Score
+        STORE_NOTE_ROWS=os.environ.get('STORE_NOTE_ROWS', '1') != '0',
+        # Lean web workers: skip extensions only the CLI needs
+        LAZY_IMPORTS=os.environ.get('LAZY_IMPORTS', '0') != '0',
+        # Rhythm attempts per /api/rhythm/score_batch call
+        RHYTHM_BATCH_MAX=int(os.environ.get('RHYTHM_BATCH_MAX', 100)),
+        # Measures per /api/scores/<id>/measures response
+        MEASURE_WINDOW_MAX=int(os.environ.get('MEASURE_WINDOW_MAX', 64)),
+        # bcrypt cost for new passwords; older hashes are upgraded on login
+        BCRYPT_LOG_ROUNDS=int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
     )
 
     # Initialize extensions
     db.init_app(app)
     bcrypt.init_app(app)
     login_manager.init_app(app)
-    migrate.init_app(app, db)
+    # Flask-Migrate imports alembic, over a second per worker at boot, and
+    # only the `flask db` commands use it
+    if not app.config['LAZY_IMPORTS']:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    analysis_queue.init_app(app)
+    parse_cache.init_app(app)
+    reference_store.init_app(app)
+    result_cache.init_app(app)
+    import_warmer.init_app(app)
+    metrics.init_app(app)
+    live_sessions.init_app(app)
+    identity_cache.init_app(app)
+    password_hasher.init_app(app)
 
     login_manager.login_view = 'login'
     login_manager.login_message_category = 'info'
+    # Shown in the recording page's legend
+    app.jinja_env.globals['tuning_tolerance_cents'] = TUNING_TOLERANCE_CENTS
 
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -71,54 +105,138 @@ def create_app():
     def allowed_file(filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-    def store_notes(notes, user_id):
+    def store_notes(notes, user_id, content_hash=None, title="Uploaded Score", commit=True):
         try:
-            logger.debug(f"Storing notes for user {user_id}: {notes}")
-            new_score = Score(
-                title="Uploaded Score",
-                user_id=user_id
-            )
-            db.session.add(new_score)
-            db.session.flush()
-
-            for note in notes:
-                new_note = NoteData(
-                    measure=note.get('measure', 1),
-                    note_name=note['pitch'],
-                    duration=float(note['duration']),  # Convert string to float
-                    score_id=new_score.id
+            logger.debug(f"Storing {len(notes)} notes for user {user_id}")
+            with stage('store_notes'):
+                new_score = Score(
+                    title=title,
+                    user_id=user_id,
+                    content_hash=content_hash
                 )
-                db.session.add(new_note)
-            
-            db.session.commit()
+                db.session.add(new_score)
+                db.session.flush()
+
+                packed = store_score_notes(new_score, notes, write_rows=app.config['STORE_NOTE_ROWS'])
+                store_measures(new_score, packed)
+                if content_hash:
+                    reference_store.put(new_score.id, content_hash, packed)
+                if commit:
+                    db.session.commit()
             logger.debug(f"Stored new score with id {new_score.id}")
             return new_score.id
         except Exception as e:
             logger.error(f"Error storing notes: {str(e)}")
-            db.session.rollback()
+            # Batch callers roll back their own savepoint
+            if commit:
+                db.session.rollback()
             raise
 
-    def quantize_duration(duration):
-        duration_map = {
-            '4.0': 'w', '6.0': 'wd', '7.0': 'wdd',
-            '2.0': 'h', '3.0': 'hd', '3.5': 'hdd',
-            '1.0': 'q', '1.5': 'qd', '1.75': 'qdd',
-            '0.5': '8', '0.75': '8d', '0.875': '8dd',
-            '0.25': '16', '0.375': '16d', '0.4375': '16dd',
-            '0.125': '32', '0.1875': '32d',
-            '0.33333': '8tr', '0.66667': 'qtr', '1.33333': 'htr',
-            'rest_4.0': 'wr', 'rest_2.0': '2r', 'rest_1.0': '4r',
-            'rest_0.5': '8r', 'rest_0.25': '16r', 'rest_0.125': '32r'
-        }
-        duration_str = str(float(duration))
-        if isinstance(duration, str) and duration.startswith('rest'):
-            duration_str = f'rest_{duration.split("_")[1]}'
-        return duration_map.get(duration_str, 'q')
+    # Shown when nobody has uploaded a score yet
+    DEMO_MEASURES = [{
+        'seq': 1, 'number': 1, 'position': 0,
+        'notes': [{"keys": [key], "duration": "q", "is_rest": False} for key in ("c/4", "d/4", "e/4", "f/4")],
+    }]
+
+    def build_measures(packed):
+        """VexFlow notes grouped into ``ScoreMeasure`` rows, in render order."""
+        # A stable sort by measure gives the same order as ORDER BY measure, id
+        packed = render_order(packed)
+        # Every duration is snapped in one pass over the tick column
+        durations = vexflow_durations(packed['ticks']).tolist()
+        rests = (packed['midi'] < 0).tolist()
+        rows = []
+        for position, (measure, note_name, duration, is_rest) in enumerate(
+                zip(packed['measure'].tolist(), note_names(packed), durations, rests)):
+            if not rows or rows[-1]['number'] != measure:
+                rows.append({'seq': len(rows) + 1, 'number': measure, 'position': position, 'notes': []})
+            rows[-1]['notes'].append({
+                "keys": ["b/4" if is_rest else f"{note_name[:-1].lower()}/{note_name[-1]}"],
+                "duration": duration,
+                "is_rest": is_rest
+            })
+        return rows
+
+    def store_measures(score, packed):
+        """Write a flushed ``score``'s measure rows and set its counts and ETag."""
+        rows = build_measures(packed)
+        digest = hashlib.sha1()
+        for row in rows:
+            row['score_id'] = score.id
+            row['notes'] = json.dumps(row['notes'], separators=(',', ':'))
+            digest.update(f"{row['number']}:{row['notes']}\n".encode('utf-8'))
+        if rows:
+            db.session.execute(ScoreMeasure.__table__.insert(), rows)
+        score.measure_count = len(rows)
+        score.pitched_count = int((packed['midi'] >= 0).sum())
+        score.vexflow_etag = digest.hexdigest()
+
+    def score_layout(score_id):
+        """``measure_count``, ``pitched_count`` and ``etag`` of a score, or None if it doesn't exist."""
+        query = db.select(Score.measure_count, Score.pitched_count, Score.vexflow_etag).where(Score.id == score_id)
+        layout = db.session.execute(query).one_or_none()
+        if layout is not None and layout.measure_count is None:
+            # Scores stored before measure rows existed are built once from
+            # their notes and saved
+            try:
+                store_measures(db.session.get(Score, score_id), load_note_array(score_id))
+                db.session.commit()
+            except IntegrityError:
+                # Another request built them first
+                db.session.rollback()
+            layout = db.session.execute(query).one()
+        if layout is None:
+            return None
+        return {'measure_count': layout.measure_count, 'pitched_count': layout.pitched_count,
+                'etag': layout.vexflow_etag}
+
+    template_digests = {}
+
+    def score_page_etag(template_name, score_id, score_etag):
+        # The page embeds the score id and is rendered for the signed-in
+        # user, so both go into the ETag next to the score's content hash
+        # and a digest of the template sources, which change on deploy.
+        # Identical uploads share a content hash but not an id.
+        if template_name not in template_digests:
+            digest = hashlib.sha1()
+            for name in (template_name, 'score_window.html'):
+                source, _, _ = app.jinja_loader.get_source(app.jinja_env, name)
+                digest.update(source.encode('utf-8'))
+            # The legend on the recording page shows this
+            digest.update(str(TUNING_TOLERANCE_CENTS).encode('utf-8'))
+            template_digests[template_name] = digest.hexdigest()[:8]
+        return f"{current_user.id}-{score_id}-{score_etag}-{template_digests[template_name]}"
+
+    def render_score_page(template_name, score_id, score_etag):
+        # The page carries only the score's shape; the measures in view are
+        # fetched from /api/scores/<id>/measures, so its size doesn't grow
+        # with the score
+        if score_etag and score_page_etag(template_name, score_id, score_etag) in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            with stage('render_score_page'):
+                layout = score_layout(score_id)
+                score_etag = layout['etag']
+                response = make_response(render_template(template_name,
+                                                         score_id=score_id,
+                                                         measure_count=layout['measure_count'],
+                                                         pitched_count=layout['pitched_count'],
+                                                         initial_measures=None))
+        response.set_etag(score_page_etag(template_name, score_id, score_etag))
+        response.headers['Cache-Control'] = 'private, no-cache'
+        # Which score the page shows depends on who is signed in
+        response.vary.add('Cookie')
+        return response
+
+    def render_demo_page(template_name):
+        return render_template(template_name, score_id=None, measure_count=len(DEMO_MEASURES),
+                               pitched_count=sum(len(measure['notes']) for measure in DEMO_MEASURES),
+                               initial_measures=DEMO_MEASURES)
 
     # Routes
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return identity_cache.get(int(user_id))
 
     @app.route("/")
     def home():
@@ -144,7 +262,11 @@ def create_app():
                 flash('Email already registered', 'danger')
                 return redirect(url_for('register'))
             
-            hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
+            try:
+                hashed_password = password_hasher.generate(password)
+            except LoginBusy:
+                flash('Lots of people are signing up right now, please try again in a moment', 'warning')
+                return render_template('register.html'), 503, {'Retry-After': '5'}
             user = User(username=username, email=email, password=hashed_password)
             db.session.add(user)
             db.session.commit()
@@ -164,7 +286,13 @@ def create_app():
             password = request.form.get('password')
             user = User.query.filter_by(email=email).first()
             
-            if user and bcrypt.check_password_hash(user.password, password):
+            try:
+                valid = user is not None and password_hasher.check(user, password)
+            except LoginBusy:
+                flash('Lots of people are signing in right now, please try again in a moment', 'warning')
+                return render_template('login.html'), 503, {'Retry-After': '5'}
+
+            if valid:
                 login_user(user)
                 next_page = request.args.get('next')
                 return redirect(next_page) if next_page else redirect(url_for('dashboard'))
@@ -181,6 +309,7 @@ def create_app():
     @app.route("/logout")
     @login_required
     def logout():
+        identity_cache.invalidate(current_user.id)
         logout_user()
         return redirect(url_for('home'))
 
@@ -188,43 +317,13 @@ def create_app():
     @login_required
     def display_score():
         try:
-            latest_score = Score.query.order_by(Score.id.desc()).first()
+            latest_score = db.session.query(Score.id, Score.vexflow_etag).order_by(Score.id.desc()).first()
             
             if not latest_score:
-                vexflow_notes = {
-                    '1': [
-                        {"keys": ["c/4"], "duration": "q"},
-                        {"keys": ["d/4"], "duration": "q"},
-                        {"keys": ["e/4"], "duration": "q"},
-                        {"keys": ["f/4"], "duration": "q"}
-                    ]
-                }
-            else:
-                notes = NoteData.query.filter_by(score_id=latest_score.id).order_by(NoteData.measure, NoteData.id).all()
-                vexflow_notes = defaultdict(list)
-                
-                for note in notes:
-                    vexflow_duration = quantize_duration(note.duration)
-                    if note.note_name.lower() == 'rest':
-                        note_key = "b/4"
-                        is_rest = True
-                    else:
-                        note_name = note.note_name[:-1].lower()
-                        octave = note.note_name[-1]
-                        note_key = f"{note_name}/{octave}"
-                        is_rest = False
-                    
-                    note_data = {
-                        "keys": [note_key],
-                        "duration": vexflow_duration,
-                        "is_rest": is_rest
-                    }
-                    vexflow_notes[str(note.measure)].append(note_data)
-            
-            return render_template('display_score.html', 
-                                 vexflow_notes=vexflow_notes,
-                                 score_id=latest_score.id if latest_score else None)
-                                 
+                return render_demo_page('display_score.html')
+
+            return render_score_page('display_score.html', latest_score.id, latest_score.vexflow_etag)
+
         except Exception as e:
             logger.error(f"Error in display_score route: {str(e)}", exc_info=True)
             flash('Error loading score display. Please try again.', 'danger')
@@ -235,44 +334,27 @@ def create_app():
     def record_performance():
         try:
             # Filter scores by current user
-            latest_score = Score.query.filter_by(user_id=current_user.id).order_by(Score.id.desc()).first()
+            latest_score = (db.session.query(Score.id, Score.vexflow_etag)
+                            .filter_by(user_id=current_user.id)
+                            .order_by(Score.id.desc())
+                            .first())
             
             if not latest_score:
                 flash('No score found. Please upload a score first.', 'warning')
                 return redirect(url_for('dashboard'))
-                
-            notes = NoteData.query.filter_by(score_id=latest_score.id).order_by(NoteData.measure, NoteData.id).all()
-            vexflow_notes = defaultdict(list)
-            
-            for note in notes:
-                vexflow_duration = quantize_duration(note.duration)
-                if note.note_name.lower() == 'rest':
-                    note_key = "b/4"
-                    is_rest = True
-                else:
-                    note_name = note.note_name[:-1].lower()
-                    octave = note.note_name[-1]
-                    note_key = f"{note_name}/{octave}"
-                    is_rest = False
-                
-                note_data = {
-                    "keys": [note_key],
-                    "duration": vexflow_duration,
-                    "is_rest": is_rest
-                }
-                vexflow_notes[note.measure].append(note_data)
-            
-            vexflow_notes_dict = {str(k): v for k, v in vexflow_notes.items()}
-            
-            return render_template('record_performance.html', 
-                                 vexflow_notes=vexflow_notes_dict,
-                                 score_id=latest_score.id)
+
+            return render_score_page('record_performance.html', latest_score.id, latest_score.vexflow_etag)
 
         except Exception as e:
             logger.error(f"Error in record_performance: {str(e)}", exc_info=True)
             flash('Error loading performance recorder', 'danger')
             return redirect(url_for('dashboard'))
 
+    # HTTP status of the submit endpoint for a job that finished before it
+    # answered (analyzed inline or from the cache); queued jobs answer 202.
+    # An upload that can't be decoded is a 422 instead.
+    ANALYSIS_STATUS_CODES = {'done': 200, 'failed': 500}
+
     @app.route("/analyze_recording", methods=['POST'])
     @login_required
     def analyze_recording():
@@ -288,118 +370,224 @@ def create_app():
             logger.error("No score ID provided in the request")
             return jsonify({'error': 'No score ID provided'}), 400
 
-        score = Score.query.get(score_id)
-        if not score:
+        # Only the id is needed, so the primary key index answers this
+        found_id = db.session.execute(db.select(Score.id).where(Score.id == score_id)).scalar()
+        if found_id is None:
             logger.error(f"No score found with id {score_id}")
             return jsonify({'error': f'No score found with id {score_id}'}), 404
+        score_id = found_id
 
-        temp_audio_path = os.path.join(app.config['UPLOAD_FOLDER'], 'temp_recording.wav')
-        audio_file.save(temp_audio_path)
-
+        reference = reference_store.locate(score_id)
         try:
-            audio = AudioSegment.from_file(temp_audio_path)
-            audio.export(temp_audio_path, format="wav")
-            
-            accuracy, feedback, correct_notes, incorrect_notes = analyze_audio(temp_audio_path, score_id)
-            
-            analysis = PerformanceAnalysis(
-                user_id=current_user.id,
-                score_id=int(score_id),
-                accuracy=accuracy,
-                feedback=feedback
-            )
-            db.session.add(analysis)
-            db.session.commit()
-
-            response_data = {
-                'feedback': feedback,
-                'accuracy': accuracy,
-                'correct_notes': correct_notes,
-                'incorrect_notes': incorrect_notes
-            }
-            return jsonify(response_data)
+            job_id = analysis_queue.submit(current_user.id, score_id, audio_file.read(), reference)
+        except RecordingUnreadable as e:
+            logger.warning(f"Rejecting unreadable recording: {str(e)}")
+            return jsonify({'error': str(e)}), 422
+        except QueueFull:
+            logger.warning("Analysis queue is full, rejecting recording")
+            return jsonify({'error': 'Too many recordings are being analyzed, please try again shortly'}), 503, {'Retry-After': '10'}
         except Exception as e:
             logger.error(f"Error in analyze_recording: {str(e)}", exc_info=True)
             return jsonify({'error': str(e)}), 500
-        finally:
-            if os.path.exists(temp_audio_path):
-                os.remove(temp_audio_path)
+
+        job = db.session.get(AnalysisJob, job_id)
+        data = analysis_queue.status(job)
+        data['status_url'] = url_for('analysis_status', job_id=job_id)
+        # Analyzed inline (ANALYSIS_WORKERS = 0) or answered from the cache,
+        # the job is already finished; report it as the status endpoint would
+        return jsonify(data), ANALYSIS_STATUS_CODES.get(job.status, 202)
+
+    @app.route("/analyze_recording/<job_id>")
+    @login_required
+    def analysis_status(job_id):
+        job = db.session.get(AnalysisJob, job_id)
+        if not job or job.user_id != current_user.id:
+            return jsonify({'error': f'No analysis job found with id {job_id}'}), 404
+
+        data = analysis_queue.status(job)
+        # The poll itself succeeded whether the job did or not
+        return jsonify(data), 202 if job.status == 'queued' else 200
+
+    @app.route("/live_analysis", methods=['POST'])
+    @login_required
+    def start_live_analysis():
+        data = request.get_json(silent=True) or {}
+        score_id = db.session.execute(db.select(Score.id).where(Score.id == data.get('score_id'))).scalar()
+        if score_id is None:
+            return jsonify({'error': f"No score found with id {data.get('score_id')}"}), 404
+        try:
+            session_id = live_sessions.create(current_user.id, score_id, reference_store.load(score_id),
+                                              int(data.get('sample_rate', 44100)), data.get('format', 's16'))
+        except (LiveSessionError, ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'session_id': session_id,
+            'chunk_url': url_for('live_analysis_chunk', session_id=session_id),
+            'finish_url': url_for('finish_live_analysis', session_id=session_id),
+        }), 201
+
+    @app.route("/live_analysis/<session_id>/chunk", methods=['POST'])
+    @login_required
+    def live_analysis_chunk(session_id):
+        seq = request.args.get('seq', type=int)
+        if seq is None:
+            return jsonify({'error': 'No chunk sequence number provided'}), 400
+        try:
+            with stage('live_chunk'):
+                verdicts, current = live_sessions.feed(session_id, current_user.id, seq, request.get_data())
+        except LiveSessionError as e:
+            return jsonify(dict(e.details, error=str(e))), e.status
+        return jsonify({'seq': seq, 'verdicts': verdicts, 'current': current})
+
+    @app.route("/live_analysis/<session_id>/finish", methods=['POST'])
+    @login_required
+    def finish_live_analysis(session_id):
+        from templates.liveanalysis import analyze_live_frames
+        try:
+            meta, frames = live_sessions.finish(session_id, current_user.id)
+        except LiveSessionError as e:
+            return jsonify(dict(e.details, error=str(e))), e.status
+
+        # Pitch tracking already ran chunk by chunk; only note segmentation
+        # and the score comparison are left
+        with stage('live_finish'):
+            accuracy, feedback, correct_notes, incorrect_notes, notes = analyze_live_frames(frames, reference_store.load(meta['score_id']))
+        analysis = PerformanceAnalysis(
+            user_id=current_user.id,
+            score_id=meta['score_id'],
+            accuracy=accuracy,
+            feedback=feedback,
+            note_results=json.dumps(notes),
+            kind=progress.RECORDING
+        )
+        db.session.add(analysis)
+        db.session.flush()
+        progress.record_attempt(analysis)
+        db.session.commit()
+        return jsonify({
+            'feedback': feedback,
+            'accuracy': accuracy,
+            'correct_notes': correct_notes,
+            'incorrect_notes': incorrect_notes,
+            'notes': notes,
+            'performance_id': analysis.id,
+        })
 
     @app.route("/rhythm_check")
     @login_required
     def rhythm_check():
         try:
-            latest_score = Score.query.order_by(Score.id.desc()).first()
+            latest_score = db.session.query(Score.id, Score.vexflow_etag).order_by(Score.id.desc()).first()
             
             if not latest_score:
-                vexflow_notes = {
-                    '1': [
-                        {"keys": ["c/4"], "duration": "q"},
-                        {"keys": ["d/4"], "duration": "q"},
-                        {"keys": ["e/4"], "duration": "q"},
-                        {"keys": ["f/4"], "duration": "q"}
-                    ]
-                }
-            else:
-                notes = NoteData.query.filter_by(score_id=latest_score.id).order_by(NoteData.measure, NoteData.id).all()
-                vexflow_notes = defaultdict(list)
-                
-                for note in notes:
-                    vexflow_duration = quantize_duration(note.duration)
-                    if note.note_name.lower() == 'rest':
-                        note_key = "b/4"
-                        is_rest = True
-                    else:
-                        note_name = note.note_name[:-1].lower()
-                        octave = note.note_name[-1]
-                        note_key = f"{note_name}/{octave}"
-                        is_rest = False
-                    
-                    note_data = {
-                        "keys": [note_key],
-                        "duration": vexflow_duration,
-                        "is_rest": is_rest
-                    }
-                    vexflow_notes[str(note.measure)].append(note_data)
-            
-            return render_template('rhythm_check.html', vexflow_notes=vexflow_notes)
+                return render_demo_page('rhythm_check.html')
+
+            return render_score_page('rhythm_check.html', latest_score.id, latest_score.vexflow_etag)
         except Exception as e:
             logger.error(f"Error in rhythm_check route: {str(e)}", exc_info=True)
             flash('Error loading rhythm check. Please try again.', 'danger')
             return redirect(url_for('dashboard'))
 
+    def score_rhythm_attempt(attempt, references):
+        """Score one rhythm attempt and add its PerformanceAnalysis to the session.
+
+        ``attempt`` has ``score_id``, ``tempo`` (BPM), ``taps`` (seconds) and
+        optionally ``offset``; ``references`` caches reference records by
+        score across a batch. Raises ValueError for a malformed attempt.
+        """
+        from templates.rhythm import score_taps
+        try:
+            score_id = int(attempt['score_id'])
+            tempo = float(attempt['tempo'])
+            taps = [float(tap) for tap in attempt['taps']]
+            offset = attempt.get('offset')
+            offset = None if offset is None else float(offset)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Each attempt needs a score_id, a tempo and a list of tap times')
+        if not 20 <= tempo <= 300:
+            raise ValueError(f"Tempo {tempo:g} is out of range")
+        if score_id not in references:
+            if db.session.execute(db.select(Score.id).where(Score.id == score_id)).scalar() is None:
+                raise ValueError(f"No score found with id {score_id}")
+            references[score_id] = reference_store.load(score_id)
+
+        with stage('rhythm_scoring'):
+            result = score_taps(taps, references[score_id], tempo, offset)
+        analysis = PerformanceAnalysis(
+            user_id=current_user.id,
+            score_id=score_id,
+            accuracy=result['accuracy'],
+            feedback=(f"Rhythm accuracy: {result['accuracy']}% ({result['missed']} missed notes, "
+                      f"{result['extra_taps']} extra taps)"),
+            note_results=json.dumps(result['notes']),
+            kind=progress.RHYTHM
+        )
+        db.session.add(analysis)
+        db.session.flush()
+        progress.record_attempt(analysis)
+        result['score_id'] = score_id
+        result['performance_id'] = analysis.id
+        return result
+
     @app.route("/save_rhythm_score", methods=['POST'])
     @login_required
     def save_rhythm_score():
-        try:
-            data = request.get_json()
-            accuracy = data.get('accuracy')
-            
-            if accuracy is not None:
-                analysis = PerformanceAnalysis(
-                    user_id=current_user.id,
-                    score_id=data.get('score_id', 1),
-                    accuracy=float(accuracy),
-                    feedback=f"Rhythm accuracy: {accuracy}%"
-                )
-                db.session.add(analysis)
-                db.session.commit()
-                
-                return jsonify({
-                    'status': 'success',
-                    'message': 'Rhythm score saved successfully'
-                })
-            else:
+        # Scored here from the raw taps (or a recording of clapping); the
+        # page no longer gets to send its own accuracy
+        if 'audio' in request.files:
+            from templates.audioanalysis import ANALYSIS_SR
+            from templates.audiodecode import AudioDecodeError, decode_blocks
+            from templates.rhythm import tap_times_from_stream
+            data = request.form.to_dict()
+            try:
+                chunks = decode_blocks(request.files['audio'].read(), ANALYSIS_SR)
+                data['taps'] = tap_times_from_stream(chunks, ANALYSIS_SR).tolist()
+            except AudioDecodeError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+        else:
+            data = request.get_json(silent=True) or {}
+            if 'taps' not in data:
                 return jsonify({
                     'status': 'error',
-                    'message': 'No accuracy score provided'
+                    'message': 'No tap times provided'
                 }), 400
+
+        try:
+            result = score_rhythm_attempt(data, {})
+            db.session.commit()
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'status': 'error', 'message': str(e)}), 400
         except Exception as e:
+            db.session.rollback()
             logger.error(f"Error saving rhythm score: {str(e)}", exc_info=True)
             return jsonify({
                 'status': 'error',
                 'message': 'Error saving rhythm score'
             }), 500
+        return jsonify(dict(result, status='success', message='Rhythm score saved successfully'))
+
+    @app.route("/api/rhythm/score_batch", methods=['POST'])
+    @login_required
+    def score_rhythm_batch():
+        attempts = (request.get_json(silent=True) or {}).get('attempts')
+        if not isinstance(attempts, list) or not attempts:
+            return jsonify({'error': 'No attempts provided'}), 400
+        if len(attempts) > app.config['RHYTHM_BATCH_MAX']:
+            return jsonify({'error': f"At most {app.config['RHYTHM_BATCH_MAX']} attempts per call"}), 413
+
+        # One transaction for the whole batch; a malformed attempt is
+        # reported in place and skipped
+        references = {}
+        results = []
+        for attempt in attempts:
+            try:
+                with db.session.begin_nested():
+                    results.append(score_rhythm_attempt(attempt if isinstance(attempt, dict) else {}, references))
+            except ValueError as e:
+                results.append({'error': str(e)})
+        db.session.commit()
+        return jsonify({'results': results})
 
     @app.route("/upload_score", methods=['GET', 'POST'])
     @login_required
@@ -418,27 +606,42 @@ def create_app():
                 if file and allowed_file(file.filename):
                     filename = secure_filename(file.filename)
                     filepath = os.path.join('static', 'uploads', filename)
-                    
-                    # Ensure directory exists
-                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                    
-                    # Save the file
-                    file.save(filepath)
-                    logger.debug(f"File saved to {filepath}")
+                    data = file.read()
+                    upload_hash = content_hash(data)
 
                     try:
-                        if filename.endswith(('.xml', '.musicxml')):
-                            notes = detect_notes_from_musicxml(filepath)
-                        elif filename.endswith(('.mid', '.midi')):
-                            notes = detect_notes_from_midi(filepath)
+                        # Identical files (a whole class uploading the same
+                        # piece) are parsed once and reused from the cache
+                        parsed = parse_cache.get(upload_hash)
+                        registry.inc('parse_cache_total', result='miss' if parsed is None else 'hit')
+                        if parsed is None:
+                            with stage('upload_save'):
+                                # Ensure directory exists
+                                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+                                # Save the file
+                                with open(filepath, 'wb') as f:
+                                    f.write(data)
+                            logger.debug(f"File saved to {filepath}")
+
+                            # OpenCV and music21 are loaded on the first upload
+                            # rather than when the worker boots
+                            from templates.notedetection import (
+                                detect_notes, detect_notes_from_musicxml, detect_notes_from_midi)
+
+                            with stage('upload_parse'):
+                                if filename.endswith(('.xml', '.musicxml')):
+                                    notes = detect_notes_from_musicxml(filepath)
+                                elif filename.endswith(('.mid', '.midi')):
+                                    notes = detect_notes_from_midi(filepath)
+                                else:
+                                    notes = detect_notes(filepath)
+
+                            parsed = parse_cache.put(upload_hash, notes)
                         else:
-                            notes = detect_notes(filepath)
-                        
-                        # Convert durations to float before storing
-                        for note in notes['notes']:
-                            note['duration'] = float(note['duration'])
-                        
-                        score_id = store_notes(notes['notes'], current_user.id)
+                            logger.debug(f"Reusing cached parse {upload_hash} for {filename}")
+
+                        score_id = store_notes(parsed['notes'], current_user.id, content_hash=upload_hash)
                         
                         flash('Score uploaded successfully!', 'success')
                         return redirect(url_for('display_score', score_id=score_id))
@@ -458,6 +661,112 @@ def create_app():
 
         return render_template('upload_score.html')
 
+    @app.route("/api/scores/<int:score_id>/measures")
+    @login_required
+    def score_measures(score_id):
+        # start and end are 1-based places in the score, inclusive; windows
+        # are capped at MEASURE_WINDOW_MAX measures
+        layout = score_layout(score_id)
+        if layout is None:
+            return jsonify({'error': f'No score found with id {score_id}'}), 404
+        window = app.config['MEASURE_WINDOW_MAX']
+        start = max(request.args.get('start', 1, type=int), 1)
+        end = min(request.args.get('end', start + window - 1, type=int), start + window - 1,
+                  layout['measure_count'])
+        etag = f"{layout['etag']}-{start}-{end}"
+        if etag in request.if_none_match:
+            response = make_response('', 304)
+        else:
+            with stage('score_measures'):
+                rows = db.session.execute(
+                    db.select(ScoreMeasure.seq, ScoreMeasure.number, ScoreMeasure.position, ScoreMeasure.notes)
+                    .where(ScoreMeasure.score_id == score_id, ScoreMeasure.seq.between(start, end))
+                    .order_by(ScoreMeasure.seq)).all()
+                # The notes are stored as JSON already and are spliced in as is
+                head = json.dumps({'score_id': score_id, 'measure_count': layout['measure_count'],
+                                   'pitched_count': layout['pitched_count'], 'start': start, 'end': end},
+                                  separators=(',', ':'))
+                measures = ','.join(f'{{"seq":{seq},"number":{number},"position":{position},"notes":{notes}}}'
+                                    for seq, number, position, notes in rows)
+                response = make_response(f'{head[:-1]},"measures":[{measures}]}}', 200,
+                                         {'Content-Type': 'application/json'})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    @app.route("/api/progress")
+    @login_required
+    def progress_overview():
+        # Served from the rollup tables; the attempt history is never scanned
+        days = min(max(request.args.get('days', 30, type=int), 1), 365)
+        summaries = progress.score_summaries(current_user.id)
+        return jsonify({
+            'totals': progress.user_totals(summaries),
+            'scores': summaries,
+            'days': progress.daily(current_user.id, days),
+        })
+
+    @app.route("/api/progress/<int:score_id>")
+    @login_required
+    def score_progress(score_id):
+        days = min(max(request.args.get('days', 30, type=int), 1), 365)
+        return jsonify({
+            'score_id': score_id,
+            'kinds': progress.score_summaries(current_user.id, score_id),
+            'days': progress.daily(current_user.id, days, score_id=score_id),
+        })
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        if not metrics.authorized():
+            return make_response('', 401)
+        return make_response(registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    @app.cli.command('import-report')
+    def import_report():
+        """Import time and peak RSS of the heavy modules, each in a fresh interpreter."""
+        runs = [(name, name, {'LAZY_IMPORTS': '0'}) for name in REPORT_MODULES]
+        # What a gunicorn worker actually pays at boot
+        runs.append(('app (LAZY_IMPORTS=1)', 'app', {'LAZY_IMPORTS': '1'}))
+        print(f"{'module':<28}{'seconds':>9}{'peak RSS MB':>13}{'added MB':>10}")
+        for label, name, env in runs:
+            result = measure_import(name, cwd=app.root_path, env=env)
+            if 'error' in result:
+                print(f"{label:<28}  failed: {result['error'][0]}")
+                continue
+            print(f"{label:<28}{result['seconds']:>9.2f}{result['rss_kb'] / 1024:>13.1f}"
+                  f"{(result['rss_kb'] - result['base_rss_kb']) / 1024:>10.1f}")
+
+    @app.cli.command('import-scores')
+    @click.argument('directory', type=click.Path(exists=True, file_okay=False))
+    @click.option('--user', 'username', required=True, help='Username or email that will own the scores.')
+    @click.option('--workers', type=int, default=None, help='Parser processes (default: one per CPU).')
+    @click.option('--batch-size', type=int, default=50, show_default=True, help='Scores per transaction.')
+    @click.option('--manifest', type=click.Path(dir_okay=False), default=None,
+                  help='Progress/failure manifest (default: DIRECTORY/.import-manifest.json).')
+    def import_scores_command(directory, username, workers, batch_size, manifest):
+        """Import every MusicXML, MIDI, image and PDF score under DIRECTORY.
+
+        Safe to rerun after an interruption: finished files are skipped.
+        """
+        user = User.query.filter((User.username == username) | (User.email == username)).first()
+        if user is None:
+            raise click.ClickException(f"No user {username!r}")
+        result = import_scores(directory, user.id, store_notes, db, parse_cache, workers=workers,
+                               batch_size=batch_size, manifest_path=manifest, echo=click.echo)
+        if result.failed:
+            raise SystemExit(1)
+
+    @app.cli.command('backfill-progress')
+    @click.option('--batch-size', type=int, default=1000, show_default=True)
+    def backfill_progress(batch_size):
+        """Rebuild the practice progress rollups from every stored attempt.
+
+        Run once after upgrading, while no recordings are being analyzed.
+        """
+        count = progress.backfill(batch_size=batch_size)
+        click.echo(f"Rebuilt practice rollups from {count} attempts")
+
     return app
 
 # Create the application instance
@@ -0,0 +1,229 @@
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(ROOT, 'uploads')
+
+# The score the store and render cases upload
+RENDER_FIXTURE = 'Fur_Elise_Easy_Piano.mid'
+RENDER_PAGES = ('display_score', 'record_performance', 'rhythm_check', 'api/scores/1/measures')
+
+# A case is slower/bigger than the baseline when its median time, peak RSS
+# or traced allocation peak grows by more than these fractions
+TIME_THRESHOLD = 0.20
+MEMORY_THRESHOLD = 0.10
+
+_CASE_SCRIPT = '''
+import json, sys
+sys.path.insert(0, sys.argv[1])
+import benchmarks
+print(json.dumps(benchmarks.run_case(sys.argv[2], sys.argv[3], int(sys.argv[4]))))
+'''
+
+
+def list_cases(fixture_dir=FIXTURE_DIR):
+    """Case names (``<kind>/<argument>``) for the fixtures in ``fixture_dir``."""
+    files = sorted(os.listdir(fixture_dir))
+    cases = [f"midi/{name}" for name in files if name.lower().endswith(('.mid', '.midi'))]
+    cases += [f"musicxml/{name}" for name in files if name.lower().endswith(('.xml', '.musicxml'))]
+    cases += [f"omr/{name}" for name in files if name.lower().endswith('.png')]
+    if RENDER_FIXTURE in files:
+        cases.append(f"store_notes/{RENDER_FIXTURE}")
+        cases += [f"render/{page}" for page in RENDER_PAGES]
+    return cases
+
+
+def _peak_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _client(fixture_dir):
+    # Runs in the case's own interpreter, whose DATABASE_URL and cache
+    # directories point at a scratch directory
+    from app import app
+    client = app.test_client()
+    client.post('/register', data={'username': 'bench', 'email': 'bench@example.com', 'password': 'bench'})
+    client.post('/login', data={'email': 'bench@example.com', 'password': 'bench'})
+    return client
+
+
+def _upload(client, fixture_dir, name):
+    with open(os.path.join(fixture_dir, name), 'rb') as f:
+        data = f.read()
+
+    def upload():
+        response = client.post('/upload_score', data={'music_score': (io.BytesIO(data), name)},
+                               content_type='multipart/form-data')
+        if 'display_score' not in response.headers.get('Location', ''):
+            raise RuntimeError(f"Uploading {name} failed")
+
+    return upload
+
+
+def _prepare(case, fixture_dir):
+    """Import what ``case`` needs and return a callable that runs it once."""
+    kind, _, argument = case.partition('/')
+    path = os.path.join(fixture_dir, argument)
+    if kind in ('midi', 'musicxml', 'omr'):
+        from templates.notedetection import detect_notes, detect_notes_from_midi, detect_notes_from_musicxml
+        detect = {'midi': detect_notes_from_midi, 'musicxml': detect_notes_from_musicxml,
+                  'omr': detect_notes}[kind]
+        return lambda: detect(path)
+
+    client = _client(fixture_dir)
+    upload = _upload(client, fixture_dir, RENDER_FIXTURE)
+    # The first upload parses; the rest hit the parse cache, leaving
+    # store_notes and the request around it
+    upload()
+    if kind == 'store_notes':
+        return upload
+    if kind == 'render':
+        def render():
+            response = client.get(f"/{argument}")
+            if response.status_code != 200:
+                raise RuntimeError(f"/{argument} returned {response.status_code}")
+        return render
+    raise ValueError(f"Unknown benchmark case {case!r}")
+
+
+def run_case(case, fixture_dir, repeat):
+    """Time ``case`` ``repeat`` times after a warm-up run, then trace one run's allocations."""
+    import tracemalloc
+
+    run = _prepare(case, fixture_dir)
+    base_rss_kb = _peak_rss_kb()
+    run()
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - started)
+    peak_rss_kb = _peak_rss_kb()
+
+    # Tracing slows everything down, so it gets its own run
+    tracemalloc.start()
+    run()
+    alloc_net, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds.sort()
+    return {
+        'seconds_median': seconds[len(seconds) // 2],
+        'seconds_min': seconds[0],
+        'seconds_max': seconds[-1],
+        'peak_rss_kb': peak_rss_kb,
+        'base_rss_kb': base_rss_kb,
+        'alloc_peak_kb': alloc_peak / 1024,
+        'alloc_net_kb': alloc_net / 1024,
+    }
+
+
+def measure_case(case, fixture_dir=FIXTURE_DIR, repeat=5):
+    """Run one case in a fresh interpreter against a scratch database."""
+    with tempfile.TemporaryDirectory() as scratch:
+        env = dict(os.environ,
+                   DATABASE_URL=f"sqlite:///{os.path.join(scratch, 'bench.db')}",
+                   PARSE_CACHE_DIR=os.path.join(scratch, 'parse_cache'),
+                   METRICS_DIR=os.path.join(scratch, 'metrics'),
+                   REFERENCE_DIR=os.path.join(scratch, 'references'),
+                   WARM_IMPORTS='0')
+        proc = subprocess.run([sys.executable, '-c', _CASE_SCRIPT, ROOT, case, os.path.abspath(fixture_dir),
+                               str(repeat)], cwd=scratch, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run_benchmarks(cases=None, fixture_dir=FIXTURE_DIR, repeat=5, echo=print):
+    """Measure ``cases`` (default: all of them) and return the results document."""
+    cases = cases or list_cases(fixture_dir)
+    width = max(len(case) for case in cases) + 2
+    echo(f"{'case':<{width}}{'median ms':>10}{'RSS MB':>10}{'alloc MB':>10}")
+    results = {}
+    for case in cases:
+        result = measure_case(case, fixture_dir, repeat)
+        results[case] = result
+        if 'error' in result:
+            echo(f"{case:<{width}}  failed: {result['error']}")
+        else:
+            echo(f"{case:<{width}}{result['seconds_median'] * 1000:>10.1f}{result['peak_rss_kb'] / 1024:>10.1f}"
+                 f"{result['alloc_peak_kb'] / 1024:>10.1f}")
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(current, baseline, time_threshold=TIME_THRESHOLD, memory_threshold=MEMORY_THRESHOLD):
+    """Regressions of ``current`` against ``baseline`` as (case, metric, old, new) tuples."""
+    regressions = []
+    for case, result in current['results'].items():
+        old = baseline['results'].get(case)
+        if old is None or 'error' in old:
+            continue
+        if 'error' in result:
+            regressions.append((case, 'error', None, result['error']))
+            continue
+        for metric, threshold in (('seconds_median', time_threshold), ('peak_rss_kb', memory_threshold),
+                                  ('alloc_peak_kb', memory_threshold)):
+            if old[metric] and result[metric] > old[metric] * (1 + threshold):
+                regressions.append((case, metric, old[metric], result[metric]))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time the parse, OMR, store and render paths on the bundled fixtures.')
+    parser.add_argument('cases', nargs='*', help='Cases to run (default: all; see --list).')
+    parser.add_argument('--list', action='store_true', help='Print the case names and exit.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case (default: 5).')
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='Fixture directory (default: uploads/).')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against a saved results file; exits 1 on regressions.')
+    parser.add_argument('--time-threshold', type=float, default=TIME_THRESHOLD)
+    parser.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print('\n'.join(list_cases(args.fixtures)))
+        return 0
+
+    current = run_benchmarks(args.cases, args.fixtures, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(current, baseline, args.time_threshold, args.memory_threshold)
+    for case, metric, old, new in regressions:
+        if metric == 'error':
+            print(f"REGRESSION {case}: now fails ({new})")
+        else:
+            print(f"REGRESSION {case}: {metric} {old:.4g} -> {new:.4g} ({new / old - 1:+.0%})")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,12 @@
-bind = "0.0.0.0:10000"
+import os
+
+# The platform's PORT, as gunicorn would use without a config file
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
 workers = 4
 threads = 4
-timeout = 120 
\ No newline at end of file
+timeout = 120 
+# Workers skip Flask-Migrate and load OpenCV/music21/SciPy on first use
+raw_env = ["LAZY_IMPORTS=1"]
+# /metrics answers only requests from this machine unless METRICS_TOKEN is
+# set in the service's environment (not here, it is a secret); scrapers then
+# send "Authorization: Bearer <token>"
@@ -0,0 +1,189 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from flask_login import UserMixin
+from sqlalchemy import event
+
+from extensions import bcrypt, db
+from models import User
+
+logger = logging.getLogger(__name__)
+
+
+class LoginBusy(Exception):
+    pass
+
+
+class CachedUser(UserMixin):
+    """What Flask-Login keeps for a signed-in user: the row without its password hash."""
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+
+class IdentityCache:
+    """Users for Flask-Login's ``user_loader``, cached across requests in each worker.
+
+    Flask-Login already memoizes the loaded user for the rest of a request
+    (``g._login_user``); this keeps it between requests, so polling the
+    analysis and rhythm endpoints doesn't cost a ``user`` lookup each time.
+    Up to ``IDENTITY_CACHE_SIZE`` users are kept for ``IDENTITY_CACHE_TTL``
+    seconds, least recently used out first. A user is dropped on logout and
+    whenever their row is updated or deleted through this process; other
+    workers pick up such a change within the TTL.
+    """
+
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.max_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_TTL', float(os.environ.get('IDENTITY_CACHE_TTL', 60)))
+        app.config.setdefault('IDENTITY_CACHE_SIZE', int(os.environ.get('IDENTITY_CACHE_SIZE', 1024)))
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        self.max_size = app.config['IDENTITY_CACHE_SIZE']
+        if not event.contains(User, 'after_update', self._row_changed):
+            event.listen(User, 'after_update', self._row_changed)
+            event.listen(User, 'after_delete', self._row_changed)
+        app.extensions['identity_cache'] = self
+
+    def get(self, user_id):
+        """The ``CachedUser`` for ``user_id``, or None if there is no such user."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        row = db.session.execute(
+            db.select(User.id, User.username, User.email).where(User.id == user_id)).one_or_none()
+        if row is None:
+            self.invalidate(user_id)
+            return None
+        user = CachedUser(*row)
+        if self.ttl > 0 and self.max_size > 0:
+            with self._lock:
+                self._entries[user_id] = (now + self.ttl, user)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _row_changed(self, mapper, connection, target):
+        self.invalidate(target.id)
+
+
+class PasswordHasher:
+    """bcrypt for logins and sign-ups, on a small thread pool in each worker.
+
+    A hash at the default cost is about a quarter of a second of CPU. Run on
+    the request threads, a burst of logins at the start of a class would
+    take every thread of a worker and every core. Here at most
+    ``PASSWORD_HASH_WORKERS`` hashes run at once per worker and at most
+    ``PASSWORD_HASH_QUEUE`` more requests wait for one; past that
+    ``LoginBusy`` is raised straight away, leaving the remaining request
+    threads to everyone else. The cost is ``BCRYPT_LOG_ROUNDS``, and
+    passwords hashed at another cost are rehashed in the background after
+    their next successful login.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_WORKERS', int(os.environ.get('PASSWORD_HASH_WORKERS', 1)))
+        # With gunicorn's 4 threads this leaves a request thread free while
+        # logins are being checked
+        app.config.setdefault('PASSWORD_HASH_QUEUE', int(os.environ.get('PASSWORD_HASH_QUEUE', 2)))
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10)))
+        # Flask-Bcrypt's own default; read back in check() to spot old hashes
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.app = app
+        app.extensions['password_hasher'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                                                    thread_name_prefix='password-hash')
+            return self._executor
+
+    def _submit(self, fn, *args):
+        limit = self.app.config['PASSWORD_HASH_WORKERS'] + self.app.config['PASSWORD_HASH_QUEUE']
+        with self._lock:
+            if self._pending >= limit:
+                raise LoginBusy()
+            self._pending += 1
+        future = self._get_executor().submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def _run(self, fn, *args):
+        future = self._submit(fn, *args)
+        try:
+            return future.result(timeout=self.app.config['PASSWORD_HASH_TIMEOUT'])
+        except FutureTimeout:
+            raise LoginBusy()
+
+    def generate(self, password):
+        return self._run(bcrypt.generate_password_hash, password,
+                         self.app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
+
+    def check(self, user, password):
+        """Whether ``password`` matches ``user``'s hash; raises LoginBusy when the pool is full."""
+        if not self._run(bcrypt.check_password_hash, user.password, password):
+            return False
+        if _hash_cost(user.password) != self.app.config['BCRYPT_LOG_ROUNDS']:
+            try:
+                self._submit(self._rehash, user.id, password)
+            except LoginBusy:
+                # Left for a quieter login
+                pass
+        return True
+
+    def _rehash(self, user_id, password):
+        hashed = bcrypt.generate_password_hash(password, self.app.config['BCRYPT_LOG_ROUNDS']).decode('utf-8')
+        with self.app.app_context():
+            try:
+                db.session.execute(db.update(User).where(User.id == user_id).values(password=hashed))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Could not rehash the password of user {user_id}: {str(e)}")
+
+
+def _hash_cost(hashed):
+    # '$2b$12$...'
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+identity_cache = IdentityCache()
+password_hasher = PasswordHasher()
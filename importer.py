@@ -0,0 +1,304 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from models import Score
+from parsecache import content_hash
+
+logger = logging.getLogger(__name__)
+
+PDFTOPPM_BINARY = os.environ.get('PDFTOPPM_BINARY', 'pdftoppm')
+PDFINFO_BINARY = os.environ.get('PDFINFO_BINARY', 'pdfinfo')
+PDF_RENDER_DPI = 300
+PDF_TIMEOUT = 120
+
+MUSICXML_EXTENSIONS = ('.xml', '.musicxml')
+MIDI_EXTENSIONS = ('.mid', '.midi')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+PDF_EXTENSIONS = ('.pdf',)
+
+
+class ScoreImportError(Exception):
+    pass
+
+
+def file_kind(path, head):
+    """'musicxml', 'midi', 'image' or 'pdf', sniffing the first bytes before the extension."""
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head.startswith(b'MThd'):
+        return 'midi'
+    if head.startswith((b'\x89PNG', b'\xff\xd8\xff')):
+        # Exported "PDFs" are sometimes a renamed PNG
+        return 'image'
+    lower = path.lower()
+    for kind, extensions in (('musicxml', MUSICXML_EXTENSIONS), ('midi', MIDI_EXTENSIONS),
+                             ('image', IMAGE_EXTENSIONS), ('pdf', PDF_EXTENSIONS)):
+        if lower.endswith(extensions):
+            return kind
+    return None
+
+
+def _poppler(binary, args):
+    path = shutil.which(binary)
+    if path is None:
+        raise ScoreImportError(f'{binary} is not installed; it is needed to read PDFs')
+    try:
+        proc = subprocess.run([path] + args, capture_output=True, timeout=PDF_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise ScoreImportError(f'Timed out running {binary}')
+    if proc.returncode != 0:
+        raise ScoreImportError(f"{binary} failed: {proc.stderr.decode(errors='replace').strip()}")
+    return proc.stdout
+
+
+def pdf_page_count(path):
+    info = _poppler(PDFINFO_BINARY, [path]).decode(errors='replace')
+    match = re.search(r'^Pages:\s+(\d+)', info, re.MULTILINE)
+    if not match:
+        raise ScoreImportError(f'Could not read the page count of {path}')
+    return int(match.group(1))
+
+
+def render_pdf_page(path, page, directory):
+    """Rasterize one page (1-based) to a PNG in ``directory``; returns its path."""
+    prefix = os.path.join(directory, f'page-{page}')
+    _poppler(PDFTOPPM_BINARY, ['-r', str(PDF_RENDER_DPI), '-gray', '-png', '-singlefile',
+                               '-f', str(page), '-l', str(page), path, prefix])
+    return prefix + '.png'
+
+
+def parse_item(path, kind, page=None):
+    """Run the matching ``detect_notes*`` on one file or PDF page. Runs in a pool worker."""
+    from templates.notedetection import detect_notes, detect_notes_from_midi, detect_notes_from_musicxml
+
+    if kind == 'musicxml':
+        parsed = detect_notes_from_musicxml(path)
+    elif kind == 'midi':
+        parsed = detect_notes_from_midi(path)
+    elif kind == 'image':
+        parsed = detect_notes(path)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            parsed = detect_notes(render_pdf_page(path, page, directory))
+    return parsed
+
+
+def scan(directory):
+    """Importable files under ``directory`` in a stable order, as (relative path, kind)."""
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                kind = file_kind(name, f.read(8))
+            if kind:
+                found.append((os.path.relpath(path, directory), kind))
+    return found
+
+
+class ImportManifest:
+    """Progress of one import, rewritten atomically after every committed batch.
+
+    ``done`` maps item keys (relative path, plus ``#page=N`` for PDF pages) to
+    score ids and ``failed`` maps them to the error. A rerun skips what is
+    done and retries what failed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.done = data.get('done', {})
+            self.failed = data.get('failed', {})
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'done': self.done, 'failed': self.failed}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def _work_items(directory, files, manifest, echo):
+    """(key, path, kind, page, content hash) for everything still to import."""
+    for relpath, kind in files:
+        if relpath in manifest.done:
+            continue
+        path = os.path.join(directory, relpath)
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = content_hash(data)
+        if kind != 'pdf':
+            yield relpath, path, kind, None, digest
+            continue
+        try:
+            pages = pdf_page_count(path)
+        except ScoreImportError as e:
+            manifest.failed[relpath] = str(e)
+            echo(f"failed {relpath}: {e}")
+            continue
+        for page in range(1, pages + 1):
+            key = f"{relpath}#page={page}"
+            if key not in manifest.done:
+                # Pages are stored as separate scores, each with its own hash
+                yield key, path, kind, page, hashlib.sha256(f"{digest}#page={page}".encode()).hexdigest()
+
+
+def import_scores(directory, user_id, store, db, parse_cache, workers=None, batch_size=50,
+                  manifest_path=None, echo=print):
+    """Parse every score under ``directory`` in a process pool and store it for ``user_id``.
+
+    ``store(notes, user_id, content_hash=..., title=..., commit=False)`` adds
+    one score to the session; scores are committed ``batch_size`` at a time.
+    Files already imported for the user (same content hash) are skipped, so
+    an interrupted import can simply be run again. Returns the manifest.
+    """
+    manifest = ImportManifest(manifest_path or os.path.join(directory, '.import-manifest.json'))
+    items = list(_work_items(directory, scan(directory), manifest, echo))
+
+    # Content already in this user's library (e.g. committed just before a
+    # crash, or the same file under two names) is not stored twice
+    existing = {}
+    hashes = [item[4] for item in items]
+    for start in range(0, len(hashes), 500):
+        rows = (db.session.query(Score.content_hash, Score.id)
+                .filter(Score.user_id == user_id, Score.content_hash.in_(hashes[start:start + 500])))
+        existing.update(rows)
+
+    total = len(items)
+    workers = workers or os.cpu_count()
+    echo(f"Importing {total} scores from {directory} with {workers} workers")
+    started = time.monotonic()
+    completed = 0
+    pending_keys = []
+    # Later keys with the same content as one being imported in this run
+    duplicates = {}
+
+    def flush():
+        db.session.commit()
+        for key, score_id in pending_keys:
+            manifest.done[key] = score_id
+            manifest.failed.pop(key, None)
+        pending_keys.clear()
+        manifest.save()
+
+    def finished(key, title, digest, parsed=None, error=None):
+        nonlocal completed
+        completed += 1
+        if error is None:
+            try:
+                with db.session.begin_nested():
+                    score_id = store(parsed['notes'], user_id, content_hash=digest, title=title, commit=False)
+                pending_keys.append((key, score_id))
+                existing[digest] = score_id
+            except Exception as e:
+                error = e
+        if error is not None:
+            manifest.failed[key] = str(error) or error.__class__.__name__
+        rate = completed / max(time.monotonic() - started, 1e-6)
+        echo(f"[{completed}/{total}] {'failed' if error is not None else 'ok'} {key}"
+             + (f": {manifest.failed[key]}" if error is not None else '') + f" ({rate:.1f}/s)")
+        for duplicate in duplicates.pop(digest, []):
+            completed += 1
+            if error is None:
+                pending_keys.append((duplicate, score_id))
+            else:
+                manifest.failed[duplicate] = manifest.failed[key]
+            echo(f"[{completed}/{total}] same content as {key}: {duplicate}")
+        if len(pending_keys) >= batch_size:
+            flush()
+
+    to_parse = []
+    for key, path, kind, page, digest in items:
+        title = os.path.splitext(os.path.basename(path))[0] + (f" (page {page})" if page else '')
+        title = title[:Score.title.type.length]
+        if digest in existing:
+            pending_keys.append((key, existing[digest]))
+            completed += 1
+            echo(f"[{completed}/{total}] already imported {key}")
+            continue
+        if digest in duplicates:
+            duplicates[digest].append(key)
+            continue
+        duplicates[digest] = []
+        cached = parse_cache.get(digest)
+        if cached is not None:
+            finished(key, title, digest, parsed=cached)
+        else:
+            to_parse.append((key, path, kind, page, digest, title))
+
+    def collect(future, key, digest, title):
+        """Record a finished parse; True if it failed because the pool broke."""
+        error = future.exception()
+        if error is None:
+            parsed = parse_cache.put(digest, future.result())
+            finished(key, title, digest, parsed=parsed)
+            return False
+        logger.error(f"Could not import {key}: {error!r}")
+        finished(key, title, digest, error=error)
+        return isinstance(error, BrokenProcessPool)
+
+    def new_executor():
+        return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def replace_pool():
+        """Swap a broken pool for a fresh one after a worker died (e.g. OOM-killed).
+
+        Everything still in flight fails with the pool; it is recorded as
+        failed, so a rerun retries it, and the rest of the queue goes on in
+        the new pool.
+        """
+        nonlocal executor
+        for future, item in in_flight.items():
+            collect(future, *item)
+        in_flight.clear()
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = new_executor()
+        flush()
+
+    in_flight = {}
+    # Bounded in-flight work keeps memory flat for very large libraries
+    executor = new_executor()
+    try:
+        queue = iter(to_parse)
+        limit = 4 * workers
+        while True:
+            for key, path, kind, page, digest, title in queue:
+                try:
+                    future = executor.submit(parse_item, path, kind, page)
+                except BrokenProcessPool:
+                    replace_pool()
+                    future = executor.submit(parse_item, path, kind, page)
+                in_flight[future] = (key, digest, title)
+                if len(in_flight) >= limit:
+                    break
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                broken = collect(future, *in_flight.pop(future)) or broken
+            if broken:
+                replace_pool()
+        flush()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+    echo(f"Imported {len(manifest.done)} scores, {len(manifest.failed)} failed "
+         f"({time.monotonic() - started:.1f}s); manifest at {manifest.path}")
+    return manifest
@@ -0,0 +1,246 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from extensions import db
+from metrics import registry
+from models import AnalysisJob, PerformanceAnalysis
+from progress import RECORDING, record_attempt
+from references import load_reference
+from resultcache import result_cache
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class RecordingUnreadable(Exception):
+    """An upload analyzed inline could not be decoded; the client's fault, not the server's."""
+
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+
+def _run_analysis(audio_bytes, reference, timeout):
+    """Decode and analyze one recording. Runs inside a pool worker process.
+
+    ``reference`` is what ``ReferenceStore.locate`` returned: usually the
+    path of the score's reference file, which is memory-mapped here.
+    """
+    from templates.audioanalysis import ANALYSIS_SR, analyze_stream
+    from templates.audiodecode import decode_blocks
+
+    # Pool workers run tasks on their main thread, so SIGALRM can interrupt
+    # a runaway analysis without taking the whole pool down.
+    armed = timeout and threading.current_thread() is threading.main_thread()
+    if armed:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(int(timeout))
+    try:
+        # Decoded block by block as the pitch tracker takes it, so the take
+        # is never held as samples all at once
+        return analyze_stream(decode_blocks(audio_bytes, ANALYSIS_SR), load_reference(reference))
+    finally:
+        if armed:
+            signal.alarm(0)
+        # Pool workers can be stopped without running exit handlers
+        registry.flush()
+
+
+def _warm_worker():
+    """Import the analysis stack so a fresh pool worker is ready for jobs."""
+    import templates.audioanalysis  # noqa: F401
+    import templates.audiodecode  # noqa: F401
+    return os.getpid()
+
+
+class AnalysisQueue:
+    """Runs recording analysis in a bounded pool of worker processes.
+
+    Job state lives in the ``analysis_job`` table, so any gunicorn worker can
+    answer a status poll for a job submitted through another one. Set
+    ``ANALYSIS_WORKERS = 0`` to analyze inline in the request instead.
+    Finished jobs are recorded on a single completion thread rather than
+    the pool's result-handling thread, so a slow commit only delays other
+    jobs' bookkeeping, not the collection of their results.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._executor = None
+        self._completions = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ANALYSIS_WORKERS', int(os.environ.get('ANALYSIS_WORKERS', 2)))
+        app.config.setdefault('ANALYSIS_QUEUE_MAX_DEPTH', int(os.environ.get('ANALYSIS_QUEUE_MAX_DEPTH', 32)))
+        app.config.setdefault('ANALYSIS_JOB_TIMEOUT', int(os.environ.get('ANALYSIS_JOB_TIMEOUT', 90)))
+        # Jobs still queued after this long were lost (e.g. their web worker
+        # was restarted) and are marked failed so they stop counting as depth.
+        app.config.setdefault('ANALYSIS_JOB_STALE_AFTER', int(os.environ.get('ANALYSIS_JOB_STALE_AFTER', 600)))
+        self.app = app
+        app.extensions['analysis_queue'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.app.config['ANALYSIS_WORKERS'],
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+            return self._executor
+
+    def _get_completions(self):
+        with self._lock:
+            if self._completions is None:
+                self._completions = ThreadPoolExecutor(max_workers=1, thread_name_prefix='analysis-complete')
+            return self._completions
+
+    def _reset_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def warm(self):
+        """Start the pool's worker processes and load the analysis modules in them."""
+        workers = self.app.config['ANALYSIS_WORKERS']
+        if not workers:
+            return
+        executor = self._get_executor()
+        for _ in range(workers):
+            executor.submit(_warm_worker)
+
+    def expire_stale(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['ANALYSIS_JOB_STALE_AFTER'])
+        expired = (AnalysisJob.query
+                   .filter(AnalysisJob.status == 'queued', AnalysisJob.created_at < cutoff)
+                   .update({'status': 'failed', 'error': 'Analysis job was lost', 'finished_at': datetime.utcnow()},
+                           synchronize_session=False))
+        if expired:
+            db.session.commit()
+            logger.warning(f"Expired {expired} stale analysis jobs")
+
+    def depth(self):
+        return AnalysisJob.query.filter_by(status='queued').count()
+
+    def submit(self, user_id, score_id, audio_bytes, reference):
+        # A take analyzed before against the same score is recorded straight
+        # away, even when the queue is full
+        cache_key = result_cache.key(audio_bytes, reference)
+        cached, tier = result_cache.get(cache_key)
+        registry.inc('analysis_cache_total', result=tier or 'miss')
+        if cached is None:
+            self.expire_stale()
+            if self.depth() >= self.app.config['ANALYSIS_QUEUE_MAX_DEPTH']:
+                raise QueueFull()
+
+        job = AnalysisJob(id=uuid.uuid4().hex, user_id=user_id, score_id=score_id, status='queued')
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+        if cached is not None:
+            self._complete(job_id, result=cached)
+            return job_id
+
+        timeout = self.app.config['ANALYSIS_JOB_TIMEOUT']
+        if not self.app.config['ANALYSIS_WORKERS']:
+            from templates.audiodecode import AudioDecodeError
+            try:
+                self._complete(job_id, result=_run_analysis(audio_bytes, reference, None), cache_key=cache_key)
+            except AudioDecodeError as e:
+                self._complete(job_id, error=e)
+                raise RecordingUnreadable(str(e)) from e
+            except Exception as e:
+                self._complete(job_id, error=e)
+            return job_id
+
+        args = (_run_analysis, audio_bytes, reference, timeout)
+        executor = self._get_executor()
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            future = self._get_executor().submit(*args)
+        future.add_done_callback(lambda f: self._finished(job_id, f, cache_key))
+        return job_id
+
+    def _finished(self, job_id, future, cache_key=None):
+        # Runs on the pool's result-handling thread; the database work is
+        # handed to the completion thread
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self._reset_executor(self._executor)
+        result = None if error else future.result()
+        self._get_completions().submit(self._complete_in_context, job_id, result, error, cache_key)
+
+    def _complete_in_context(self, job_id, result, error, cache_key):
+        with self.app.app_context():
+            self._complete(job_id, result=result, error=error, cache_key=cache_key)
+
+    def _complete(self, job_id, result=None, error=None, cache_key=None):
+        if result is not None and cache_key is not None:
+            result_cache.put(cache_key, result)
+        job = db.session.get(AnalysisJob, job_id)
+        if job is None:
+            return
+        try:
+            if error is not None:
+                logger.error(f"Analysis job {job_id} failed: {error!r}")
+                job.status = 'failed'
+                job.error = ('Analysis timed out' if isinstance(error, JobTimeout)
+                             else str(error) or error.__class__.__name__)
+            else:
+                accuracy, feedback, correct_notes, incorrect_notes, notes = result
+                analysis = PerformanceAnalysis(
+                    user_id=job.user_id,
+                    score_id=job.score_id,
+                    accuracy=accuracy,
+                    feedback=feedback,
+                    note_results=json.dumps(notes),
+                    kind=RECORDING
+                )
+                db.session.add(analysis)
+                db.session.flush()
+                record_attempt(analysis)
+                job.performance_id = analysis.id
+                job.status = 'done'
+                job.result = json.dumps({
+                    'feedback': feedback,
+                    'accuracy': accuracy,
+                    'correct_notes': correct_notes,
+                    'incorrect_notes': incorrect_notes,
+                    'notes': notes
+                })
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Error recording analysis job {job_id}: {str(e)}", exc_info=True)
+            db.session.rollback()
+
+    def status(self, job):
+        data = {'job_id': job.id, 'status': job.status, 'score_id': job.score_id}
+        if job.status == 'done':
+            data.update(json.loads(job.result))
+        elif job.status == 'failed':
+            data['error'] = job.error
+        return data
+
+
+analysis_queue = AnalysisQueue()
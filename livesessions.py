@@ -0,0 +1,169 @@
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_FORMATS = {'s16': ('<i2', 1 / 32768.0), 'f32': ('<f4', 1.0)}
+
+
+class LiveSessionError(Exception):
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+class LiveSessions:
+    """Live pitch-check sessions, shared by every gunicorn worker through disk.
+
+    A session is three files in ``LIVE_SESSION_DIR``: ``<id>.json`` (owner,
+    score, next chunk number), ``<id>.npz`` (the
+    ``LiveAnalyzer`` state: overlap samples, resampler history, recent
+    frames) and ``<id>.frames``, to which each chunk's frame rows are
+    appended. Chunks of one session are serialized with a per-session file
+    lock, so consecutive chunks may land on different workers.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.ttl = 0
+        self.max_seconds = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIVE_SESSION_DIR', os.environ.get(
+            'LIVE_SESSION_DIR', os.path.join(app.instance_path, 'live_sessions')))
+        # Sessions without a chunk for this long are abandoned
+        app.config.setdefault('LIVE_SESSION_TTL', int(os.environ.get('LIVE_SESSION_TTL', 900)))
+        app.config.setdefault('LIVE_MAX_SECONDS', int(os.environ.get('LIVE_MAX_SECONDS', 900)))
+        self.directory = app.config['LIVE_SESSION_DIR']
+        self.ttl = app.config['LIVE_SESSION_TTL']
+        self.max_seconds = app.config['LIVE_MAX_SECONDS']
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['live_sessions'] = self
+
+    def _path(self, session_id, suffix):
+        return os.path.join(self.directory, f"{session_id}{suffix}")
+
+    @contextmanager
+    def _locked(self, session_id, user_id):
+        if not session_id.isalnum():
+            raise LiveSessionError('No such live session', 404)
+        try:
+            lock = open(self._path(session_id, '.lock'), 'r+')
+        except FileNotFoundError:
+            raise LiveSessionError('No such live session', 404)
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                meta_path = self._path(session_id, '.json')
+                try:
+                    with open(meta_path) as f:
+                        meta = json.load(f)
+                except FileNotFoundError:
+                    raise LiveSessionError('No such live session', 404)
+                if meta['user_id'] != user_id:
+                    raise LiveSessionError('No such live session', 404)
+                yield meta
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save(self, session_id, meta, analyzer):
+        tmp_path = self._path(session_id, '.npz.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **analyzer.state())
+        os.replace(tmp_path, self._path(session_id, '.npz'))
+        with open(self._path(session_id, '.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(self._path(session_id, '.json.tmp'), self._path(session_id, '.json'))
+
+    def _load(self, session_id):
+        from templates.liveanalysis import LiveAnalyzer
+        with np.load(self._path(session_id, '.npz'), allow_pickle=False) as state:
+            return LiveAnalyzer.from_state(dict(state))
+
+    def create(self, user_id, score_id, reference, sample_rate, sample_format='s16'):
+        from templates.liveanalysis import LiveAnalyzer
+        if sample_format not in SAMPLE_FORMATS:
+            raise LiveSessionError(f"Unsupported sample format {sample_format!r}")
+        if not 8000 <= sample_rate <= 192000:
+            raise LiveSessionError(f"Unsupported sample rate {sample_rate}")
+        self.expire()
+        session_id = uuid.uuid4().hex
+        meta = {'user_id': user_id, 'score_id': score_id, 'format': sample_format,
+                'next_seq': 0, 'created_at': time.time()}
+        open(self._path(session_id, '.frames'), 'wb').close()
+        self._save(session_id, meta, LiveAnalyzer(reference, sample_rate))
+        # The lock file is created last: a session exists once it can be locked
+        open(self._path(session_id, '.lock'), 'w').close()
+        return session_id
+
+    def feed(self, session_id, user_id, seq, data):
+        """Analyze chunk number ``seq`` of raw PCM; returns ``(verdicts, current)``.
+
+        A chunk that was already processed (a client retry) is acknowledged
+        without analyzing it again.
+        """
+        with self._locked(session_id, user_id) as meta:
+            if seq < meta['next_seq']:
+                return [], None
+            if seq > meta['next_seq']:
+                raise LiveSessionError('Chunk out of order', 409, expected_seq=meta['next_seq'])
+            dtype, scale = SAMPLE_FORMATS[meta['format']]
+            if len(data) % np.dtype(dtype).itemsize:
+                raise LiveSessionError('Chunk is not a whole number of samples')
+            chunk = np.frombuffer(data, dtype=dtype).astype(np.float32) * np.float32(scale)
+
+            analyzer = self._load(session_id)
+            if analyzer.seconds + len(chunk) / analyzer.sample_rate > self.max_seconds:
+                raise LiveSessionError('Recording is too long', 413)
+            frames, verdicts, current = analyzer.feed(chunk)
+            # Rows past the saved frame count are ignored on read, so a
+            # failure between these two writes can't corrupt the take
+            with open(self._path(session_id, '.frames'), 'ab') as f:
+                frames.tofile(f)
+            meta['next_seq'] = seq + 1
+            self._save(session_id, meta, analyzer)
+            return verdicts, current
+
+    def finish(self, session_id, user_id):
+        """Close the session; returns ``(meta, every frame row of the take)``."""
+        from templates.liveanalysis import FRAME_DTYPE
+        with self._locked(session_id, user_id) as meta:
+            analyzer = self._load(session_id)
+            count = analyzer.n_frames
+            frames = np.fromfile(self._path(session_id, '.frames'), dtype=FRAME_DTYPE, count=count)
+            frames = np.concatenate((frames[:count], analyzer.finish()))
+            self._remove(session_id)
+        return meta, frames
+
+    def _remove(self, session_id):
+        for suffix in ('.json', '.npz', '.frames', '.lock'):
+            try:
+                os.remove(self._path(session_id, suffix))
+            except OSError:
+                pass
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        stale = entry.stat().st_mtime < cutoff
+                    except OSError:
+                        continue
+                    if stale:
+                        logger.info(f"Removing abandoned live session {entry.name[:-5]}")
+                        self._remove(entry.name[:-5])
+
+
+live_sessions = LiveSessions()
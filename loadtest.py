@@ -0,0 +1,429 @@
+import http.cookiejar
+import io
+import json
+import os
+import platform
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks import FIXTURE_DIR, RENDER_FIXTURE, ROOT
+
+# Synthesized takes: a bowed-string-like harmonic series, each note with an
+# attack, a release before the next one and a little vibrato
+SYNTH_SR = 44100
+HARMONICS = (1.0, 0.6, 0.45, 0.3, 0.25, 0.15, 0.1, 0.08)
+ATTACK_SECONDS = 0.03
+RELEASE_SECONDS = 0.04
+LEGATO = 0.92  # fraction of a note's length it sounds for
+VIBRATO_HZ = 5.5
+VIBRATO_CENTS = 15.0
+LEAD_IN_SECONDS = 0.5
+# Takes are cut off here; a WAV this long stays under MAX_CONTENT_LENGTH
+MAX_TAKE_SECONDS = 90
+
+# Clean takes rendered up front; every upload adds its own noise on top, so
+# no two are the same bytes and the analysis result cache never answers
+TAKE_VARIANTS = 4
+
+POLL_SECONDS = 0.5
+ANALYSIS_WAIT_SECONDS = 300
+SERVER_START_SECONDS = 120
+REQUEST_TIMEOUT = 180
+
+PERCENTILES = (50, 95, 99)
+
+
+def score_notes(database_url, score_id):
+    """A score's notes in render order, packed from its ``note_data`` rows."""
+    import sqlalchemy as sa
+
+    from models import NoteData
+    from notestore import pack_columns
+
+    engine = sa.create_engine(database_url)
+    try:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                sa.select(NoteData.note_name, NoteData.duration, NoteData.measure)
+                .where(NoteData.score_id == score_id)
+                .order_by(NoteData.measure, NoteData.id)).all()
+    finally:
+        engine.dispose()
+    if not rows:
+        raise RuntimeError(f"Score {score_id} has no note_data rows (is STORE_NOTE_ROWS off?)")
+    return pack_columns([row.note_name for row in rows], [row.duration for row in rows],
+                        [row.measure for row in rows])
+
+
+def synthesize_take(packed, rng, tempo=90.0, drift=0.03, wrong_notes=0.05, sr=SYNTH_SR,
+                    max_seconds=MAX_TAKE_SECONDS):
+    """A take of ``packed`` played on a synthetic violin, as a float32 buffer at ``sr``.
+
+    The tempo wanders as a random walk of ``drift`` (log-tempo per note)
+    around ``tempo`` BPM, a ``wrong_notes`` fraction of the pitched notes are
+    played a semitone or two off, and every note is a few cents out of tune.
+    Every sample is rendered at once: each looks up the note it falls in,
+    and the harmonics are summed over a phase accumulated from the per-sample
+    frequency, so pitch changes don't click.
+    """
+    midi = packed['midi'].astype(np.float64)
+    beats = packed['duration'].astype(np.float64)
+    pitched = midi >= 0
+    wrong = pitched & (rng.random(len(midi)) < wrong_notes)
+    midi[wrong] += rng.choice([-2, -1, 1, 2], int(wrong.sum()))
+
+    seconds = beats * 60.0 / (tempo * np.exp(np.cumsum(rng.normal(0.0, drift, len(beats)))))
+    onsets = np.concatenate(([0.0], np.cumsum(seconds)))
+    total = min(onsets[-1] + 2 * LEAD_IN_SECONDS, max_seconds)
+    t = np.arange(int(total * sr)) / sr - LEAD_IN_SECONDS
+
+    index = np.searchsorted(onsets, t, side='right') - 1
+    inside = (index >= 0) & (index < len(midi))
+    index = np.clip(index, 0, len(midi) - 1)
+    note = np.where(inside, midi[index], -1.0)
+    since = t - onsets[index]
+
+    detune = rng.normal(0.0, 8.0, len(midi))[index]
+    vibrato = VIBRATO_CENTS * np.sin(2 * np.pi * VIBRATO_HZ * t) * np.clip(since / 0.3, 0.0, 1.0)
+    freq = np.where(note >= 0, 440.0 * 2.0 ** ((note - 69.0 + (detune + vibrato) / 100.0) / 12.0), 0.0)
+    phase = 2 * np.pi * np.cumsum(freq) / sr
+
+    envelope = (np.clip(since / ATTACK_SECONDS, 0.0, 1.0)
+                * np.clip((seconds[index] * LEGATO - since) / RELEASE_SECONDS, 0.0, 1.0)
+                * (note >= 0))
+    y = np.zeros(len(t))
+    for k, amplitude in enumerate(HARMONICS, start=1):
+        y += amplitude * (k * freq < sr / 2) * np.sin(k * phase)
+    return (0.3 / sum(HARMONICS) * envelope * y).astype(np.float32)
+
+
+def encode_take(clean, rng, snr_db=30.0, sr=SYNTH_SR):
+    """``clean`` plus white noise ``snr_db`` below its level, as 16-bit WAV bytes."""
+    import soundfile as sf
+
+    level = np.sqrt(np.mean(np.square(clean[clean != 0], dtype=np.float64))) if clean.any() else 0.1
+    noisy = clean + rng.normal(0.0, level * 10 ** (-snr_db / 20), len(clean)).astype(np.float32)
+    buffer = io.BytesIO()
+    sf.write(buffer, np.clip(noisy, -1.0, 1.0), sr, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Stats:
+    """Latencies and outcomes per endpoint, shared by every simulated student."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self._calls.setdefault(endpoint, []).append((seconds, ok))
+
+    def summary(self, wall_seconds):
+        results = {}
+        with self._lock:
+            calls = {endpoint: list(values) for endpoint, values in self._calls.items()}
+        for endpoint, values in sorted(calls.items()):
+            seconds = np.array([value[0] for value in values])
+            errors = sum(1 for value in values if not value[1])
+            results[endpoint] = {
+                'requests': len(values),
+                'errors': errors,
+                'error_rate': errors / len(values),
+                'throughput': len(values) / wall_seconds if wall_seconds else 0.0,
+                **{f"p{p}_ms": float(np.percentile(seconds, p) * 1000) for p in PERCENTILES},
+            }
+        return results
+
+
+class Student:
+    """One simulated student: a cookie session against the server under test."""
+
+    def __init__(self, base_url, stats, name):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.name = name
+        self.email = f"{name}@loadtest.invalid"
+        self.password = secrets.token_hex(8)
+        self.score_id = None
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, endpoint, path, data=None, files=None, ok=(200,)):
+        """``(status, headers, body)``; the call is recorded under ``endpoint``.
+
+        ``ok`` lists the statuses that count as success, or is a function of
+        ``(status, headers)`` deciding it.
+        """
+        headers = {}
+        body = None
+        if files:
+            boundary = secrets.token_hex(16)
+            body = _multipart(boundary, data or {}, files)
+            headers['Content-Type'] = f"multipart/form-data; boundary={boundary}"
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        request = urllib.request.Request(self.base_url + path, data=body, headers=headers)
+
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                status, response_headers, content = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, content = e.code, e.headers, e.read()
+        except OSError:
+            self.stats.record(endpoint, time.perf_counter() - started, False)
+            return None, {}, b''
+        passed = ok(status, response_headers) if callable(ok) else status in ok
+        self.stats.record(endpoint, time.perf_counter() - started, passed)
+        return status, response_headers, content
+
+    def sign_in(self, attempts=5):
+        self.request('register', '/register', {'username': self.name, 'email': self.email,
+                                               'password': self.password}, ok=(302,))
+        for _ in range(attempts):
+            status, headers, _body = self.request('login', '/login', {'email': self.email,
+                                                                      'password': self.password}, ok=(302,))
+            if status == 302:
+                return True
+            # Logins beyond the password hasher's queue are turned away with a Retry-After
+            time.sleep(float(headers.get('Retry-After', 1)) if status == 503 else 1)
+        return False
+
+    def upload_score(self, name, data):
+        # Failed uploads redirect to the dashboard instead of the score
+        status, headers, _body = self.request(
+            'upload_score', '/upload_score', files={'music_score': (name, data)},
+            ok=lambda status, headers: status == 302 and 'score_id=' in headers.get('Location', ''))
+        match = re.search(r'score_id=(\d+)', headers.get('Location', '')) if status == 302 else None
+        if match is None:
+            return None
+        self.score_id = int(match.group(1))
+        return self.score_id
+
+    def record_performance(self):
+        self.request('record_performance', '/record_performance')
+
+    def analyze(self, take):
+        """Upload a take and wait for its analysis; the wait is recorded as ``analysis_complete``."""
+        started = time.perf_counter()
+        status, _headers, body = self.request('analyze_recording', '/analyze_recording',
+                                              data={'score_id': str(self.score_id)},
+                                              files={'audio': ('take.wav', take)}, ok=(200, 202))
+        if status not in (200, 202):
+            return
+        data = json.loads(body)
+        status_url = data['status_url']
+        deadline = time.monotonic() + ANALYSIS_WAIT_SECONDS
+        while data.get('status') not in ('done', 'failed') and time.monotonic() < deadline:
+            time.sleep(POLL_SECONDS)
+            status, _headers, body = self.request('analysis_status', status_url, ok=(200, 202))
+            if status is None or not body:
+                continue
+            data = json.loads(body)
+        self.stats.record('analysis_complete', time.perf_counter() - started, data.get('status') == 'done')
+
+
+def _multipart(boundary, fields, files):
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(scratch, server='gunicorn', workers=4, threads=4, timeout=120, database_url=None):
+    """Start the app on a free local port against scratch storage; returns ``(process, base_url)``.
+
+    ``gunicorn`` runs with ``gunicorn_config.py``, its pool sizes overridden
+    by ``workers``/``threads``/``timeout``; ``flask`` is the development
+    server, for machines without gunicorn.
+    """
+    port = _free_port()
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+               DATABASE_URL=database_url or f"sqlite:///{os.path.join(scratch, 'loadtest.db')}",
+               PARSE_CACHE_DIR=os.path.join(scratch, 'parse_cache'),
+               METRICS_DIR=os.path.join(scratch, 'metrics'),
+               REFERENCE_DIR=os.path.join(scratch, 'references'),
+               LIVE_SESSION_DIR=os.path.join(scratch, 'live_sessions'),
+               RESULT_CACHE_DIR=os.path.join(scratch, 'result_cache'))
+    if server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn_config.py'),
+                   '--bind', f"127.0.0.1:{port}", '--workers', str(workers), '--threads', str(threads),
+                   '--timeout', str(timeout), 'app:app']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port),
+                   '--with-threads', '--no-reload']
+    # Run from the scratch directory so uploads land there, not in the tree
+    log = open(os.path.join(scratch, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=scratch, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            with open(os.path.join(scratch, 'server.log'), errors='replace') as f:
+                tail = f.read().strip().splitlines()[-5:]
+            raise RuntimeError(f"The server exited with {process.returncode}: " + ' / '.join(tail))
+        try:
+            with urllib.request.urlopen(base_url + '/', timeout=2):
+                return process, base_url
+        except OSError:
+            time.sleep(0.5)
+    stop_server(process)
+    raise RuntimeError(f"The server did not answer within {SERVER_START_SECONDS}s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_load(base_url, database_url, score_path, students=16, duration=60.0, ramp=10.0, think=1.0,
+             tempo=90.0, drift=0.03, wrong_notes=0.05, snr_db=30.0, seed=0, echo=print):
+    """Drive ``students`` simulated students against ``base_url``; returns the per-endpoint summary.
+
+    A setup student uploads ``score_path`` first, and the takes are
+    synthesized from the ``note_data`` rows that upload stored. Then every
+    student signs in, uploads the score, and until ``duration`` runs out
+    opens the recording page and submits a take, waiting for its analysis
+    and ``think`` seconds before the next. Students start spread over
+    ``ramp`` seconds, as a class arriving.
+    """
+    with open(score_path, 'rb') as f:
+        score_name, score_data = os.path.basename(score_path), f.read()
+
+    setup = Student(base_url, Stats(), f"loadtest-setup-{secrets.token_hex(4)}")
+    if not setup.sign_in() or setup.upload_score(score_name, score_data) is None:
+        raise RuntimeError(f"Could not upload {score_name} as the setup user")
+    packed = score_notes(database_url, setup.score_id)
+    rng = np.random.default_rng(seed)
+    takes = [synthesize_take(packed, rng, tempo, drift, wrong_notes) for _ in range(TAKE_VARIANTS)]
+    echo(f"{len(packed)} notes, {len(takes[0]) / SYNTH_SR:.1f}s takes; "
+         f"{students} students for {duration:.0f}s against {base_url}")
+
+    stats = Stats()
+    started = time.monotonic()
+    deadline = started + ramp + duration
+
+    def run_student(number):
+        student_rng = np.random.default_rng([seed, number])
+        time.sleep(ramp * number / max(students, 1))
+        student = Student(base_url, stats, f"loadtest-{secrets.token_hex(4)}-{number}")
+        if not student.sign_in() or student.upload_score(score_name, score_data) is None:
+            return
+        while time.monotonic() < deadline:
+            student.record_performance()
+            take = encode_take(takes[student_rng.integers(len(takes))], student_rng, snr_db)
+            student.analyze(take)
+            time.sleep(think)
+
+    threads = [threading.Thread(target=run_student, args=(number,), daemon=True) for number in range(students)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return stats.summary(time.monotonic() - started)
+
+
+def print_summary(results, echo=print):
+    width = max([len(endpoint) for endpoint in results] + [8]) + 2
+    echo(f"{'endpoint':<{width}}{'requests':>9}{'errors':>8}{'err %':>7}{'req/s':>8}"
+         + ''.join(f"{f'p{p} ms':>10}" for p in PERCENTILES))
+    for endpoint, result in results.items():
+        echo(f"{endpoint:<{width}}{result['requests']:>9}{result['errors']:>8}{result['error_rate'] * 100:>7.1f}"
+             f"{result['throughput']:>8.2f}" + ''.join(f"{result[f'p{p}_ms']:>10.0f}" for p in PERCENTILES))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Load-test the upload, recording page and analysis paths with synthesized recordings.')
+    parser.add_argument('--students', type=int, default=16, help='Concurrent simulated students (default: 16).')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds of load after the ramp (default: 60).')
+    parser.add_argument('--ramp', type=float, default=10, help='Seconds over which students start (default: 10).')
+    parser.add_argument('--think', type=float, default=1, help='Pause after each analysis, in seconds.')
+    parser.add_argument('--score', default=os.path.join(FIXTURE_DIR, RENDER_FIXTURE),
+                        help=f"Score file to upload (default: uploads/{RENDER_FIXTURE}).")
+    parser.add_argument('--tempo', type=float, default=90, help='Tempo of the synthesized takes in BPM.')
+    parser.add_argument('--drift', type=float, default=0.03, help='Tempo drift, log-tempo per note.')
+    parser.add_argument('--wrong-notes', type=float, default=0.05, help='Fraction of notes played wrong.')
+    parser.add_argument('--snr', type=float, default=30, help='Signal-to-noise ratio of the takes in dB.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server', choices=('gunicorn', 'flask'), default='gunicorn',
+                        help='Server to start locally (default: gunicorn with gunicorn_config.py).')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--timeout', type=int, default=120)
+    parser.add_argument('--url', help='Test a server that is already running instead of starting one.')
+    parser.add_argument('--database-url', help="That server's database, for reading note_data "
+                                               '(with --url; otherwise a scratch SQLite file is used).')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    if args.url and not args.database_url:
+        parser.error('--url needs --database-url to read the score notes')
+
+    with tempfile.TemporaryDirectory() as scratch:
+        process = None
+        database_url = args.database_url or f"sqlite:///{os.path.join(scratch, 'loadtest.db')}"
+        base_url = args.url
+        if not base_url:
+            process, base_url = start_server(scratch, args.server, args.workers, args.threads, args.timeout,
+                                             database_url)
+        try:
+            results = run_load(base_url, database_url, args.score, args.students, args.duration, args.ramp,
+                               args.think, args.tempo, args.drift, args.wrong_notes, args.snr, args.seed)
+        finally:
+            if process is not None:
+                stop_server(process)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'config': {name: value for name, value in vars(args).items() if name != 'output'},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
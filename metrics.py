@@ -0,0 +1,333 @@
+import cProfile
+import fcntl
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds; an upload parse or a recording analysis can take
+# several seconds, a cached page render a few milliseconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRIC_PREFIX = 'teachmemusic_'
+METRIC_HELP = {
+    'request_seconds': ('histogram', 'Request latency by route.'),
+    'requests_total': ('counter', 'Requests by route and status code.'),
+    'stage_seconds': ('histogram', 'Time spent in one processing stage (parse, DB insert, decode, ...).'),
+    'stage_errors_total': ('counter', 'Stages that raised.'),
+    'parse_cache_total': ('counter', 'Upload parse cache lookups by result.'),
+    'analysis_cache_total': ('counter', 'Analysis result cache lookups by tier (memory, disk or miss).'),
+}
+
+_ARCHIVE_FILE = 'archived.json'
+
+
+def _series_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Registry:
+    """Histograms and counters for this process.
+
+    With ``directory`` set (``METRICS_DIR``), the values are also written to
+    ``<directory>/<pid>-<token>.json`` at most every ``flush_interval``
+    seconds, so ``collect()`` in any process can add up every gunicorn worker
+    and analysis pool process. Files of processes that have exited are folded
+    into one archive file so the totals stay monotonic.
+    """
+
+    def __init__(self, directory=None, flush_interval=2.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._timer = None
+        self._file = None
+
+    def observe(self, name, seconds, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            index = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            series[0][index] += 1
+            series[1] += seconds
+        self._schedule_flush()
+
+    def inc(self, name, amount=1, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _snapshot(self):
+        with self._lock:
+            self._timer = None
+            return {
+                'pid': os.getpid(),
+                'histograms': [[name, dict(labels), buckets[:], total]
+                               for (name, labels), (buckets, total) in self.histograms.items()],
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+            }
+
+    def flush(self):
+        """Write this process's values to its file in the metrics directory."""
+        if not self.directory:
+            return
+        snapshot = self._snapshot()
+        if self._file is None:
+            self._file = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json")
+        tmp_path = f"{self._file}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self._file)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self._file}: {str(e)}")
+
+    def collect(self):
+        """Totals over every process as (histograms, counters) dicts keyed by (name, labels)."""
+        if not self.directory:
+            return self._merge([self._snapshot()])
+        self.flush()
+        with self._archive_lock():
+            self._archive_exited()
+            snapshots = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return self._merge(snapshots)
+
+    @contextmanager
+    def _archive_lock(self):
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _archive_exited(self):
+        exited = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json') or name == _ARCHIVE_FILE:
+                continue
+            pid = int(name.split('-', 1)[0])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                exited.append(os.path.join(self.directory, name))
+            except PermissionError:
+                pass
+        if not exited:
+            return
+
+        archive_path = os.path.join(self.directory, _ARCHIVE_FILE)
+        snapshots = []
+        for path in [archive_path] + exited:
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        histograms, counters = self._merge(snapshots)
+        archive = {
+            'pid': 0,
+            'histograms': [[name, dict(labels), buckets, total]
+                           for (name, labels), (buckets, total) in histograms.items()],
+            'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        }
+        with open(f"{archive_path}.tmp", 'w') as f:
+            json.dump(archive, f)
+        os.replace(f"{archive_path}.tmp", archive_path)
+        for path in exited:
+            os.remove(path)
+
+    @staticmethod
+    def _merge(snapshots):
+        histograms, counters = {}, {}
+        for snapshot in snapshots:
+            for name, labels, buckets, total in snapshot['histograms']:
+                key = _series_key(name, labels)
+                if key in histograms:
+                    merged = histograms[key]
+                    merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                    merged[1] += total
+                else:
+                    histograms[key] = [list(buckets), total]
+            for name, labels, value in snapshot['counters']:
+                key = _series_key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+        return histograms, counters
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        histograms, counters = self.collect()
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            full_name = METRIC_PREFIX + name
+            series = histograms if kind == 'histogram' else counters
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == 'counter':
+                    lines.append(f"{full_name}{_format_labels(labels)} {series[key]}")
+                    continue
+                buckets, total = series[key]
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', repr(bound)),))} {cumulative}")
+                count = sum(buckets)
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+# Pool workers are spawned with the parent's environment, so they find the
+# directory the web app configured and write their own files
+registry = Registry(os.environ.get('METRICS_DIR') or None)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as ``stage_seconds{stage=name}``; works in any process."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        registry.inc('stage_errors_total', stage=name)
+        raise
+    finally:
+        registry.observe('stage_seconds', time.perf_counter() - started, stage=name)
+
+
+class Metrics:
+    """Per-route request metrics, the shared registry directory and sampled profiles.
+
+    ``METRICS_DIR`` is where every process writes its values (default
+    ``instance/metrics``). With ``PROFILE_SAMPLE_RATE`` above 0, that
+    fraction of requests runs under cProfile and is dumped to
+    ``PROFILE_DIR`` as ``.prof`` files, keeping the newest ``PROFILE_KEEP``.
+    ``/metrics`` needs ``Authorization: Bearer <METRICS_TOKEN>``; with no
+    token configured it is only served to loopback clients.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', os.environ.get(
+            'METRICS_DIR', os.path.join(app.instance_path, 'metrics')))
+        app.config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+        app.config.setdefault('PROFILE_DIR', os.environ.get(
+            'PROFILE_DIR', os.path.join(app.instance_path, 'profiles')))
+        app.config.setdefault('PROFILE_KEEP', int(os.environ.get('PROFILE_KEEP', 200)))
+        self.app = app
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        registry.directory = app.config['METRICS_DIR']
+        os.environ['METRICS_DIR'] = app.config['METRICS_DIR']
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.extensions['metrics'] = self
+
+    def authorized(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+        try:
+            return ipaddress.ip_address(request.remote_addr or '').is_loopback
+        except ValueError:
+            return False
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already running in this process
+                return
+            g.metrics_profiler = profiler
+
+    def _after_request(self, response):
+        g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.pop('metrics_status', 500)
+        registry.observe('request_seconds', elapsed, route=route, method=request.method)
+        registry.inc('requests_total', route=route, method=request.method, status=str(status))
+
+        profiler = g.pop('metrics_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._dump_profile(profiler, route, elapsed)
+
+    def _dump_profile(self, profiler, route, elapsed):
+        directory = self.app.config['PROFILE_DIR']
+        name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'
+        path = os.path.join(directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{name}-{os.getpid()}-{elapsed * 1000:.0f}ms.prof")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(path)
+            profiles = sorted((entry.stat().st_mtime, entry.path) for entry in os.scandir(directory)
+                              if entry.name.endswith('.prof'))
+            for _mtime, old_path in profiles[:-self.app.config['PROFILE_KEEP']]:
+                os.remove(old_path)
+        except OSError as e:
+            logger.warning(f"Could not write request profile {path}: {str(e)}")
+
+
+metrics = Metrics()
@@ -0,0 +1,40 @@
+"""Add analysis_job table
+
+Revision ID: 3b1f6c2d9e04
+Revises: 77898099f6ca
+Create Date: 2026-10-18 09:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f6c2d9e04'
+down_revision = '77898099f6ca'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('analysis_job',
+    sa.Column('id', sa.String(length=32), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('score_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('performance_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['performance_id'], ['performance_analysis.id'], ),
+    sa.ForeignKeyConstraint(['score_id'], ['score.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_analysis_job_status'), 'analysis_job', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_analysis_job_status'), table_name='analysis_job')
+    op.drop_table('analysis_job')
@@ -0,0 +1,43 @@
+"""Store score measures as rows for windowed loading
+
+Revision ID: 6a1e8c3d2f90
+Revises: d3f9a2b7c614
+Create Date: 2026-10-18 20:12:48.915362
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a1e8c3d2f90'
+down_revision = 'd3f9a2b7c614'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('score_measure',
+    sa.Column('score_id', sa.Integer(), nullable=False),
+    sa.Column('seq', sa.Integer(), nullable=False),
+    sa.Column('number', sa.Integer(), nullable=False),
+    sa.Column('position', sa.Integer(), nullable=False),
+    sa.Column('notes', sa.Text(), nullable=False),
+    sa.ForeignKeyConstraint(['score_id'], ['score.id'], ),
+    sa.PrimaryKeyConstraint('score_id', 'seq')
+    )
+    # Existing scores get their measure rows built on first view; the
+    # cleared ETag keeps browsers from reusing pages cached before
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('measure_count', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('pitched_count', sa.Integer(), nullable=True))
+        batch_op.drop_column('vexflow_notes')
+    op.execute(sa.text("UPDATE score SET vexflow_etag = NULL"))
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('vexflow_notes', sa.Text(), nullable=True))
+        batch_op.drop_column('pitched_count')
+        batch_op.drop_column('measure_count')
+    op.drop_table('score_measure')
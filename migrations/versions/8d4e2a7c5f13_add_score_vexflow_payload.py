@@ -0,0 +1,28 @@
+"""Add precomputed VexFlow payload to score
+
+Revision ID: 8d4e2a7c5f13
+Revises: 3b1f6c2d9e04
+Create Date: 2026-10-18 10:02:47.118530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d4e2a7c5f13'
+down_revision = '3b1f6c2d9e04'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('vexflow_notes', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('vexflow_etag', sa.String(length=40), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.drop_column('vexflow_etag')
+        batch_op.drop_column('vexflow_notes')
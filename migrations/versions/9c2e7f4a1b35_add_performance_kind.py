@@ -0,0 +1,29 @@
+"""Store whether a performance_analysis row is a recording or a rhythm check
+
+Revision ID: 9c2e7f4a1b35
+Revises: 6a1e8c3d2f90
+Create Date: 2026-10-18 21:26:17.503841
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c2e7f4a1b35'
+down_revision = '6a1e8c3d2f90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('performance_analysis', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('kind', sa.String(length=10), nullable=False, server_default='recording'))
+    # Existing rows only say so in their feedback text; this is the last
+    # time it is read for that
+    op.execute(sa.text("UPDATE performance_analysis SET kind = 'rhythm' WHERE feedback LIKE 'Rhythm accuracy:%'"))
+
+
+def downgrade():
+    with op.batch_alter_table('performance_analysis', schema=None) as batch_op:
+        batch_op.drop_column('kind')
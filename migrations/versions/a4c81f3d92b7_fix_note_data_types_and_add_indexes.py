@@ -0,0 +1,81 @@
+"""Fix note_data.duration and performance_analysis.score_id, add hot-query indexes
+
+Revision ID: a4c81f3d92b7
+Revises: e7b3d5a1c842
+Create Date: 2026-10-18 14:21:07.316052
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c81f3d92b7'
+down_revision = 'e7b3d5a1c842'
+branch_labels = None
+depends_on = None
+
+# Lets batch mode on SQLite name (and so drop) the unnamed foreign keys
+# created by the first migration
+naming_convention = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+}
+
+
+def _foreign_key(table, column, referred_table):
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys(table):
+        if fk['constrained_columns'] == [column] and fk['referred_table'] == referred_table:
+            return fk['name'] or f'fk_{table}_{column}_{referred_table}'
+    return None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    # The first migration created score without its owner column
+    if 'user_id' not in {column['name'] for column in inspector.get_columns('score')}:
+        with op.batch_alter_table('score', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_score_user_id_user', 'user', ['user_id'], ['id'])
+
+    with op.batch_alter_table('note_data', schema=None) as batch_op:
+        batch_op.alter_column('duration',
+                              existing_type=sa.String(length=10),
+                              type_=sa.Float(),
+                              existing_nullable=False,
+                              postgresql_using='duration::double precision')
+        batch_op.create_index('ix_note_data_score_id_measure_id', ['score_id', 'measure', 'id'],
+                              unique=False, postgresql_include=['note_name', 'duration'])
+
+    wrong_fk = _foreign_key('performance_analysis', 'score_id', 'note_data')
+    with op.batch_alter_table('performance_analysis', schema=None,
+                              naming_convention=naming_convention) as batch_op:
+        if wrong_fk:
+            batch_op.drop_constraint(wrong_fk, type_='foreignkey')
+            batch_op.create_foreign_key('fk_performance_analysis_score_id_score', 'score', ['score_id'], ['id'])
+        batch_op.create_index('ix_performance_analysis_user_id_score_id_timestamp',
+                              ['user_id', 'score_id', 'timestamp'], unique=False)
+
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.create_index('ix_score_user_id_id', ['user_id', 'id'], unique=False,
+                              postgresql_include=['vexflow_etag'])
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.drop_index('ix_score_user_id_id')
+
+    with op.batch_alter_table('performance_analysis', schema=None,
+                              naming_convention=naming_convention) as batch_op:
+        batch_op.drop_index('ix_performance_analysis_user_id_score_id_timestamp')
+        fixed_fk = _foreign_key('performance_analysis', 'score_id', 'score')
+        if fixed_fk:
+            batch_op.drop_constraint(fixed_fk, type_='foreignkey')
+            batch_op.create_foreign_key('fk_performance_analysis_score_id_note_data', 'note_data', ['score_id'], ['id'])
+
+    with op.batch_alter_table('note_data', schema=None) as batch_op:
+        batch_op.drop_index('ix_note_data_score_id_measure_id')
+        batch_op.alter_column('duration',
+                              existing_type=sa.Float(),
+                              type_=sa.String(length=10),
+                              existing_nullable=False)
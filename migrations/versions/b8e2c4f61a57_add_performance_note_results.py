@@ -0,0 +1,26 @@
+"""Add per-note results to performance_analysis
+
+Revision ID: b8e2c4f61a57
+Revises: f2d67b0c3e18
+Create Date: 2026-10-18 17:41:09.215634
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e2c4f61a57'
+down_revision = 'f2d67b0c3e18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('performance_analysis', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('note_results', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('performance_analysis', schema=None) as batch_op:
+        batch_op.drop_column('note_results')
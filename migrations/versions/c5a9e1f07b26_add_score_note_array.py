@@ -0,0 +1,28 @@
+"""Add packed note array to score
+
+Revision ID: c5a9e1f07b26
+Revises: 8d4e2a7c5f13
+Create Date: 2026-10-18 11:20:05.637214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5a9e1f07b26'
+down_revision = '8d4e2a7c5f13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('note_array', sa.LargeBinary(), nullable=True))
+        batch_op.add_column(sa.Column('note_count', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.drop_column('note_count')
+        batch_op.drop_column('note_array')
@@ -0,0 +1,27 @@
+"""Rebuild VexFlow payloads with tick-quantized durations
+
+Revision ID: d3f9a2b7c614
+Revises: b8e2c4f61a57
+Create Date: 2026-10-18 19:05:33.480127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f9a2b7c614'
+down_revision = 'b8e2c4f61a57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Payloads built before triplets and float noise were snapped to the
+    # nearest duration showed those notes as quarters; cleared ones are
+    # rebuilt from the notes on the next view
+    op.execute(sa.text("UPDATE score SET vexflow_notes = NULL, vexflow_etag = NULL"))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,28 @@
+"""Add content hash to score
+
+Revision ID: e7b3d5a1c842
+Revises: c5a9e1f07b26
+Create Date: 2026-10-18 12:04:51.920377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3d5a1c842'
+down_revision = 'c5a9e1f07b26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_score_content_hash'), ['content_hash'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('score', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_score_content_hash'))
+        batch_op.drop_column('content_hash')
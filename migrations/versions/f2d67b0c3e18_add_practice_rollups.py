@@ -0,0 +1,51 @@
+"""Add practice progress rollup tables
+
+Revision ID: f2d67b0c3e18
+Revises: a4c81f3d92b7
+Create Date: 2026-10-18 15:02:44.870391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2d67b0c3e18'
+down_revision = 'a4c81f3d92b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('practice_score_rollup',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('score_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('accuracy_sum', sa.Float(), nullable=False),
+    sa.Column('best_accuracy', sa.Float(), nullable=False),
+    sa.Column('last_accuracy', sa.Float(), nullable=False),
+    sa.Column('ema_accuracy', sa.Float(), nullable=False),
+    sa.Column('first_attempt_at', sa.DateTime(), nullable=True),
+    sa.Column('last_attempt_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['score_id'], ['score.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'score_id', 'kind')
+    )
+    op.create_table('practice_day_rollup',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('score_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('accuracy_sum', sa.Float(), nullable=False),
+    sa.Column('best_accuracy', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['score_id'], ['score.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'day', 'score_id', 'kind')
+    )
+
+
+def downgrade():
+    op.drop_table('practice_day_rollup')
+    op.drop_table('practice_score_rollup')
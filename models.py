@@ -9,25 +9,105 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(60), nullable=False)
 
 class PerformanceAnalysis(db.Model):
+    # A student's history of one score, newest last
+    __table_args__ = (
+        db.Index('ix_performance_analysis_user_id_score_id_timestamp', 'user_id', 'score_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     score_id = db.Column(db.Integer, db.ForeignKey('score.id'), nullable=False)
     accuracy = db.Column(db.Float, nullable=False)
     feedback = db.Column(db.Text, nullable=False)
+    # JSON list of per-note pitch and timing results from the score
+    # alignment; NULL for rhythm checks and older recordings
+    note_results = db.Column(db.Text)
+    # 'recording' or 'rhythm' (progress.RECORDING / progress.RHYTHM)
+    kind = db.Column(db.String(10), nullable=False, default='recording', server_default='recording')
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     user = db.relationship('User', backref=db.backref('performances', lazy=True))
     score = db.relationship('Score', backref=db.backref('performances', lazy=True))
 
 class Score(db.Model):
+    # A user's latest score; the ETag is included so PostgreSQL can answer
+    # record_performance from the index alone
+    __table_args__ = (
+        db.Index('ix_score_user_id_id', 'user_id', 'id', postgresql_include=['vexflow_etag']),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # Hash of the VexFlow measures (ScoreMeasure rows), built once when the
+    # notes are stored; NULL counts mean the rows haven't been built yet
+    vexflow_etag = db.Column(db.String(40))
+    measure_count = db.Column(db.Integer)
+    pitched_count = db.Column(db.Integer)
+    # Packed notes (notestore.NOTE_DTYPE saved with np.save); NoteData rows
+    # are an optional normalized copy
+    note_array = db.deferred(db.Column(db.LargeBinary))
+    note_count = db.Column(db.Integer)
+    # SHA-256 of the uploaded file; repeat uploads reuse its cached parse
+    content_hash = db.Column(db.String(64), index=True)
     notes = db.relationship('NoteData', back_populates='score', cascade='all, delete-orphan')
+    measures = db.relationship('ScoreMeasure', cascade='all, delete-orphan')
+
+class ScoreMeasure(db.Model):
+    # One row per measure of a score, keyed by its 1-based place in render
+    # order so a window of measures is a primary-key range scan. number is
+    # the measure's own label, position the score index of its first note
+    # and notes the VexFlow-ready JSON list.
+    score_id = db.Column(db.Integer, db.ForeignKey('score.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    number = db.Column(db.Integer, nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    notes = db.Column(db.Text, nullable=False)
 
 class NoteData(db.Model):
+    # Notes of a score in render order, with the selected columns included
+    # for an index-only scan on PostgreSQL
+    __table_args__ = (
+        db.Index('ix_note_data_score_id_measure_id', 'score_id', 'measure', 'id',
+                 postgresql_include=['note_name', 'duration']),
+    )
     id = db.Column(db.Integer, primary_key=True)
     measure = db.Column(db.Integer, nullable=False)
     note_name = db.Column(db.String(10), nullable=False)
     duration = db.Column(db.Float, nullable=False)
     score_id = db.Column(db.Integer, db.ForeignKey('score.id'), nullable=False)
-    score = db.relationship('Score', back_populates='notes')
\ No newline at end of file
+    score = db.relationship('Score', back_populates='notes')
+
+class AnalysisJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    score_id = db.Column(db.Integer, db.ForeignKey('score.id'), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued', index=True)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    performance_id = db.Column(db.Integer, db.ForeignKey('performance_analysis.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime)
+
+# Practice progress rollups, updated in the same transaction as every
+# PerformanceAnalysis insert (see progress.py). kind is 'recording' or
+# 'rhythm'; accuracies are 0-1 fractions for both.
+class PracticeScoreRollup(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    score_id = db.Column(db.Integer, db.ForeignKey('score.id'), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False)
+    accuracy_sum = db.Column(db.Float, nullable=False)
+    best_accuracy = db.Column(db.Float, nullable=False)
+    last_accuracy = db.Column(db.Float, nullable=False)
+    # Exponential moving average over attempts, most recent weighted highest
+    ema_accuracy = db.Column(db.Float, nullable=False)
+    first_attempt_at = db.Column(db.DateTime)
+    last_attempt_at = db.Column(db.DateTime)
+
+class PracticeDayRollup(db.Model):
+    # Keyed by user and day first so a user's recent days are one range scan
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    score_id = db.Column(db.Integer, db.ForeignKey('score.id'), primary_key=True)
+    kind = db.Column(db.String(10), primary_key=True)
+    attempts = db.Column(db.Integer, nullable=False)
+    accuracy_sum = db.Column(db.Float, nullable=False)
+    best_accuracy = db.Column(db.Float, nullable=False)
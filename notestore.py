@@ -0,0 +1,253 @@
+import io
+import re
+
+import numpy as np
+
+from extensions import db
+from models import NoteData, Score
+
+# Duration grid. 960 = 2**6 * 15, so every value down to a double-dotted
+# 64th, triplets and quintuplets are whole numbers of ticks
+TICKS_PER_QUARTER = 960
+
+# A correct note this far from true pitch still counts as in tune, in the
+# recording analysis, the live verdicts and the recording page's legend
+TUNING_TOLERANCE_CENTS = 30
+
+# One record per note or rest. Rests have midi == step == -1. Spelling
+# (step/alter/octave) is kept alongside the MIDI number so names round-trip
+# exactly, e.g. 'B-3' stays 'B-3' rather than becoming 'A#3'. ticks is the
+# exact duration; duration is the same in quarter notes, for NoteData rows
+# and anything working in beats.
+NOTE_DTYPE = np.dtype([
+    ('midi', '<i2'),
+    ('step', 'i1'),
+    ('alter', 'i1'),
+    ('octave', 'i1'),
+    ('duration', '<f8'),
+    ('measure', '<i4'),
+    ('ticks', '<i4'),
+])
+
+# One record per pitched note, in render order: what a recording is
+# compared against. position indexes the score's notes (rests included) so
+# results can colour noteheads; beat is the onset in quarter notes.
+REFERENCE_DTYPE = np.dtype([
+    ('position', '<i4'),
+    ('midi', '<i2'),
+    ('beat', '<f8'),
+    ('duration', '<f8'),
+])
+
+STEPS = 'CDEFGAB'
+_STEP_SEMITONES = np.array([0, 2, 4, 5, 7, 9, 11], dtype=np.int16)
+_PITCH_RE = re.compile(r'^([A-Ga-g])([#\-]*)[~`]*(-?\d+)$')
+_NOTE_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+
+
+# A length only reads as a triplet this close to one; anything else (a
+# quarter tied to a sixteenth, say) gets the nearest plain or dotted value
+TUPLET_TOLERANCE_TICKS = TICKS_PER_QUARTER // 96
+
+
+def _duration_table():
+    """Lookup table for ``vexflow_durations``: sorted tick bounds and a code per interval.
+
+    Plain, dotted ('d') and double-dotted ('dd') values from whole notes to
+    64ths split the line at the midpoints between neighbours; triplets
+    ('tr') from halves to 32nds each claim a narrow window around their
+    exact length. Interval ``k`` lies below ``bounds[k]``.
+    """
+    plain, triplets = {}, {}
+    for code, quarters in (('w', 4), ('h', 2), ('q', 1), ('8', 1 / 2), ('16', 1 / 4), ('32', 1 / 8),
+                           ('64', 1 / 16)):
+        for suffix, scale in (('', 1.0), ('d', 1.5), ('dd', 1.75)):
+            plain[quarters * scale * TICKS_PER_QUARTER] = code + suffix
+        if code not in ('w', '64'):
+            triplets[quarters * 2 / 3 * TICKS_PER_QUARTER] = code + 'tr'
+    lengths = np.array(sorted(plain))
+    midpoints = (lengths[:-1] + lengths[1:]) / 2
+    tuplet_lengths = np.array(sorted(triplets))
+    bounds = np.unique(np.concatenate((midpoints, tuplet_lengths - TUPLET_TOLERANCE_TICKS,
+                                       tuplet_lengths + TUPLET_TOLERANCE_TICKS)))
+    # Name each interval by a point inside it
+    inside = np.concatenate(([bounds[0] - 1], (bounds[:-1] + bounds[1:]) / 2, [bounds[-1] + 1]))
+    codes = []
+    for point in inside:
+        nearest = tuplet_lengths[np.argmin(np.abs(tuplet_lengths - point))]
+        if abs(nearest - point) < TUPLET_TOLERANCE_TICKS:
+            codes.append(triplets[nearest])
+        else:
+            codes.append(plain[lengths[np.argmin(np.abs(lengths - point))]])
+    return bounds, np.array(codes)
+
+
+_DURATION_BOUNDS, _DURATION_CODES = _duration_table()
+
+
+def parse_pitch_name(name):
+    """Split a music21 ``nameWithOctave`` into ``(step, alter, octave)``."""
+    match = _PITCH_RE.match(name.strip())
+    if not match:
+        return None
+    step, accidentals, octave = match.groups()
+    return STEPS.index(step.upper()), accidentals.count('#') - accidentals.count('-'), int(octave)
+
+
+def pitch_name_to_midi(name):
+    """Convert a music21 ``nameWithOctave`` (e.g. ``'B-3'``, ``'F#5'``) to a MIDI number."""
+    parsed = parse_pitch_name(name)
+    if parsed is None:
+        return None
+    step, alter, octave = parsed
+    return (octave + 1) * 12 + int(_STEP_SEMITONES[step]) + alter
+
+
+def midi_to_pitch_name(midi):
+    midi = int(midi)
+    return f"{_NOTE_NAMES[midi % 12]}{midi // 12 - 1}"
+
+
+def duration_ticks(durations):
+    """Quarter lengths (floats or music21 Fractions) as whole TICKS_PER_QUARTER ticks."""
+    return np.rint(np.asarray(durations, dtype=np.float64) * TICKS_PER_QUARTER).astype(np.int32)
+
+
+def vexflow_durations(ticks):
+    """VexFlow duration codes ('q', '8d', 'qtr', ...) for an array of tick lengths.
+
+    One ``searchsorted`` over the whole array: each length gets the nearest
+    plain, dotted or double-dotted value, or a triplet when it is one, so
+    float noise and tuplets land on the right code instead of a default.
+    """
+    return _DURATION_CODES[np.searchsorted(_DURATION_BOUNDS, np.asarray(ticks), side='right')]
+
+
+def note_array(step, alter, octave, durations, measures):
+    """Build a NOTE_DTYPE array from columns; a negative ``step`` marks a rest."""
+    step = np.asarray(step, dtype=np.int16)
+    packed = np.empty(len(step), dtype=NOTE_DTYPE)
+    packed['step'], packed['alter'], packed['octave'] = step, alter, octave
+    packed['ticks'] = duration_ticks(durations)
+    packed['duration'] = packed['ticks'] / TICKS_PER_QUARTER
+    packed['measure'] = measures
+
+    pitched = step >= 0
+    packed['midi'] = -1
+    packed['midi'][pitched] = ((packed['octave'][pitched].astype(np.int16) + 1) * 12
+                               + _STEP_SEMITONES[step[pitched]] + packed['alter'][pitched])
+    return packed
+
+
+def pack_columns(names, durations, measures):
+    """Build a NOTE_DTYPE array from music21 names ('C#4', 'Rest'), quarter lengths and measures."""
+    spellings = {'rest': (-1, 0, 0)}
+    spelled = []
+    for name in names:
+        spelling = spellings.get(name.lower())
+        if spelling is None:
+            spelling = parse_pitch_name(name)
+            if spelling is None:
+                raise ValueError(f"Unrecognised pitch name {name!r}")
+            spellings[name.lower()] = spelling
+        spelled.append(spelling)
+    spelled = np.array(spelled, dtype=np.int16).reshape(-1, 3)
+    return note_array(spelled[:, 0], spelled[:, 1], spelled[:, 2], durations, measures)
+
+
+def pack_notes(notes):
+    """Pack ``{'pitch', 'duration', 'measure'}`` dicts into a NOTE_DTYPE array."""
+    return pack_columns([note['pitch'] for note in notes], [note['duration'] for note in notes],
+                        [1 if note.get('measure') is None else note['measure'] for note in notes])
+
+
+def note_names(packed):
+    """music21-style names ('C#4', 'Rest') for every record, in order."""
+    names = []
+    for step, alter, octave in zip(packed['step'].tolist(), packed['alter'].tolist(), packed['octave'].tolist()):
+        if step < 0:
+            names.append('Rest')
+        else:
+            names.append(STEPS[step] + ('#' * alter if alter > 0 else '-' * -alter) + str(octave))
+    return names
+
+
+def serialize_notes(packed):
+    buffer = io.BytesIO()
+    np.save(buffer, packed, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def deserialize_notes(blob):
+    packed = np.load(io.BytesIO(blob), allow_pickle=False)
+    if packed.dtype != NOTE_DTYPE:
+        # Stored before durations were kept in ticks
+        upgraded = np.empty(len(packed), dtype=NOTE_DTYPE)
+        for name in packed.dtype.names:
+            upgraded[name] = packed[name]
+        upgraded['ticks'] = duration_ticks(packed['duration'])
+        upgraded['duration'] = upgraded['ticks'] / TICKS_PER_QUARTER
+        packed = upgraded
+    return packed
+
+
+def store_score_notes(score, notes, write_rows=True):
+    """Attach notes to a flushed ``score``.
+
+    ``notes`` is a packed array, as ``detect_notes*`` return, or a list of
+    note dicts. The packed array always goes into ``score.note_array``. When
+    ``write_rows`` is set the normalized ``note_data`` rows are written too,
+    as one executemany Core insert rather than an ORM object per note.
+    Returns the packed array.
+    """
+    packed = notes if isinstance(notes, np.ndarray) else pack_notes(notes)
+    score.note_array = serialize_notes(packed)
+    score.note_count = len(packed)
+
+    if write_rows and len(packed):
+        names = note_names(packed) if isinstance(notes, np.ndarray) else [note['pitch'] for note in notes]
+        rows = [
+            {'score_id': score.id, 'measure': measure, 'note_name': name, 'duration': duration}
+            for name, measure, duration in zip(names, packed['measure'].tolist(), packed['duration'].tolist())
+        ]
+        db.session.execute(NoteData.__table__.insert(), rows)
+    return packed
+
+
+def render_order(packed):
+    return packed[np.argsort(packed['measure'], kind='stable')]
+
+
+def reference_features(packed):
+    """REFERENCE_DTYPE records for a packed score already in render order."""
+    durations = packed['duration'].astype(np.float64)
+    # Summed in ticks, so onsets after triplets are exact
+    ticks = packed['ticks'].astype(np.int64)
+    onsets = (np.cumsum(ticks) - ticks) / TICKS_PER_QUARTER
+    pitched = np.flatnonzero(packed['midi'] >= 0)
+    reference = np.empty(len(pitched), dtype=REFERENCE_DTYPE)
+    reference['position'] = pitched
+    reference['midi'] = packed['midi'][pitched]
+    reference['beat'] = onsets[pitched]
+    reference['duration'] = durations[pitched]
+    return reference
+
+
+def load_note_array(score_id):
+    """Notes of a score in render order (measure, then insertion order).
+
+    Reads the packed column; scores stored before it existed are packed from
+    their NoteData rows without building ORM objects.
+    """
+    blob = db.session.execute(db.select(Score.note_array).where(Score.id == score_id)).scalar()
+    if blob is not None:
+        return render_order(deserialize_notes(blob))
+
+    rows = (db.session.query(NoteData.note_name, NoteData.duration, NoteData.measure)
+            .filter_by(score_id=score_id)
+            .order_by(NoteData.measure, NoteData.id)
+            .all())
+    return pack_columns([name for name, _duration, _measure in rows],
+                        [duration for _name, duration, _measure in rows],
+                        [1 if measure is None else measure for _name, _duration, measure in rows])
+
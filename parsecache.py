@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from notestore import NOTE_DTYPE, pack_notes
+
+logger = logging.getLogger(__name__)
+
+# Bump when the detect_notes* output changes so stale parses are ignored
+PARSER_VERSION = 3
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ParseCache:
+    """Parsed uploads stored on disk under the SHA-256 of the file content.
+
+    Each entry is one ``<hash>.npz`` holding the packed notes plus the time
+    signature, key and clef. Entries are touched on every hit and the least
+    recently used ones are deleted once the directory grows past
+    ``PARSE_CACHE_MAX_BYTES``.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_bytes = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PARSE_CACHE_DIR', os.environ.get(
+            'PARSE_CACHE_DIR', os.path.join(app.instance_path, 'parse_cache')))
+        app.config.setdefault('PARSE_CACHE_MAX_BYTES', int(os.environ.get(
+            'PARSE_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+        self.directory = app.config['PARSE_CACHE_DIR']
+        self.max_bytes = app.config['PARSE_CACHE_MAX_BYTES']
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['parse_cache'] = self
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """The cached parse for ``key``, with ``notes`` as a packed array, or None."""
+        if not self.max_bytes:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                meta = json.loads(str(entry['meta']))
+                notes = entry['notes']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable parse cache entry {key}: {str(e)}")
+            self._remove(path)
+            return None
+
+        if meta.get('parser_version') != PARSER_VERSION or notes.dtype != NOTE_DTYPE:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return {
+            'notes': notes,
+            'time_signature': meta['time_signature'],
+            'key_signature': meta['key_signature'],
+            'clef': meta['clef'],
+        }
+
+    def put(self, key, parsed):
+        """Store a ``detect_notes*`` result; returns it with the notes packed."""
+        notes = parsed['notes']
+        if not isinstance(notes, np.ndarray):
+            notes = pack_notes(notes)
+        parsed = dict(parsed, notes=notes)
+        if not self.max_bytes:
+            return parsed
+
+        meta = json.dumps({
+            'parser_version': PARSER_VERSION,
+            'time_signature': parsed.get('time_signature'),
+            'key_signature': parsed.get('key_signature'),
+            'clef': parsed.get('clef'),
+        })
+        # Write to a temp file and rename so concurrent readers in other
+        # workers never see a partial entry
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, notes=notes, meta=np.array(meta))
+            os.replace(tmp_path, self._path(key))
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Could not write parse cache entry {key}: {str(e)}")
+            if tmp_path:
+                self._remove(tmp_path)
+        return parsed
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _mtime, size, path in sorted(entries):
+            self._remove(path)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+parse_cache = ParseCache()
@@ -0,0 +1,216 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import case
+
+from extensions import db
+from models import PerformanceAnalysis, PracticeDayRollup, PracticeScoreRollup, Score
+
+RECORDING = 'recording'
+RHYTHM = 'rhythm'
+
+# Weight of the newest attempt in ema_accuracy
+EMA_ALPHA = 0.3
+# Trailing window of the per-day moving average
+MOVING_AVERAGE_DAYS = 7
+
+
+def normalized_accuracy(accuracy, kind):
+    # Recordings are scored 0-1; rhythm attempts are stored as the 0-100
+    # score of templates.rhythm.score_taps
+    return accuracy / 100.0 if kind == RHYTHM else accuracy
+
+
+def _upsert(model, values, updates):
+    """INSERT ... ON CONFLICT (primary key) DO UPDATE on SQLite and PostgreSQL.
+
+    A single statement, so concurrent attempts from several workers add up
+    instead of overwriting each other.
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(model.__table__).values(**values)
+    key = [column.name for column in model.__table__.primary_key.columns]
+    db.session.execute(stmt.on_conflict_do_update(index_elements=key, set_=updates(model.__table__.c, stmt.excluded)))
+
+
+def record_attempt(analysis):
+    """Fold one flushed PerformanceAnalysis into the rollups, in the caller's transaction."""
+    kind = analysis.kind
+    accuracy = normalized_accuracy(analysis.accuracy, kind)
+    at = analysis.timestamp
+    key = {'user_id': analysis.user_id, 'score_id': analysis.score_id, 'kind': kind}
+
+    def score_updates(c, new):
+        newer = new.last_attempt_at >= c.last_attempt_at
+        return {
+            'attempts': c.attempts + 1,
+            'accuracy_sum': c.accuracy_sum + new.accuracy_sum,
+            'best_accuracy': case((new.best_accuracy > c.best_accuracy, new.best_accuracy), else_=c.best_accuracy),
+            'last_accuracy': case((newer, new.last_accuracy), else_=c.last_accuracy),
+            'last_attempt_at': case((newer, new.last_attempt_at), else_=c.last_attempt_at),
+            'ema_accuracy': c.ema_accuracy + EMA_ALPHA * (new.ema_accuracy - c.ema_accuracy),
+        }
+
+    _upsert(PracticeScoreRollup, dict(key, attempts=1, accuracy_sum=accuracy, best_accuracy=accuracy,
+                                      last_accuracy=accuracy, ema_accuracy=accuracy,
+                                      first_attempt_at=at, last_attempt_at=at), score_updates)
+    if at is None:
+        return
+
+    def day_updates(c, new):
+        return {
+            'attempts': c.attempts + 1,
+            'accuracy_sum': c.accuracy_sum + new.accuracy_sum,
+            'best_accuracy': case((new.best_accuracy > c.best_accuracy, new.best_accuracy), else_=c.best_accuracy),
+        }
+
+    _upsert(PracticeDayRollup, dict(key, day=at.date(), attempts=1, accuracy_sum=accuracy, best_accuracy=accuracy),
+            day_updates)
+
+
+def backfill(batch_size=1000):
+    """Rebuild both rollup tables from performance_analysis; returns the number of attempts read.
+
+    Attempts are streamed per user and score in time order, so the moving
+    average comes out the same as if every insert had been recorded live.
+    """
+    db.session.execute(db.delete(PracticeDayRollup))
+    db.session.execute(db.delete(PracticeScoreRollup))
+
+    rows = db.session.execute(
+        db.select(PerformanceAnalysis.user_id, PerformanceAnalysis.score_id, PerformanceAnalysis.accuracy,
+                  PerformanceAnalysis.kind, PerformanceAnalysis.timestamp)
+        .order_by(PerformanceAnalysis.user_id, PerformanceAnalysis.score_id,
+                  PerformanceAnalysis.timestamp, PerformanceAnalysis.id)
+        .execution_options(yield_per=batch_size))
+
+    scores, days = {}, {}
+    count = 0
+    for user_id, score_id, accuracy, kind, at in rows:
+        count += 1
+        accuracy = normalized_accuracy(accuracy, kind)
+        rollup = scores.get((user_id, score_id, kind))
+        if rollup is None:
+            scores[(user_id, score_id, kind)] = {
+                'user_id': user_id, 'score_id': score_id, 'kind': kind, 'attempts': 1,
+                'accuracy_sum': accuracy, 'best_accuracy': accuracy, 'last_accuracy': accuracy,
+                'ema_accuracy': accuracy, 'first_attempt_at': at, 'last_attempt_at': at,
+            }
+        else:
+            rollup['attempts'] += 1
+            rollup['accuracy_sum'] += accuracy
+            rollup['best_accuracy'] = max(rollup['best_accuracy'], accuracy)
+            rollup['ema_accuracy'] += EMA_ALPHA * (accuracy - rollup['ema_accuracy'])
+            if at is not None:
+                rollup['first_attempt_at'] = rollup['first_attempt_at'] or at
+                rollup['last_accuracy'], rollup['last_attempt_at'] = accuracy, at
+        if at is None:
+            continue
+        day = days.get((user_id, at.date(), score_id, kind))
+        if day is None:
+            days[(user_id, at.date(), score_id, kind)] = {
+                'user_id': user_id, 'day': at.date(), 'score_id': score_id, 'kind': kind,
+                'attempts': 1, 'accuracy_sum': accuracy, 'best_accuracy': accuracy,
+            }
+        else:
+            day['attempts'] += 1
+            day['accuracy_sum'] += accuracy
+            day['best_accuracy'] = max(day['best_accuracy'], accuracy)
+
+    for model, values in ((PracticeScoreRollup, list(scores.values())), (PracticeDayRollup, list(days.values()))):
+        for start in range(0, len(values), batch_size):
+            db.session.execute(db.insert(model), values[start:start + batch_size])
+    db.session.commit()
+    return count
+
+
+def _summary(attempts, accuracy_sum, best, last, last_at, ema):
+    return {
+        'attempts': attempts,
+        'mean_accuracy': accuracy_sum / attempts if attempts else None,
+        'best_accuracy': best,
+        'last_accuracy': last,
+        'last_attempt_at': last_at.isoformat() if last_at else None,
+        'moving_average': ema,
+    }
+
+
+def score_summaries(user_id, score_id=None):
+    """Per-score, per-kind progress of a user, most recently practiced first."""
+    query = (db.session.query(PracticeScoreRollup, Score.title)
+             .join(Score, Score.id == PracticeScoreRollup.score_id)
+             .filter(PracticeScoreRollup.user_id == user_id))
+    if score_id is not None:
+        query = query.filter(PracticeScoreRollup.score_id == score_id)
+    summaries = []
+    for rollup, title in query.all():
+        summary = _summary(rollup.attempts, rollup.accuracy_sum, rollup.best_accuracy, rollup.last_accuracy,
+                           rollup.last_attempt_at, rollup.ema_accuracy)
+        summary.update(score_id=rollup.score_id, title=title, kind=rollup.kind,
+                       first_attempt_at=rollup.first_attempt_at.isoformat() if rollup.first_attempt_at else None)
+        summaries.append(summary)
+    summaries.sort(key=lambda s: s['last_attempt_at'] or '', reverse=True)
+    return summaries
+
+
+def user_totals(summaries):
+    """Per-kind totals over a user's score summaries."""
+    totals = {}
+    for summary in summaries:
+        total = totals.setdefault(summary['kind'], {'attempts': 0, 'accuracy_sum': 0.0, 'best_accuracy': None,
+                                                    'last_accuracy': None, 'last_attempt_at': None,
+                                                    'scores': 0})
+        total['attempts'] += summary['attempts']
+        total['accuracy_sum'] += summary['mean_accuracy'] * summary['attempts']
+        total['scores'] += 1
+        if total['best_accuracy'] is None or summary['best_accuracy'] > total['best_accuracy']:
+            total['best_accuracy'] = summary['best_accuracy']
+        if summary['last_attempt_at'] and (total['last_attempt_at'] is None
+                                           or summary['last_attempt_at'] > total['last_attempt_at']):
+            total['last_accuracy'] = summary['last_accuracy']
+            total['last_attempt_at'] = summary['last_attempt_at']
+    for total in totals.values():
+        total['mean_accuracy'] = total.pop('accuracy_sum') / total['attempts'] if total['attempts'] else None
+    return totals
+
+
+def daily(user_id, days=30, score_id=None, today=None):
+    """Per-day, per-kind progress over the last ``days`` days, oldest first.
+
+    ``moving_average`` is the attempt-weighted mean accuracy over the
+    trailing ``MOVING_AVERAGE_DAYS`` days, counting days before the window.
+    Days are UTC, like the analysis timestamps the rollups are keyed by.
+    """
+    today = today or datetime.utcnow().date()
+    start = today - timedelta(days=days - 1)
+    query = (db.session.query(PracticeDayRollup.day, PracticeDayRollup.kind,
+                              db.func.sum(PracticeDayRollup.attempts), db.func.sum(PracticeDayRollup.accuracy_sum),
+                              db.func.max(PracticeDayRollup.best_accuracy))
+             .filter(PracticeDayRollup.user_id == user_id,
+                     PracticeDayRollup.day >= start - timedelta(days=MOVING_AVERAGE_DAYS - 1),
+                     PracticeDayRollup.day <= today))
+    if score_id is not None:
+        query = query.filter(PracticeDayRollup.score_id == score_id)
+    rows = query.group_by(PracticeDayRollup.day, PracticeDayRollup.kind).order_by(PracticeDayRollup.day).all()
+
+    series = []
+    window = {}
+    for day, kind, attempts, accuracy_sum, best in rows:
+        recent = [entry for entry in window.get(kind, [])
+                  if entry[0] > day - timedelta(days=MOVING_AVERAGE_DAYS)]
+        recent.append((day, attempts, accuracy_sum))
+        window[kind] = recent
+        if day < start:
+            continue
+        window_attempts = sum(entry[1] for entry in recent)
+        series.append({
+            'day': day.isoformat(),
+            'kind': kind,
+            'attempts': attempts,
+            'mean_accuracy': accuracy_sum / attempts,
+            'best_accuracy': best,
+            'moving_average': sum(entry[2] for entry in recent) / window_attempts,
+        })
+    return series
@@ -0,0 +1,106 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+from extensions import db
+from models import Score
+from notestore import REFERENCE_DTYPE, load_note_array, reference_features, render_order
+
+logger = logging.getLogger(__name__)
+
+# Bump when REFERENCE_DTYPE or reference_features changes; older files are
+# then simply not found and get rebuilt
+REFERENCE_VERSION = 2
+
+
+def load_reference(reference):
+    """Memory-map a reference path from ``ReferenceStore.locate``; arrays pass through.
+
+    The pages of a mapped file are shared by every process that analyzes
+    the same score, and nothing is copied until the analysis reads it.
+    """
+    if isinstance(reference, str):
+        return np.load(reference, mmap_mode='r', allow_pickle=False)
+    return reference
+
+
+class ReferenceStore:
+    """What recordings of a score are compared against, built once per score.
+
+    Each score's REFERENCE_DTYPE records (pitch, score position, onset beat
+    and duration of every note) are written at upload time to
+    ``<score id>-<content hash>.v<REFERENCE_VERSION>.npy`` in
+    ``REFERENCE_DIR``. Jobs pass the path to the analysis workers, which
+    memory-map it instead of unpickling a note list per recording. Each score
+    has its own file: identical uploads parsed by different PARSER_VERSIONs
+    have different notes, and the content hash guards against a score id
+    reused after a rolled-back import batch. Onsets are kept in beats; the
+    analysis judges timing against the student's own tempo, so no per-tempo
+    copies are stored.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('REFERENCE_DIR', os.environ.get(
+            'REFERENCE_DIR', os.path.join(app.instance_path, 'references')))
+        self.directory = app.config['REFERENCE_DIR']
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['reference_store'] = self
+
+    def _path(self, score_id, content_hash):
+        return os.path.join(self.directory, f"{score_id}-{content_hash}.v{REFERENCE_VERSION}.npy")
+
+    def put(self, score_id, content_hash, packed):
+        """Write the reference for a score's packed notes; returns its path, or None if it couldn't be written."""
+        reference = reference_features(render_order(packed))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, reference, allow_pickle=False)
+            # Workers that mapped the old file keep reading it until they close it
+            os.replace(tmp_path, self._path(score_id, content_hash))
+        except OSError as e:
+            logger.warning(f"Could not write reference features for score {score_id}: {str(e)}")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            return None
+        return self._path(score_id, content_hash)
+
+    def locate(self, score_id):
+        """A path for ``load_reference``, or the records themselves.
+
+        Scores stored before references existed get their file built on
+        first use; scores without a content hash are built every time.
+        """
+        content_hash = db.session.execute(db.select(Score.content_hash).where(Score.id == score_id)).scalar()
+        if content_hash:
+            path = self._path(score_id, content_hash)
+            try:
+                if load_reference(path).dtype == REFERENCE_DTYPE:
+                    return path
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Rebuilding unreadable reference features for score {score_id}: {str(e)}")
+        packed = load_note_array(score_id)
+        if content_hash:
+            path = self.put(score_id, content_hash, packed)
+            if path:
+                return path
+        return reference_features(packed)
+
+    def load(self, score_id):
+        return load_reference(self.locate(score_id))
+
+
+reference_store = ReferenceStore()
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bump when templates/audioanalysis changes what a recording scores, so
+# results cached under the old analysis are recomputed
+ANALYSIS_VERSION = 3
+
+
+def reference_key(reference):
+    """What a ``ReferenceStore.locate`` result was built from.
+
+    Reference files are named after the score id, its content hash and the
+    reference version; records built on the fly are hashed as they are.
+    """
+    if isinstance(reference, str):
+        return os.path.basename(reference)
+    return hashlib.sha256(np.ascontiguousarray(reference).tobytes()).hexdigest()
+
+
+class ResultCache:
+    """Analysis results stored under the recording, the score and the analysis version.
+
+    A resubmitted take (a retry after a dropped connection) has the same
+    upload bytes, so the key is the SHA-256 of those bytes together with
+    ``reference_key`` and ANALYSIS_VERSION. The last
+    ``RESULT_CACHE_MEMORY_ENTRIES`` results are kept in the process; behind
+    them each result is a ``<key>.json`` file in ``RESULT_CACHE_DIR``,
+    shared by every worker. Files are touched on every hit and the least
+    recently used ones are deleted once the directory grows past
+    ``RESULT_CACHE_MAX_BYTES``.
+    """
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.max_bytes = 0
+        self.memory_entries = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESULT_CACHE_DIR', os.environ.get(
+            'RESULT_CACHE_DIR', os.path.join(app.instance_path, 'result_cache')))
+        app.config.setdefault('RESULT_CACHE_MAX_BYTES', int(os.environ.get(
+            'RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+        app.config.setdefault('RESULT_CACHE_MEMORY_ENTRIES', int(os.environ.get(
+            'RESULT_CACHE_MEMORY_ENTRIES', 128)))
+        self.directory = app.config['RESULT_CACHE_DIR']
+        self.max_bytes = app.config['RESULT_CACHE_MAX_BYTES']
+        self.memory_entries = app.config['RESULT_CACHE_MEMORY_ENTRIES']
+        os.makedirs(self.directory, exist_ok=True)
+        app.extensions['result_cache'] = self
+
+    def key(self, audio_bytes, reference):
+        digest = hashlib.sha256(audio_bytes).hexdigest()
+        return hashlib.sha256(f"{digest}:{reference_key(reference)}:{ANALYSIS_VERSION}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """``(result, tier)`` for a cached analysis, tier being 'memory' or 'disk', or ``(None, None)``."""
+        with self._lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                return result, 'memory'
+        if not self.max_bytes:
+            return None, None
+
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            return None, None
+        except Exception as e:
+            logger.warning(f"Discarding unreadable result cache entry {key}: {str(e)}")
+            self._remove(path)
+            return None, None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._remember(key, result)
+        return result, 'disk'
+
+    def put(self, key, result):
+        """Store an ``analyze_*`` result tuple."""
+        result = list(result)
+        self._remember(key, result)
+        if not self.max_bytes:
+            return
+
+        # Written to a temp file and renamed so other workers never read a
+        # partial entry
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._path(key))
+            self.evict()
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not write result cache entry {key}: {str(e)}")
+            if tmp_path:
+                self._remove(tmp_path)
+
+    def _remember(self, key, result):
+        if not self.memory_entries:
+            return
+        with self._lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        for _mtime, size, path in sorted(entries):
+            self._remove(path)
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+result_cache = ResultCache()
@@ -0,0 +1,242 @@
+import warnings
+
+import numpy as np
+
+# Band radius in notes around the path found at half resolution. It is
+# doubled, up to BAND_MAX_RADIUS, while the path runs along the band's edge;
+# capped, so the work per note doesn't grow with the length of the piece
+BAND_RADIUS = 16
+BAND_MAX_RADIUS = 64
+# Sequences with up to this many cells between them (about 1 MB of step
+# codes) are aligned whole, without a band
+FULL_DTW_CELLS = 1 << 20
+
+# With fewer played notes than this fraction of the score, the take is
+# aligned as a passage (subsequence) rather than the whole piece
+PASSAGE_RATIO = 0.6
+
+# Substitution costs; an octave error is half wrong
+OCTAVE_COST = 0.5
+MISMATCH_COST = 1.0
+
+# Intervals between heard notes the local tempo is taken over
+TEMPO_WINDOW_NOTES = 4
+
+# Step codes kept for the backtrack
+DIAGONAL, VERTICAL, HORIZONTAL = 0, 1, 2
+
+
+def note_costs(midi, others):
+    """Cost of matching ``midi`` against each note of ``others``."""
+    others = np.asarray(others)
+    return np.where(others == midi, 0.0, np.where((others - midi) % 12 == 0, OCTAVE_COST, MISMATCH_COST))
+
+
+def _row(costs, diagonal, vertical):
+    """One DTW row: ``D[j] = c[j] + min(D'[j-1], D'[j], D[j-1])``.
+
+    ``diagonal`` and ``vertical`` are the previous row's values shifted into
+    this row's columns. The horizontal term is a running minimum over prefix
+    sums, ``D[j] = S[j] + min_{k<=j}(A[k] - S[k])``, so a row is a handful
+    of vectorized passes. Returns the row, its step codes and, for each
+    column, the column ``k`` its horizontal run started from.
+    """
+    from_diagonal = diagonal <= vertical
+    entered = costs + np.where(from_diagonal, diagonal, vertical)
+    prefix = np.cumsum(costs)
+    offset = entered - prefix
+    best = np.minimum.accumulate(offset)
+    row = prefix + best
+    columns = np.arange(len(costs))
+    # Ties prefer entering the row here over extending a horizontal run
+    entry = np.maximum.accumulate(np.where(offset <= best, columns, 0))
+    steps = np.where(entry < columns, HORIZONTAL, np.where(from_diagonal, DIAGONAL, VERTICAL)).astype(np.int8)
+    return row, steps, entry
+
+
+def _band_around(path, m, n, radius):
+    """Per-row ``[low, high)`` column windows covering a half-resolution ``path``, widened by ``radius``.
+
+    Coarse cell ``(i, j)`` stands for rows ``2i, 2i + 1`` and columns
+    ``2j, 2j + 1``; every row's window is then widened by ``radius``
+    columns and merged with those of the ``radius`` rows either side.
+    """
+    coarse = np.asarray(path)
+    rows = np.concatenate((2 * coarse[:, 0], 2 * coarse[:, 0] + 1))
+    columns = np.tile(2 * coarse[:, 1], 2)
+    inside = rows < m
+    lows = np.full(m, n)
+    highs = np.zeros(m, dtype=int)
+    np.minimum.at(lows, rows[inside], columns[inside])
+    np.maximum.at(highs, rows[inside], columns[inside] + 2)
+    window = 2 * radius + 1
+    lows = np.lib.stride_tricks.sliding_window_view(np.pad(lows, radius, constant_values=n), window).min(axis=1)
+    highs = np.lib.stride_tricks.sliding_window_view(np.pad(highs, radius), window).max(axis=1)
+    lows = np.clip(lows - radius, 0, n - 1)
+    highs = np.clip(highs + radius, 1, n)
+    lows[0], highs[-1] = 0, n
+    return lows, highs
+
+
+def banded_dtw(expected, played, radius=BAND_RADIUS):
+    """Align two MIDI sequences end to end; returns the path as ``(i, j)`` pairs.
+
+    Rows are ``expected`` notes and columns ``played`` notes. Up to
+    FULL_DTW_CELLS the whole matrix is evaluated. Past that the path is
+    first found for every other note of both sequences (recursively, down
+    to sequences short enough to align whole), and only a band of
+    ``radius`` notes around it is evaluated at full resolution; where the
+    path runs along the band's edge the band is widened, up to
+    BAND_MAX_RADIUS. Only the band's step codes are kept, so time and memory
+    grow with ``(len(expected) + len(played)) * radius`` instead of the
+    product of the lengths once that product is past FULL_DTW_CELLS.
+    """
+    m, n = len(expected), len(played)
+    if not m or not n:
+        return []
+    expected = np.asarray(expected)
+    played = np.asarray(played)
+    if m * n <= FULL_DTW_CELLS or min(m, n) <= 2 * (radius + 1):
+        return _band_path(expected, played, np.zeros(m, dtype=int), np.full(m, n))
+    coarse = banded_dtw(expected[::2], played[::2], radius)
+    while True:
+        lows, highs = _band_around(coarse, m, n, radius)
+        path = _band_path(expected, played, lows, highs)
+        if radius >= BAND_MAX_RADIUS:
+            return path
+        rows, columns = np.asarray(path).T
+        if not np.any(((columns == lows[rows]) & (lows[rows] > 0))
+                      | ((columns == highs[rows] - 1) & (highs[rows] < n))):
+            return path
+        radius *= 2
+
+
+def _band_path(expected, played, lows, highs):
+    """The cheapest path through the cells ``lows[i] <= j < highs[i]`` of each row ``i``."""
+    m, n = len(expected), len(played)
+    steps = []
+    previous, previous_low = None, 0
+    for i in range(m):
+        low, high = lows[i], highs[i]
+        costs = note_costs(expected[i], played[low:high])
+        if previous is None:
+            row = np.cumsum(costs)
+            codes = np.full(len(costs), HORIZONTAL, dtype=np.int8)
+            codes[0] = DIAGONAL
+        else:
+            padded = np.full(high - low + 1, np.inf)
+            # padded[k] is the previous row's value at column low + k - 1
+            start, stop = max(previous_low, low - 1), min(previous_low + len(previous), high)
+            padded[start - low + 1:stop - low + 1] = previous[start - previous_low:stop - previous_low]
+            row, codes, _entry = _row(costs, padded[:-1], padded[1:])
+        steps.append(codes)
+        previous, previous_low = row, low
+
+    path = []
+    i, j = m - 1, n - 1
+    while i > 0 or j > 0:
+        path.append((i, j))
+        code = steps[i][j - lows[i]]
+        if code == HORIZONTAL:
+            j -= 1
+        elif code == VERTICAL:
+            i -= 1
+        else:
+            i, j = i - 1, j - 1
+    path.append((0, 0))
+    return path[::-1]
+
+
+def passage_span(expected, played):
+    """The ``(start, end)`` expected notes that ``played`` matches best (subsequence DTW).
+
+    The alignment may start and end anywhere in ``expected``. Only two rows
+    and the start column of each cell are kept, so memory is linear in
+    ``len(expected)``.
+    """
+    expected = np.asarray(expected)
+    row = note_costs(played[0], expected)
+    starts = np.arange(len(expected))
+    for midi in played[1:]:
+        costs = note_costs(midi, expected)
+        diagonal = np.concatenate(([np.inf], row[:-1]))
+        diagonal_starts = np.concatenate(([0], starts[:-1]))
+        from_diagonal = diagonal <= row
+        entered_starts = np.where(from_diagonal, diagonal_starts, starts)
+        row, _codes, entry = _row(costs, diagonal, row)
+        starts = entered_starts[entry]
+    # On a tie take the later end, so a repeated last note is still counted
+    end = len(row) - 1 - int(np.argmin(row[::-1]))
+    return int(starts[end]), end
+
+
+def align_notes(expected, played, passage=None):
+    """Match played notes to expected notes.
+
+    Returns ``(owner, span)``: ``owner[j]`` is the expected index played
+    note ``j`` is assigned to (or -1 for an extra note), and ``span`` the
+    ``(start, end)`` range of expected notes that was aligned. ``passage``
+    forces or disables subsequence alignment; by default it is used when
+    far fewer notes were played than the score has.
+    """
+    m, n = len(expected), len(played)
+    owner = np.full(n, -1, dtype=np.int64)
+    if not m or not n:
+        return owner, (0, m - 1)
+    if passage is None:
+        passage = n < PASSAGE_RATIO * m
+    start, end = passage_span(expected, played) if passage else (0, m - 1)
+
+    # Along a path a played note can be paired with several expected notes
+    # (the student skipped some) and an expected note with several played
+    # ones (a repeat); each played note goes to its cheapest pairing, and
+    # each expected note keeps only its cheapest played note
+    expected = np.asarray(expected)
+    played = np.asarray(played)
+    path = banded_dtw(expected[start:end + 1], played)
+    best = {}
+    for i, j in path:
+        cost = note_costs(played[j], expected[start + i:start + i + 1])[0]
+        if j not in best or cost < best[j][0]:
+            best[j] = (cost, start + i)
+    claimed = {}
+    for j, (cost, i) in sorted(best.items()):
+        if i not in claimed or cost < claimed[i][0]:
+            claimed[i] = (cost, j)
+    for i, (_cost, j) in claimed.items():
+        owner[j] = i
+    return owner, (start, end)
+
+
+def timing_deviations(beats, seconds, window=TEMPO_WINDOW_NOTES):
+    """Each onset's deviation in seconds from where the local tempo puts it.
+
+    ``beats`` are the score positions and ``seconds`` the played onsets of
+    matched notes, in order. A note is expected one score interval after
+    the previous note, at the median seconds-per-beat of the ``window``
+    intervals before it (after it, at the start of the take), so one held
+    or rushed note shows up at that note only. NaN for the first note and
+    wherever no tempo is known.
+    """
+    beats = np.asarray(beats, dtype=float)
+    seconds = np.asarray(seconds, dtype=float)
+    deviations = np.full(len(beats), np.nan)
+    if len(beats) < 3:
+        return deviations
+    step_beats = np.diff(beats)
+    step_seconds = np.diff(seconds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = np.where(step_beats > 0, step_seconds / step_beats, np.nan)
+    # rates[k - 1] is the interval ending at note k; padded so row k of the
+    # windows holds the intervals before note k, and row k + window + 1 the
+    # ones after it
+    padded = np.concatenate((np.full(window, np.nan), rates, np.full(window, np.nan)))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        medians = np.nanmedian(windows, axis=1)
+    before = medians[:len(rates)]
+    after = medians[window + 1:window + 1 + len(rates)]
+    tempo = np.where(np.isnan(before), after, before)
+    deviations[1:] = step_seconds - tempo * step_beats
+    return deviations
@@ -0,0 +1,386 @@
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.signal import find_peaks
+
+from metrics import stage
+from notestore import TUNING_TOLERANCE_CENTS, midi_to_pitch_name
+from templates.alignment import align_notes, timing_deviations
+from templates.audiodecode import resample_buffer
+
+# Analysis parameters. Everything is computed on a mono float32 buffer at
+# ANALYSIS_SR, framed with FRAME_LENGTH / HOP_LENGTH (10 ms hop).
+ANALYSIS_SR = 16000
+FRAME_LENGTH = 512
+HOP_LENGTH = 160
+FRAME_BATCH = 4096  # frames per vectorized batch, bounds peak memory
+
+FMIN = 150.0   # a little below the violin's open G (196 Hz)
+FMAX = 2200.0
+YIN_THRESHOLD = 0.15
+SILENCE_DB = -45.0  # frames this far below the take's loud frames are unvoiced
+
+MIN_NOTE_SECONDS = 0.06
+ONSET_MIN_GAP_SECONDS = 0.05
+ONSET_COMPRESSION = 1.0  # log1p(gamma * |X|); larger values let broadband noise dominate the flux
+ONSET_WINDOW_SECONDS = 0.25  # adaptive threshold: flux above its local median
+# An onset only starts a note if the level rises this much across it; vibrato
+# makes flux peaks inside a held note but barely moves the level
+ONSET_RISE_DB = 3.0
+ONSET_RISE_SECONDS = 0.05
+TIMING_TOLERANCE_SECONDS = 0.15  # onset deviation from the local tempo worth mentioning
+
+
+def _frames(y, frame_length, hop_length):
+    if len(y) < frame_length:
+        y = np.pad(y, (0, frame_length - len(y)))
+    return np.lib.stride_tricks.sliding_window_view(y, frame_length)[::hop_length]
+
+
+def _yin(frames, sr, fmin, fmax, threshold):
+    """Batched YIN over the rows of ``frames``.
+
+    Returns ``(f0, periodic, spectrum)``; the zero-padded spectrum is handed
+    back so the caller can reuse it.
+    """
+    n_frames, frame_length = frames.shape
+    max_lag = min(int(np.ceil(sr / fmin)), frame_length // 2)
+    min_lag = max(int(np.floor(sr / fmax)), 2)
+    window = frame_length - max_lag
+    n_fft = 1 << int(np.ceil(np.log2(frame_length)))
+
+    # Difference function d(tau) = E[0:W] + E[tau:tau+W] - 2 r(tau), with the
+    # cross-correlation r computed for all frames by one FFT product. The
+    # head is W samples and tau <= max_lag = N - W, so a frame-length FFT
+    # never wraps.
+    spectrum = np.fft.rfft(frames, n_fft, axis=1)
+    head = np.fft.rfft(frames[:, :window], n_fft, axis=1)
+    r = np.fft.irfft(spectrum * np.conj(head), n_fft, axis=1)[:, :max_lag + 1]
+    del head
+
+    energy = np.zeros((n_frames, frame_length + 1), dtype=np.float64)
+    np.cumsum(np.square(frames, dtype=np.float64), axis=1, out=energy[:, 1:])
+    e_shift = energy[:, window:window + max_lag + 1] - energy[:, :max_lag + 1]
+    diff = energy[:, window, None] + e_shift - 2.0 * r
+    diff[:, 0] = 0.0
+    np.maximum(diff, 0.0, out=diff)
+
+    # Cumulative mean normalized difference
+    lags = np.arange(1, max_lag + 1)
+    running = np.cumsum(diff[:, 1:], axis=1)
+    cmnd = np.ones_like(diff)
+    cmnd[:, 1:] = diff[:, 1:] * lags / np.maximum(running, 1e-12)
+
+    # First local minimum under the threshold, else the global minimum (unvoiced)
+    search = cmnd[:, min_lag:max_lag]
+    dips = (search[:, :-1] < threshold) & (search[:, :-1] <= search[:, 1:])
+    has_dip = dips.any(axis=1)
+    best = np.where(has_dip, dips.argmax(axis=1), search.argmin(axis=1)) + min_lag
+
+    # Parabolic interpolation around the chosen lag
+    rows = np.arange(n_frames)
+    inner = np.clip(best, 1, max_lag - 1)
+    left, mid, right = cmnd[rows, inner - 1], cmnd[rows, inner], cmnd[rows, inner + 1]
+    denom = left - 2.0 * mid + right
+    shift = np.where(np.abs(denom) > 1e-12, 0.5 * (left - right) / np.where(denom == 0, 1, denom), 0.0)
+    period = inner + np.clip(shift, -1.0, 1.0)
+
+    f0 = sr / period
+    periodic = has_dip & (f0 >= fmin) & (f0 <= fmax)
+    return f0, periodic, spectrum
+
+
+def _hann_spectrum(spectrum, frame_length, n_fft):
+    """Hann-windowed magnitude spectrum derived from an unwindowed one.
+
+    Windowing by a periodic Hann is a three-tap convolution in frequency, so
+    the onset detector can reuse the FFT already taken for pitch tracking
+    instead of transforming every frame a second time.
+    """
+    step = n_fft // frame_length
+    padded = np.pad(spectrum, ((0, 0), (step, step)), mode='reflect')
+    padded[:, :step] = np.conj(padded[:, :step])
+    padded[:, -step:] = np.conj(padded[:, -step:])
+    windowed = 0.5 * spectrum - 0.25 * (padded[:, :-2 * step] + padded[:, 2 * step:])
+    return np.abs(windowed)
+
+
+def frame_features(frames, sr=ANALYSIS_SR, frame_length=FRAME_LENGTH, previous=None):
+    """YIN f0, periodicity, level in dB and spectral flux for one batch of frames.
+
+    ``previous`` is the last log-magnitude row of the batch before, so flux
+    carries across batches; the batch's own last row is returned for the
+    next call as ``(f0, periodic, level_db, flux, last_row)``.
+    """
+    batch = np.asarray(frames, dtype=np.float32)
+    f0, periodic, spectrum = _yin(batch, sr, FMIN, FMAX, YIN_THRESHOLD)
+    rms = np.sqrt(np.mean(np.square(batch, dtype=np.float64), axis=1))
+
+    # Spectral flux on a log-compressed magnitude spectrum
+    n_fft = 2 * (spectrum.shape[1] - 1)
+    log_mag = np.log1p(ONSET_COMPRESSION * _hann_spectrum(spectrum, frame_length, n_fft))
+    if previous is None:
+        previous = log_mag[:1]
+    stacked = np.vstack([previous, log_mag])
+    flux = np.maximum(np.diff(stacked, axis=0), 0.0).sum(axis=1)
+    level_db = 20.0 * np.log10(np.maximum(rms, 1e-10))
+    return f0, periodic, level_db, flux, log_mag[-1:]
+
+
+def voicing(periodic, level_db, loud=None):
+    """Frames that are periodic and within SILENCE_DB of the take's loud frames."""
+    if loud is None:
+        loud = np.percentile(level_db, 95) if len(level_db) else 0.0
+    return periodic & (level_db > loud + SILENCE_DB) & (level_db > -70.0)
+
+
+def stream_frames(chunks, frame_length=FRAME_LENGTH, hop_length=HOP_LENGTH):
+    """Frame matrices of FRAME_BATCH rows over a take arriving as chunks of samples.
+
+    The rows are those ``_frames`` gives for the whole take, the last batch
+    holding whatever is left over; between chunks only the samples of
+    frames not yet handed out are kept.
+    """
+    span = (FRAME_BATCH - 1) * hop_length + frame_length
+    pending = np.empty(0, dtype=np.float32)
+    batched = False
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float32)
+        pending = np.concatenate((pending, chunk)) if len(pending) else chunk
+        while len(pending) >= span:
+            yield _frames(pending[:span], frame_length, hop_length)
+            pending = pending[FRAME_BATCH * hop_length:]
+            batched = True
+    if not batched or len(pending) >= frame_length:
+        yield _frames(pending, frame_length, hop_length)
+
+
+def track_pitch(y, sr=ANALYSIS_SR, hop_length=HOP_LENGTH, frame_length=FRAME_LENGTH):
+    """Frame-level f0, voicing, level in dB and onset strength for a whole buffer."""
+    return track_pitch_stream([y], sr, hop_length, frame_length)
+
+
+def track_pitch_stream(chunks, sr=ANALYSIS_SR, hop_length=HOP_LENGTH, frame_length=FRAME_LENGTH):
+    """``track_pitch`` for a take arriving as chunks of samples.
+
+    Frames are processed in batches of FRAME_BATCH rows; within a batch every
+    step is a single NumPy operation over the frame matrix. Only the frame
+    level results are kept for the whole take.
+    """
+    columns = []
+    previous = None
+    for frames in stream_frames(chunks, frame_length, hop_length):
+        *features, previous = frame_features(frames, sr, frame_length, previous)
+        columns.append(features)
+    f0, periodic, level_db, flux = (np.concatenate(column) for column in zip(*columns))
+    return f0, voicing(periodic, level_db), level_db, flux
+
+
+def detect_onsets(flux, sr=ANALYSIS_SR, hop_length=HOP_LENGTH):
+    if not len(flux) or not flux.any():
+        return np.empty(0, dtype=int)
+    frames_per_second = sr / hop_length
+    local = median_filter(flux, size=max(3, int(ONSET_WINDOW_SECONDS * frames_per_second)), mode='nearest')
+    novelty = np.maximum(flux - local, 0.0)
+    if not novelty.any():
+        return np.empty(0, dtype=int)
+    novelty /= novelty.max()
+    distance = max(1, int(ONSET_MIN_GAP_SECONDS * frames_per_second))
+    peaks, _ = find_peaks(novelty, height=np.median(novelty) + 0.1, distance=distance)
+    return peaks
+
+
+def attacks(onsets, level_db, sr=ANALYSIS_SR, hop_length=HOP_LENGTH):
+    """The onsets where the level rises by ONSET_RISE_DB, i.e. a note is actually attacked.
+
+    The rise is from the quietest frame in the ONSET_RISE_SECONDS before an
+    onset to the loudest in the ONSET_RISE_SECONDS after it.
+    """
+    if not len(onsets):
+        return onsets
+    span = max(1, int(ONSET_RISE_SECONDS * sr / hop_length))
+    last = len(level_db) - 1
+    before = level_db[np.clip(onsets[:, None] - np.arange(span + 1), 0, last)].min(axis=1)
+    after = level_db[np.clip(onsets[:, None] + np.arange(span + 1), 0, last)].max(axis=1)
+    return onsets[after - before >= ONSET_RISE_DB]
+
+
+def segment_notes(f0, voiced, onsets, sr=ANALYSIS_SR, hop_length=HOP_LENGTH):
+    """Split frame-level pitch into notes.
+
+    Returns a dict of arrays: ``midi`` (nearest semitone), ``cents`` (mean
+    deviation from it), ``start``/``end`` (seconds).
+    """
+    midi = np.full(len(f0), np.nan)
+    midi[voiced] = 69.0 + 12.0 * np.log2(f0[voiced] / 440.0)
+    labels = np.where(voiced, np.rint(np.nan_to_num(midi, nan=-1.0)), -1).astype(int)
+    labels = median_filter(labels, size=5, mode='nearest')
+
+    # A note boundary is a change in the rounded pitch or an onset
+    changes = np.flatnonzero(np.diff(labels)) + 1
+    bounds = np.unique(np.concatenate(([0], changes, onsets)).astype(int))
+    bounds = bounds[bounds < len(labels)]
+    ends = np.append(bounds[1:], len(labels))
+    seg_labels = labels[bounds]
+
+    min_frames = max(1, int(MIN_NOTE_SECONDS * sr / hop_length))
+    keep = (seg_labels >= 0) & (ends - bounds >= min_frames)
+
+    # Mean pitch per segment over frames that agree with the segment label
+    agrees = voiced & (labels >= 0) & (np.abs(np.nan_to_num(midi) - labels) < 0.5)
+    weights = np.add.reduceat(agrees.astype(float), bounds) if len(bounds) else np.empty(0)
+    sums = np.add.reduceat(np.where(agrees, midi, 0.0), bounds) if len(bounds) else np.empty(0)
+    mean_midi = np.where(weights > 0, sums / np.maximum(weights, 1), seg_labels)
+
+    seconds = hop_length / sr
+    return {
+        'midi': seg_labels[keep],
+        'cents': 100.0 * (mean_midi[keep] - seg_labels[keep]),
+        'start': bounds[keep] * seconds,
+        'end': ends[keep] * seconds,
+    }
+
+
+def merge_repeats(segments, onsets, sr=ANALYSIS_SR, hop_length=HOP_LENGTH):
+    """Join same-pitch segments split by a short dropout rather than a new attack."""
+    midi = segments['midi']
+    if len(midi) < 2:
+        return segments
+    seconds = hop_length / sr
+    gap = segments['start'][1:] - segments['end'][:-1]
+    reattacked = np.isin(np.rint(segments['start'][1:] / seconds).astype(int), onsets)
+    joined = (midi[1:] == midi[:-1]) & (gap < MIN_NOTE_SECONDS) & ~reattacked
+    if not joined.any():
+        return segments
+
+    heads = np.concatenate(([True], ~joined))
+    group = np.cumsum(heads) - 1
+    last = np.append(np.flatnonzero(heads)[1:] - 1, len(midi) - 1)
+    durations = segments['end'] - segments['start']
+    weight = np.bincount(group, weights=durations)
+    cents = np.bincount(group, weights=segments['cents'] * durations) / np.maximum(weight, 1e-9)
+    return {
+        'midi': midi[heads],
+        'cents': cents,
+        'start': segments['start'][heads],
+        'end': segments['end'][last],
+    }
+
+
+def compare_to_score(segments, reference):
+    """Align played notes against the score.
+
+    ``reference`` holds the score's pitched notes as
+    ``notestore.REFERENCE_DTYPE`` records (see ``references.py``); the
+    returned note lists hold their ``position`` values, indices into the
+    score's notes in render order, so the page can colour noteheads.
+    The alignment is a banded DTW (``templates.alignment``), so repeated and
+    skipped notes don't throw off the rest of the take; a take of only part
+    of the piece is aligned as a passage and scored on that passage alone.
+
+    Returns ``(accuracy, correct, incorrect, details, notes)``, where
+    ``notes`` has one entry per aligned score note with its status, the
+    pitch heard, the cents deviation and the onset's timing deviation in
+    seconds from the tempo the student was keeping around that note.
+    """
+    positions = reference['position'].tolist()
+    expected_midi = reference['midi'].astype(np.int64)
+    beats = reference['beat']
+
+    played = segments['midi']
+    cents = segments['cents']
+    starts = segments['start']
+    owner, (first, last) = align_notes(expected_midi, played)
+    heard = np.full(len(expected_midi), -1, dtype=np.int64)
+    heard[owner[owner >= 0]] = np.flatnonzero(owner >= 0)
+
+    # Timing is judged on notes that were heard, against the local tempo
+    timed = np.flatnonzero(heard[first:last + 1] >= 0) + first
+    timing = np.full(len(expected_midi), np.nan)
+    timing[timed] = timing_deviations(beats[timed], starts[heard[timed]])
+
+    correct, incorrect, details, notes = [], [], [], []
+    late = []
+    for i in range(first, last + 1):
+        j = heard[i]
+        expected_name = midi_to_pitch_name(expected_midi[i])
+        note = {'index': positions[i], 'expected': expected_name, 'heard': None, 'cents': None,
+                'onset': None, 'timing': None}
+        if j < 0:
+            note['status'] = 'missed'
+            details.append(f"missed {expected_name}")
+        else:
+            note.update(heard=midi_to_pitch_name(played[j]), onset=round(float(starts[j]), 3))
+            if not np.isnan(timing[i]):
+                note['timing'] = round(float(timing[i]), 3)
+            if played[j] != expected_midi[i]:
+                note['status'] = 'wrong_pitch'
+                details.append(f"expected {expected_name}, heard {note['heard']}")
+            else:
+                note['cents'] = int(round(cents[j]))
+                if abs(cents[j]) <= TUNING_TOLERANCE_CENTS:
+                    note['status'] = 'correct'
+                else:
+                    note['status'] = 'out_of_tune'
+                    details.append(f"{expected_name} was {note['cents']:+d} cents out of tune")
+                if note['timing'] is not None and abs(note['timing']) > TIMING_TOLERANCE_SECONDS:
+                    late.append(f"{expected_name} was {abs(note['timing']) * 1000:.0f} ms "
+                                f"{'late' if note['timing'] > 0 else 'early'}")
+        (correct if note['status'] == 'correct' else incorrect).append(positions[i])
+        notes.append(note)
+
+    extra = int((owner < 0).sum())
+    if extra:
+        details.append(f"{extra} extra note{'s' if extra != 1 else ''}")
+    details.extend(late)
+    total = len(notes)
+    accuracy = len(correct) / total if total else 0.0
+    return accuracy, correct, incorrect, details, notes
+
+
+def build_feedback(accuracy, correct, incorrect, details, played_count):
+    total = len(correct) + len(incorrect)
+    if not played_count:
+        return "No notes were detected in the recording. Check your microphone and try again."
+    feedback = f"You played {len(correct)} of {total} notes correctly."
+    if accuracy >= 0.9:
+        feedback += " Excellent work!"
+    elif accuracy >= 0.7:
+        feedback += " Good job, keep practicing the highlighted notes."
+    else:
+        feedback += " Try playing more slowly and focus on the highlighted notes."
+    if details:
+        listed = "; ".join(details[:5])
+        if len(details) > 5:
+            listed += f"; and {len(details) - 5} more"
+        feedback += f" {listed[0].upper()}{listed[1:]}."
+    return feedback
+
+
+def analyze_buffer(y, sr, reference):
+    """Run the full analysis on a decoded mono buffer against a score's ``reference`` records."""
+    if sr != ANALYSIS_SR:
+        y, sr = resample_buffer(y, sr, ANALYSIS_SR), ANALYSIS_SR
+    return analyze_stream([y], reference)
+
+
+def analyze_stream(chunks, reference):
+    """``analyze_buffer`` for a take arriving as chunks of mono samples at ANALYSIS_SR.
+
+    With ``audiodecode.decode_blocks`` as the chunks, decoding happens as
+    the pitch tracker consumes them and is timed with it.
+    """
+    with stage('pitch_tracking'):
+        f0, voiced, level_db, flux = track_pitch_stream(chunks)
+    return analyze_frames(f0, voiced, level_db, flux, reference)
+
+
+def analyze_frames(f0, voiced, level_db, flux, reference, sr=ANALYSIS_SR):
+    """The note-level half of the analysis, from frame-level pitch, level and flux."""
+    with stage('note_segmentation'):
+        onsets = attacks(detect_onsets(flux, sr), level_db, sr)
+        segments = merge_repeats(segment_notes(f0, voiced, onsets, sr), onsets, sr)
+    with stage('score_comparison'):
+        accuracy, correct, incorrect, details, notes = compare_to_score(segments, reference)
+    feedback = build_feedback(accuracy, correct, incorrect, details, len(segments['midi']))
+    return accuracy, feedback, correct, incorrect, notes
+
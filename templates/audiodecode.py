@@ -0,0 +1,181 @@
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import firwin, resample_poly, upfirdn
+
+FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+FFMPEG_TIMEOUT = 60
+# Samples per channel read from an upload at a time
+DECODE_BLOCK_FRAMES = int(os.environ.get('DECODE_BLOCK_FRAMES', 65536))
+
+
+class AudioDecodeError(Exception):
+    pass
+
+
+def resample_buffer(y, orig_sr, target_sr):
+    """Polyphase resample, skipped entirely when the rates already match."""
+    if orig_sr == target_sr:
+        return np.ascontiguousarray(y, dtype=np.float32)
+    g = np.gcd(int(orig_sr), int(target_sr))
+    return resample_poly(y, target_sr // g, orig_sr // g).astype(np.float32)
+
+
+class StreamResampler:
+    """Chunk-by-chunk equivalent of ``resample_buffer`` for live audio.
+
+    Uses the same Kaiser-windowed FIR as ``resample_poly`` and carries the
+    input history the filter still needs between calls, so concatenating the
+    outputs of every ``process`` call plus ``flush`` matches resampling the
+    whole take at once.
+    """
+
+    def __init__(self, orig_sr, target_sr):
+        g = np.gcd(int(orig_sr), int(target_sr))
+        self.up, self.down = int(target_sr) // g, int(orig_sr) // g
+        if self.up != self.down:
+            max_rate = max(self.up, self.down)
+            half_len = 10 * max_rate
+            pre_pad = self.down - half_len % self.down
+            h = firwin(2 * half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0)).astype(np.float32) * self.up
+            self.h = np.concatenate((np.zeros(pre_pad, dtype=np.float32), h))
+            self.pre_remove = (half_len + pre_pad) // self.down
+        self.buffer = np.empty(0, dtype=np.float32)
+        self.buffer_start = 0  # input index of buffer[0]
+        self.received = 0
+        self.produced = 0
+
+    def _outputs(self, ready):
+        first, last = self.produced + self.pre_remove, ready + self.pre_remove
+        # upfirdn's output i lines up with the full output i + start * up / down
+        # only when the window starts on a multiple of down
+        start = max(0, first * self.down - len(self.h) + 1) // self.up // self.down * self.down
+        y = upfirdn(self.h, self.buffer[start - self.buffer_start:], self.up, self.down)
+        offset = first - start * self.up // self.down
+        self.produced = ready
+        keep_from = max(0, (ready + self.pre_remove) * self.down - len(self.h) + 1) // self.up // self.down * self.down
+        self.buffer = self.buffer[keep_from - self.buffer_start:]
+        self.buffer_start = keep_from
+        return y[offset:offset + last - first].astype(np.float32)
+
+    def process(self, x):
+        """Resample the next chunk; returns every output sample its input fully determines."""
+        if self.up == self.down:
+            return np.ascontiguousarray(x, dtype=np.float32)
+        self.buffer = np.concatenate((self.buffer, np.asarray(x, dtype=np.float32)))
+        self.received += len(x)
+        ready = (self.received * self.up - 1) // self.down - self.pre_remove + 1
+        if ready <= self.produced:
+            return np.empty(0, dtype=np.float32)
+        return self._outputs(ready)
+
+    def flush(self):
+        """The remaining output, treating the input as ending here."""
+        if self.up == self.down:
+            return np.empty(0, dtype=np.float32)
+        total = -(-self.received * self.up // self.down)
+        if total <= self.produced:
+            return np.empty(0, dtype=np.float32)
+        return self._outputs(total)
+
+
+def _downmix(block):
+    return block.mean(axis=1) if block.shape[1] > 1 else block[:, 0]
+
+
+def _native_blocks(sound_file, sr, block_frames):
+    resampler = StreamResampler(sound_file.samplerate, sr)
+    with sound_file:
+        for block in sound_file.blocks(block_frames, dtype='float32', always_2d=True):
+            y = resampler.process(_downmix(block))
+            if len(y):
+                yield y
+    y = resampler.flush()
+    if len(y):
+        yield y
+
+
+def _ffmpeg_blocks(data, sr, block_frames):
+    # Containers libsndfile can't open (MediaRecorder's webm/opus, mp4/aac)
+    # are piped through ffmpeg, which downmixes and resamples on the way out
+    binary = shutil.which(FFMPEG_BINARY)
+    if binary is None:
+        raise AudioDecodeError('Unsupported audio format (ffmpeg is not installed)')
+    command = [binary, '-nostdin', '-hide_banner', '-loglevel', 'error',
+               '-i', 'pipe:0', '-f', 'f32le', '-acodec', 'pcm_f32le',
+               '-ac', '1', '-ar', str(sr), 'pipe:1']
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+
+        # The upload is written from a thread so the output can be read as
+        # ffmpeg produces it
+        def feed():
+            try:
+                proc.stdin.write(data)
+                proc.stdin.close()
+            except OSError:
+                pass
+
+        timed_out = threading.Event()
+
+        def expire():
+            timed_out.set()
+            proc.kill()
+
+        writer = threading.Thread(target=feed, daemon=True)
+        timer = threading.Timer(FFMPEG_TIMEOUT, expire)
+        writer.start()
+        timer.start()
+        try:
+            while True:
+                raw = proc.stdout.read(block_frames * 4)
+                if not raw:
+                    break
+                yield np.frombuffer(raw[:len(raw) // 4 * 4], dtype=np.float32)
+            returncode = proc.wait()
+        finally:
+            timer.cancel()
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            writer.join()
+        if timed_out.is_set():
+            raise AudioDecodeError('Timed out decoding audio')
+        if returncode != 0:
+            stderr.seek(0)
+            message = stderr.read().decode(errors='replace').strip()
+            raise AudioDecodeError(f"Could not decode audio: {message}")
+
+
+def decode_blocks(data, sr, block_frames=DECODE_BLOCK_FRAMES):
+    """Decode an uploaded recording as a stream of mono float32 chunks at ``sr``.
+
+    ``data`` is the raw bytes of the upload; nothing is written to disk. The
+    recording is read ``block_frames`` samples per channel at a time and
+    each block is downmixed and resampled on its way through, so a decode
+    holds one block and the resampler's filter history however long the
+    recording is. A file ffmpeg can't decode raises AudioDecodeError while
+    the chunks are being read.
+    """
+    if not data:
+        raise AudioDecodeError('Empty audio upload')
+    try:
+        # libsndfile reads WAV/FLAC/OGG (Vorbis and Opus) and, on recent
+        # builds, MP3 straight from memory
+        sound_file = sf.SoundFile(io.BytesIO(data))
+    except (RuntimeError, TypeError):
+        return _ffmpeg_blocks(data, sr, block_frames)
+    return _native_blocks(sound_file, sr, block_frames)
+
+
+def decode_audio(data, sr):
+    """Decode an uploaded recording to a single mono float32 buffer at ``sr``."""
+    chunks = list(decode_blocks(data, sr))
+    return (np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)), sr
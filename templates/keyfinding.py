@@ -0,0 +1,56 @@
+import numpy as np
+
+# Key profiles as (major, minor) weights for each pitch class above the
+# tonic. 'aarden' is what music21's analyze('key') uses, so it is the default.
+KEY_PROFILES = {
+    'aarden': (
+        [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587,
+         0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+        [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362,
+         0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623],
+    ),
+    'krumhansl': (
+        [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+        [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+    ),
+    'temperley': (
+        [0.748, 0.06, 0.488, 0.082, 0.67, 0.46, 0.096, 0.715, 0.104, 0.366, 0.057, 0.4],
+        [0.712, 0.084, 0.474, 0.618, 0.049, 0.46, 0.105, 0.747, 0.404, 0.067, 0.133, 0.33],
+    ),
+}
+DEFAULT_PROFILE = 'aarden'
+
+# Tonic spellings music21 picks for each pitch class (e.g. A- major, G# minor)
+MAJOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'A-', 'A', 'B-', 'B']
+MINOR_TONICS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+_KEY_NAMES = [f"{tonic} major" for tonic in MAJOR_TONICS] + [f"{tonic} minor" for tonic in MINOR_TONICS]
+
+
+def _key_matrix(major, minor):
+    # Row k holds the profile rotated to tonic k % 12, centred and scaled to
+    # unit length, so one product with a centred histogram gives the Pearson
+    # correlation against all 24 keys
+    rows = np.array([np.roll(major, tonic) for tonic in range(12)]
+                    + [np.roll(minor, tonic) for tonic in range(12)], dtype=np.float64)
+    rows -= rows.mean(axis=1, keepdims=True)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+_KEY_MATRICES = {name: _key_matrix(*profiles) for name, profiles in KEY_PROFILES.items()}
+
+
+def pitch_class_histogram(pitch_classes, durations):
+    """Total quarter length sounded on each of the 12 pitch classes."""
+    pitch_classes = np.asarray(pitch_classes, dtype=np.int64) % 12
+    return np.bincount(pitch_classes, weights=np.asarray(durations, dtype=np.float64), minlength=12)
+
+
+def estimate_key(histogram, profile=DEFAULT_PROFILE):
+    """Best matching key as ``'<tonic> <mode>'`` (e.g. ``'E- major'``), or None without notes."""
+    histogram = np.asarray(histogram, dtype=np.float64)
+    centred = histogram - histogram.mean()
+    norm = np.linalg.norm(centred)
+    if not norm:
+        return None
+    correlations = _KEY_MATRICES[profile] @ (centred / norm)
+    return _KEY_NAMES[int(np.argmax(correlations))]
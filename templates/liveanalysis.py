@@ -0,0 +1,191 @@
+import numpy as np
+from scipy.ndimage import median_filter
+
+from notestore import TUNING_TOLERANCE_CENTS, midi_to_pitch_name
+from templates.audioanalysis import (ANALYSIS_SR, FRAME_BATCH, FRAME_LENGTH, HOP_LENGTH, MIN_NOTE_SECONDS,
+                                     analyze_frames, frame_features, voicing)
+from templates.audiodecode import StreamResampler
+
+# One row per analysis frame, as appended to a live session's frame file
+FRAME_DTYPE = np.dtype([('f0', '<f8'), ('periodic', '?'), ('level_db', '<f8'), ('flux', '<f8')])
+
+# Level histogram for a running estimate of the take's loud (95th
+# percentile) level, which the batch analysis takes over the whole take
+LEVEL_EDGES = np.arange(-120.0, 20.5, 0.5)
+
+# segment_notes smooths labels with a 5-frame median, so the newest two
+# frames can still change
+MEDIAN_LOOKAHEAD = 2
+MIN_NOTE_FRAMES = max(1, int(MIN_NOTE_SECONDS * ANALYSIS_SR / HOP_LENGTH))
+
+
+class LiveAnalyzer:
+    """Incremental pitch tracking for a take that arrives in chunks.
+
+    ``feed`` resamples each chunk with a ``StreamResampler``, keeps the
+    samples of the frame that straddles the chunk end, and runs YIN on every
+    frame that is now complete, carrying the flux row across calls. The
+    frames come out exactly as ``track_pitch`` would compute them on the
+    whole take, so ``finish`` only needs the note-level steps.
+
+    As soon as a note has been stable for MIN_NOTE_SECONDS it is matched
+    against the next expected score note for a per-note verdict.
+    """
+
+    _SCALARS = ('sample_rate', 'n_frames', 'live_from', 'judged_start', 'cursor',
+                'buffer_start', 'received', 'produced')
+
+    def __init__(self, reference, sample_rate):
+        self.sample_rate = int(sample_rate)
+        self.resampler = StreamResampler(self.sample_rate, ANALYSIS_SR)
+        self.samples = np.empty(0, dtype=np.float32)
+        self.previous = None
+        self.level_counts = np.zeros(len(LEVEL_EDGES) + 1, dtype=np.int64)
+        self.recent = np.empty(0, dtype=FRAME_DTYPE)
+        self.n_frames = 0
+        self.live_from = 0
+        self.judged_start = -1
+        self.cursor = 0
+        self.positions = reference['position'].astype(np.int64)
+        self.expected_midi = reference['midi'].astype(np.int64)
+
+    def state(self):
+        """Arrays for ``np.savez``; ``LiveAnalyzer.from_state`` restores them."""
+        state = {name: np.array(getattr(self, name)) for name in ('samples', 'level_counts', 'recent',
+                                                                  'positions', 'expected_midi')}
+        state['previous'] = self.previous if self.previous is not None else np.empty((0, 0))
+        state['resampler_buffer'] = self.resampler.buffer
+        state['scalars'] = np.array([self.sample_rate, self.n_frames, self.live_from, self.judged_start,
+                                     self.cursor, self.resampler.buffer_start, self.resampler.received,
+                                     self.resampler.produced], dtype=np.int64)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        analyzer = cls.__new__(cls)
+        scalars = dict(zip(cls._SCALARS, state['scalars'].tolist()))
+        analyzer.sample_rate = scalars['sample_rate']
+        analyzer.resampler = StreamResampler(analyzer.sample_rate, ANALYSIS_SR)
+        analyzer.resampler.buffer = state['resampler_buffer']
+        for name in ('buffer_start', 'received', 'produced'):
+            setattr(analyzer.resampler, name, scalars[name])
+        for name in ('n_frames', 'live_from', 'judged_start', 'cursor'):
+            setattr(analyzer, name, scalars[name])
+        for name in ('samples', 'level_counts', 'recent', 'positions', 'expected_midi'):
+            setattr(analyzer, name, state[name])
+        analyzer.previous = state['previous'] if state['previous'].size else None
+        return analyzer
+
+    @property
+    def seconds(self):
+        return self.resampler.received / self.sample_rate
+
+    def _frames(self, y, final=False):
+        self.samples = np.concatenate((self.samples, y))
+        if final and not self.n_frames and 0 < len(self.samples) < FRAME_LENGTH:
+            # track_pitch pads a take shorter than one frame
+            self.samples = np.pad(self.samples, (0, FRAME_LENGTH - len(self.samples)))
+        if len(self.samples) < FRAME_LENGTH:
+            return np.empty(0, dtype=FRAME_DTYPE)
+        count = (len(self.samples) - FRAME_LENGTH) // HOP_LENGTH + 1
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples, FRAME_LENGTH)[::HOP_LENGTH][:count]
+        records = np.empty(count, dtype=FRAME_DTYPE)
+        for start in range(0, count, FRAME_BATCH):
+            stop = min(start + FRAME_BATCH, count)
+            (records['f0'][start:stop], records['periodic'][start:stop], records['level_db'][start:stop],
+             records['flux'][start:stop], self.previous) = frame_features(frames[start:stop], ANALYSIS_SR,
+                                                                          FRAME_LENGTH, self.previous)
+        self.samples = self.samples[count * HOP_LENGTH:].copy()
+        self.n_frames += count
+        self.level_counts += np.bincount(np.searchsorted(LEVEL_EDGES, records['level_db']),
+                                         minlength=len(self.level_counts))
+        return records
+
+    def _loud(self):
+        # 95th percentile of every frame's level so far, to histogram precision
+        target = 0.95 * (self.level_counts.sum() - 1)
+        index = int(np.searchsorted(np.cumsum(self.level_counts), target, side='right'))
+        return LEVEL_EDGES[min(max(index - 1, 0), len(LEVEL_EDGES) - 1)]
+
+    def _verdict(self, i, correct, heard=None, cents=None, time=None):
+        return {
+            'index': int(self.positions[i]),
+            'correct': bool(correct),
+            'expected': midi_to_pitch_name(int(self.expected_midi[i])),
+            'heard': midi_to_pitch_name(heard) if heard is not None else None,
+            'cents': int(round(cents)) if cents is not None else None,
+            'time': round(float(time), 3) if time is not None else None,
+        }
+
+    def _judge(self, midi, cents, time):
+        verdicts = []
+        expected = self.expected_midi
+        if self.cursor >= len(expected):
+            return verdicts
+        if midi != expected[self.cursor] and self.cursor + 1 < len(expected) and midi == expected[self.cursor + 1]:
+            # One note skipped
+            verdicts.append(self._verdict(self.cursor, False))
+            self.cursor += 1
+        if midi == expected[self.cursor]:
+            verdicts.append(self._verdict(self.cursor, abs(cents) <= TUNING_TOLERANCE_CENTS, midi, cents, time))
+            self.cursor += 1
+        else:
+            verdicts.append(self._verdict(self.cursor, False, midi, cents, time))
+        return verdicts
+
+    def _live_notes(self, records):
+        """Verdicts for notes that became stable, plus the pitch currently heard."""
+        self.recent = np.concatenate((self.recent, records))
+        stable = len(self.recent) - MEDIAN_LOOKAHEAD
+        if stable <= 0:
+            return [], None
+
+        voiced = voicing(self.recent['periodic'], self.recent['level_db'], self._loud())
+        midi = np.full(len(self.recent), np.nan)
+        midi[voiced] = 69.0 + 12.0 * np.log2(self.recent['f0'][voiced] / 440.0)
+        labels = np.where(voiced, np.rint(np.nan_to_num(midi, nan=-1.0)), -1).astype(int)
+        labels = median_filter(labels, size=5, mode='nearest')[:stable]
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(labels)) + 1))
+        ends = np.append(starts[1:], stable)
+        verdicts = []
+        current = None
+        seconds = HOP_LENGTH / ANALYSIS_SR
+        for start, end in zip(starts, ends):
+            label = labels[start]
+            if label < 0 or end - start < MIN_NOTE_FRAMES:
+                continue
+            run = midi[start:end]
+            agrees = np.abs(np.nan_to_num(run) - label) < 0.5
+            cents = 100.0 * (run[agrees].mean() - label) if agrees.any() else 0.0
+            if end == stable:
+                current = {'pitch': midi_to_pitch_name(int(label)), 'cents': int(round(cents))}
+            if self.live_from + start > self.judged_start:
+                self.judged_start = self.live_from + start
+                verdicts.extend(self._judge(int(label), cents, (self.live_from + start) * seconds))
+
+        # Keep the last (possibly still sounding) run and the median filter's context
+        keep = max(int(starts[-1]) - MEDIAN_LOOKAHEAD, 0)
+        self.recent = self.recent[keep:]
+        self.live_from += keep
+        return verdicts, current
+
+    def feed(self, chunk):
+        """Analyze the next chunk of mono samples at ``sample_rate``.
+
+        Returns ``(frames, verdicts, current)``: the new frame rows, verdicts
+        for notes that just became stable, and the note being held, if any.
+        """
+        records = self._frames(self.resampler.process(chunk))
+        verdicts, current = self._live_notes(records)
+        return records, verdicts, current
+
+    def finish(self):
+        """Frame rows for the rest of the take once recording has stopped."""
+        return self._frames(self.resampler.flush(), final=True)
+
+
+def analyze_live_frames(frames, reference):
+    """Final ``(accuracy, feedback, correct, incorrect, notes)`` from every frame row of a take."""
+    voiced = voicing(frames['periodic'], frames['level_db'])
+    return analyze_frames(frames['f0'], voiced, frames['level_db'], frames['flux'], reference)
@@ -0,0 +1,305 @@
+import math
+import struct
+from fractions import Fraction
+
+import numpy as np
+
+from notestore import pack_columns
+from templates.keyfinding import estimate_key
+
+# Reads Standard MIDI Files straight from the track chunks and produces the
+# same notes as detect_notes_from_midi, following music21's conventions:
+# offsets and durations quantized to sixteenths or eighth-note triplets,
+# chords skipped, gaps filled with rests, notes and rests split at
+# barlines, one part per track with notes.
+
+QUANTIZE_DIVISORS = (4, 3)
+
+# music21's default spelling for MIDI pitches
+_SPELLINGS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+
+_MAJOR_TONICS = {-7: 'C-', -6: 'G-', -5: 'D-', -4: 'A-', -3: 'E-', -2: 'B-', -1: 'F',
+                 0: 'C', 1: 'G', 2: 'D', 3: 'A', 4: 'E', 5: 'B', 6: 'F#', 7: 'C#'}
+_MINOR_TONICS = {-7: 'A-', -6: 'E-', -5: 'B-', -4: 'F', -3: 'C', -2: 'G', -1: 'D',
+                 0: 'A', 1: 'E', 2: 'B', 3: 'F#', 4: 'C#', 5: 'G#', 6: 'D#', 7: 'A#'}
+
+# Data bytes following each channel status nibble
+_DATA_LENGTHS = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+
+class MidiFormatError(Exception):
+    """The file is not something the fast reader handles; use music21."""
+
+
+def _read_vlq(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+
+def _read_track(data, start, end, meta):
+    """Note (start, end, pitch) ticks for one MTrk chunk.
+
+    Time and key signature events are appended to ``meta`` as
+    ``(tick, kind, values)``.
+    """
+    pos = start
+    tick = 0
+    status = 0
+    pending = {}
+    starts, ends, pitches = [], [], []
+
+    while pos < end:
+        delta, pos = _read_vlq(data, pos)
+        tick += delta
+        byte = data[pos]
+        if byte & 0x80:
+            pos += 1
+            if byte < 0xF0:
+                status = byte
+        elif not status:
+            raise MidiFormatError('Running status without a previous status byte')
+        else:
+            byte = status
+
+        kind = byte >> 4
+        if kind == 0x9 or kind == 0x8:
+            pitch, velocity = data[pos], data[pos + 1]
+            pos += 2
+            key = ((byte & 0x0F) << 7) | pitch
+            if byte & 0x0F == 9:
+                # music21 reads channel 10 as unpitched percussion
+                raise MidiFormatError('Percussion channel')
+            if kind == 0x9 and velocity:
+                pending.setdefault(key, []).append(len(starts))
+                starts.append(tick)
+                ends.append(-1)
+                pitches.append(pitch)
+            else:
+                # Like music21, a note off ends every sounding note of that
+                # pitch, so re-struck notes all stop at the first release
+                for index in pending.pop(key, ()):
+                    ends[index] = tick
+        elif byte < 0xF0:
+            pos += _DATA_LENGTHS[kind]
+        elif byte == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_vlq(data, pos + 1)
+            if meta_type == 0x58 and length >= 2:
+                meta.append((tick, 'time', (data[pos], 2 ** data[pos + 1])))
+            elif meta_type == 0x59 and length >= 2:
+                meta.append((tick, 'key', (struct.unpack('b', data[pos:pos + 1])[0], data[pos + 1])))
+            elif meta_type == 0x2F:
+                break
+            pos += length
+        elif byte in (0xF0, 0xF7):
+            length, pos = _read_vlq(data, pos)
+            pos += length
+        else:
+            raise MidiFormatError(f'Unexpected status byte {byte:#x}')
+
+    # Notes are kept in note-on order; ones never released are dropped
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    pitches = np.array(pitches, dtype=np.int16)
+    closed = ends >= 0
+    return starts[closed], ends[closed], pitches[closed]
+
+
+def _nearest_multiple(value, divisor):
+    # Exact halves round down and errors are rounded to 7 places, as in
+    # music21.common.nearestMultiple, so ties resolve the same way
+    tick = 1 / divisor
+    multiple = math.floor(value / tick)
+    low = tick * multiple
+    if value <= low + tick / 2:
+        return multiple, round(value - low, 7)
+    return multiple + 1, round(tick * (multiple + 1) - value, 7)
+
+
+def _best_match(value, zero_allowed=True, gap=0.0):
+    """Quantize a quarter length the way music21's Stream.quantize does.
+
+    Candidates are ranked by how much of ``gap`` (the distance to the next
+    onset) they leave unfilled, then by error, then by the finer grid.
+    """
+    found = []
+    for divisor in QUANTIZE_DIVISORS:
+        tick = 1 / divisor
+        multiple, error = _nearest_multiple(value, divisor)
+        if not zero_allowed and multiple == 0:
+            multiple, error = 1, round(abs(value - tick), 7)
+        remaining = 0.0 if gap % tick == 0 else max(gap - multiple * tick, 0.0)
+        found.append((remaining, error, tick, multiple, divisor))
+    _remaining, _error, _tick, multiple, divisor = min(found)
+    return Fraction(multiple, divisor)
+
+
+def _measure_starts(time_signatures, total):
+    """Barline offsets (Fractions) from 0 up to the first one at or after ``total``."""
+    changes = sorted(time_signatures, key=lambda change: change[0]) or [(Fraction(0), (4, 4))]
+    if changes[0][0] > 0:
+        changes.insert(0, (Fraction(0), (4, 4)))
+    starts = []
+    for i, (offset, (numerator, denominator)) in enumerate(changes):
+        length = Fraction(4 * numerator, denominator)
+        until = changes[i + 1][0] if i + 1 < len(changes) else total
+        position = offset
+        while position < until:
+            starts.append(position)
+            position += length
+    starts.append(position)
+    return starts
+
+
+def _group_chords(starts, ends, division):
+    """Split sorted notes into (first, last) index runs sounding as one chord.
+
+    Notes starting within a sixteenth of each other and ending together form
+    a chord; if they end apart music21 would split the part into voices,
+    which the fast reader does not reproduce.
+    """
+    tolerance = division / max(QUANTIZE_DIVISORS)
+    groups = []
+    i = 0
+    while i < len(starts):
+        j = i + 1
+        while j < len(starts) and abs(starts[j] - starts[i]) < tolerance:
+            if abs(ends[j] - ends[i]) > tolerance:
+                raise MidiFormatError('Notes need separate voices')
+            j += 1
+        groups.append((i, j - 1))
+        i = j
+    return groups
+
+
+def _part_notes(starts, ends, pitches, division, time_signatures, histogram, columns):
+    """Append one part's notes and rests to ``columns`` as (name, quarter length, measure).
+
+    Quarter lengths stay Fractions until they are packed into ticks. Each
+    sounded quarter length is added to ``histogram``.
+    """
+    starts, ends, pitches = starts.tolist(), ends.tolist(), pitches.tolist()
+    groups = _group_chords(starts, ends, division)
+
+    # Offsets first, then durations, each aware of the next later onset
+    offsets = [_best_match(starts[first] / division) for first, _last in groups]
+    later = [None] * len(offsets)
+    for k in range(len(offsets) - 2, -1, -1):
+        later[k] = offsets[k + 1] if offsets[k + 1] > offsets[k] else later[k + 1]
+    events = []
+    for k, (first, last) in enumerate(groups):
+        offset = offsets[k]
+        # A chord takes its length from its last note, as in music21
+        length = (ends[last] - starts[last]) / division
+        gap = 0.0 if later[k] is None else float(later[k] - offset)
+        duration = _best_match(length, zero_allowed=False, gap=gap)
+        for pitch in pitches[first:last + 1]:
+            histogram[pitch % 12] += float(duration)
+        # Chords occupy time but, like in detect_notes_from_midi, are not listed
+        pitch = pitches[first] if first == last else None
+        events.append((offset, duration, pitch))
+    events.sort(key=lambda event: event[0])
+
+    total = max(offset + duration for offset, duration, _pitch in events)
+    measure_starts = _measure_starts(time_signatures, total)
+    boundaries = np.array([float(start) for start in measure_starts])
+
+    # Split every event at the barlines it crosses
+    measures = [[] for _ in range(len(measure_starts) - 1)]
+    for offset, duration, pitch in events:
+        index = int(np.searchsorted(boundaries, float(offset), side='right')) - 1
+        end = offset + duration
+        carried = False
+        while offset < end and index < len(measures):
+            piece_end = min(end, measure_starts[index + 1])
+            measures[index].append((offset, carried, piece_end, pitch))
+            offset = piece_end
+            index += 1
+            carried = True
+
+    # Tied continuations land after notes starting on the same beat, then
+    # rests fill every gap within a measure and pad it to the barline
+    for index, pieces in enumerate(measures):
+        number = index + 1
+        position = measure_starts[index]
+        pieces.sort(key=lambda piece: piece[:2])
+        for offset, _carried, end, pitch in pieces:
+            if offset > position:
+                columns.append(('Rest', offset - position, number))
+            if pitch is not None:
+                columns.append((f"{_SPELLINGS[pitch % 12]}{pitch // 12 - 1}", end - offset, number))
+            position = max(position, end)
+        if position < measure_starts[index + 1]:
+            columns.append(('Rest', measure_starts[index + 1] - position, number))
+
+
+def read_midi(file_path):
+    with open(file_path, 'rb') as f:
+        data = f.read()
+
+    if data[:4] != b'MThd':
+        raise MidiFormatError('Missing MThd header')
+    header_length, midi_format, track_count, division = struct.unpack('>IHHH', data[4:14])
+    if midi_format > 1:
+        raise MidiFormatError('Format 2 MIDI files are not supported')
+    if division & 0x8000:
+        raise MidiFormatError('SMPTE time division is not supported')
+
+    tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(data) and len(tracks) < track_count:
+        chunk_type = data[pos:pos + 4]
+        length = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        pos += 8
+        if chunk_type == b'MTrk':
+            meta = []
+            try:
+                notes = _read_track(data, pos, min(pos + length, len(data)), meta)
+            except (IndexError, KeyError) as e:
+                raise MidiFormatError(f'Truncated or malformed track: {e!r}')
+            tracks.append((notes, sorted(meta, key=lambda event: event[0])))
+        pos += length
+
+    # A leading track without notes is the conductor track and its
+    # signatures apply to every part; otherwise each track keeps its own
+    conductor = []
+    if tracks and not len(tracks[0][0][0]):
+        conductor = tracks[0][1]
+
+    columns = []
+    time_signature = None
+    key_signatures = []
+    histogram = np.zeros(12)
+    for (starts, ends, pitches), meta in tracks:
+        if not len(starts):
+            continue
+        meta = sorted(conductor + meta, key=lambda event: event[0]) if conductor is not meta else meta
+        time_signatures = [(Fraction(tick, division), values) for tick, kind, values in meta if kind == 'time']
+        key_signatures += [values for _tick, kind, values in meta if kind == 'key']
+        if time_signature is None and time_signatures:
+            numerator, denominator = time_signatures[0][1]
+            time_signature = f"{numerator}/{denominator}"
+        _part_notes(starts, ends, pitches, division, time_signatures, histogram, columns)
+
+    key_signature = None
+    if key_signatures:
+        sharps, minor = key_signatures[0]
+        if -7 <= sharps <= 7:
+            key_signature = (f"{_MINOR_TONICS[sharps]} minor" if minor
+                             else f"{_MAJOR_TONICS[sharps]} major")
+    if key_signature is None:
+        # Chords are not listed but still count towards the key
+        key_signature = estimate_key(histogram)
+
+    names, durations, measures = zip(*columns) if columns else ((), (), ())
+    return {
+        'notes': pack_columns(names, durations, measures),
+        'time_signature': time_signature or "4/4",
+        'key_signature': key_signature,
+        'clef': "G"
+    }
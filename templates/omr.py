@@ -0,0 +1,257 @@
+import cv2
+import numpy as np
+
+from notestore import note_array
+
+# Optical music recognition for printed single-staff parts. Works in units of
+# the detected staff spacing (distance between adjacent staff lines), so the
+# same thresholds hold for phone photos and 600 dpi scans alike. Assumes a
+# treble clef and ignores key signatures and accidentals.
+
+MAX_PIXELS = 12_000_000  # larger pages are downscaled before processing
+
+STAFF_ROW_FILL = 0.5  # a staff line row is at least this fraction as dark as the darkest row
+STAFF_GAP_TOLERANCE = 0.25  # the four gaps of a staff agree to within this fraction
+
+# Notehead size limits, in staff spacings
+HEAD_MIN_WIDTH, HEAD_MAX_WIDTH = 0.8, 2.0
+HEAD_MIN_HEIGHT, HEAD_MAX_HEIGHT = 0.6, 1.5
+CLEF_WIDTH = 3.0  # heads and barlines this close to the start of the staff are the clef
+HEAD_MIN_FILL = 0.5  # share of the bounding box that is ink
+HOLLOW_MIN_HOLE = 0.12  # share of a head that is enclosed paper (half and whole notes)
+
+STEM_MIN_LENGTH = 2.5
+BARLINE_MAX_WIDTH = 0.5
+
+_STEP_SEMITONES = np.array([0, 2, 4, 5, 7, 9, 11])
+_BOTTOM_LINE = 4 * 7 + 2  # diatonic index of E4, the bottom line of a treble staff
+
+
+class OMRError(Exception):
+    pass
+
+
+def load_binary(image_path):
+    """Ink as 255 on a 0 background, downscaled so it stays under MAX_PIXELS."""
+    gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise OMRError(f"Could not read image {image_path}")
+    height, width = gray.shape
+    if height * width > MAX_PIXELS:
+        scale = (MAX_PIXELS / (height * width)) ** 0.5
+        gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return binary
+
+
+def find_staves(binary):
+    """Staff line rows from the horizontal projection profile.
+
+    Returns ``(lines, thickness)`` where ``lines`` is an ``(n_staves, 5)``
+    array of line centre rows, top to bottom.
+    """
+    profile = np.count_nonzero(binary, axis=1)
+    dark = profile >= STAFF_ROW_FILL * profile.max()
+    # Runs of consecutive dark rows are single (possibly thick) lines
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], dark.astype(np.int8), [0]))))
+    starts, ends = edges[::2], edges[1::2]
+    centres = (starts + ends - 1) / 2
+    thickness = int(np.median(ends - starts)) if len(starts) else 0
+
+    staves = []
+    i = 0
+    while i + 5 <= len(centres):
+        gaps = np.diff(centres[i:i + 5])
+        if gaps.min() > thickness and gaps.max() - gaps.min() <= STAFF_GAP_TOLERANCE * gaps.mean():
+            staves.append(centres[i:i + 5])
+            i += 5
+        else:
+            i += 1
+    if not staves:
+        raise OMRError('No staves found')
+    return np.array(staves), max(thickness, 1)
+
+
+def remove_staff_lines(binary, lines, thickness):
+    """Erase staff line pixels that have no ink directly above and below them."""
+    clean = binary.copy()
+    height = binary.shape[0]
+    half = thickness // 2 + 1
+    for row in lines.ravel():
+        top = max(int(round(row)) - half, 0)
+        bottom = min(int(round(row)) + half, height - 1)
+        above = binary[max(top - 1, 0)] > 0
+        below = binary[min(bottom + 1, height - 1)] > 0
+        clean[top:bottom + 1, ~(above & below)] = 0
+    return clean
+
+
+def _fill_holes(clean):
+    # Paper not reachable from the page border is enclosed, e.g. the inside
+    # of a hollow notehead
+    flood = clean.copy()
+    mask = np.zeros((clean.shape[0] + 2, clean.shape[1] + 2), np.uint8)
+    cv2.floodFill(flood, mask, (0, 0), 255)
+    holes = cv2.bitwise_not(flood)
+    return cv2.bitwise_or(clean, holes), holes
+
+
+def _box_sums(integral, x0, y0, x1, y1):
+    """Ink pixel counts of many boxes at once from an integral image."""
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    x0, x1 = np.clip(x0, 0, w), np.clip(x1, 0, w)
+    y0, y1 = np.clip(y0, 0, h), np.clip(y1, 0, h)
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def find_noteheads(clean, spacing):
+    """Notehead boxes ``(x, y, w, h)`` and whether each one is hollow."""
+    filled, holes = _fill_holes(clean)
+    size = max(int(round(spacing * 0.6)), 3)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+    # Stems, beams' thin ends, slurs and ledger lines are narrower than the
+    # kernel and disappear; noteheads survive the opening
+    heads = cv2.morphologyEx(filled, cv2.MORPH_OPEN, kernel)
+    count, _labels, stats, _centroids = cv2.connectedComponentsWithStats(heads, connectivity=8)
+    x, y, w, h, area = stats[1:].T
+
+    keep = ((w >= HEAD_MIN_WIDTH * spacing) & (w <= HEAD_MAX_WIDTH * spacing)
+            & (h >= HEAD_MIN_HEIGHT * spacing) & (h <= HEAD_MAX_HEIGHT * spacing)
+            & (area >= HEAD_MIN_FILL * w * h))
+    boxes = stats[1:][keep, :4]
+
+    hole_integral = cv2.integral((holes > 0).astype(np.uint8))
+    x, y, w, h = boxes.T
+    hole_share = _box_sums(hole_integral, x, y, x + w, y + h) / np.maximum(w * h, 1)
+    return boxes, hole_share >= HOLLOW_MIN_HOLE
+
+
+def _verticals(clean, spacing):
+    length = max(int(round(STEM_MIN_LENGTH * spacing)), 3)
+    return cv2.morphologyEx(clean, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, length)))
+
+
+def _horizontals(clean, spacing, thickness):
+    # Beams and flags: thicker than staff lines, wider than a stem
+    height = max(int(round(spacing * 0.3)), thickness + 1)
+    width = max(int(round(spacing * 0.8)), 2)
+    return cv2.morphologyEx(clean, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (width, height)))
+
+
+def _beam_count(column):
+    """Separate runs of beam ink along a stem."""
+    runs = np.diff(np.concatenate(([0], (column > 0).astype(np.int8), [0])))
+    return int(np.count_nonzero(runs == 1))
+
+
+def note_durations(clean, boxes, hollow, spacing, thickness):
+    """Quarter lengths from notehead fill, stems, beams/flags and dots."""
+    verticals = _verticals(clean, spacing)
+    horizontals = _horizontals(clean, spacing, thickness)
+    vertical_integral = cv2.integral((verticals > 0).astype(np.uint8))
+    x, y, w, h = boxes.T.astype(np.int64)
+    cy = y + h // 2
+    reach = int(round(STEM_MIN_LENGTH * spacing))
+    pad = max(thickness, 2)
+
+    # Stems go up from the right edge of a head or down from its left edge
+    up = _box_sums(vertical_integral, x + w - 2 * pad, cy - reach, x + w + pad, cy) >= reach
+    down = _box_sums(vertical_integral, x - pad, cy, x + 2 * pad, cy + reach) >= reach
+    has_stem = up | down
+
+    durations = np.where(hollow, np.where(has_stem, 2.0, 4.0), 1.0)
+    extent = int(round(4 * spacing))
+    for i in np.flatnonzero(has_stem & ~hollow):
+        # Look along the stem, past the head, for beams or flags
+        if up[i]:
+            rows = slice(max(cy[i] - extent, 0), max(cy[i] - int(spacing), 0))
+            columns = slice(x[i] + w[i] - pad, x[i] + w[i] + pad)
+        else:
+            rows = slice(cy[i] + int(spacing), cy[i] + extent)
+            columns = slice(max(x[i] - pad, 0), x[i] + pad)
+        column = horizontals[rows, columns]
+        beams = _beam_count(column.max(axis=1)) if column.size else 0
+        durations[i] = 1.0 / 2 ** beams
+
+    # Augmentation dots: small round blobs just right of the head
+    count, _labels, stats, centroids = cv2.connectedComponentsWithStats(clean, connectivity=8)
+    dw, dh = stats[1:, 2], stats[1:, 3]
+    dots = centroids[1:][(dw >= 0.2 * spacing) & (dw <= 0.6 * spacing)
+                         & (dh >= 0.2 * spacing) & (dh <= 0.6 * spacing)]
+    if len(dots) and len(boxes):
+        dx = dots[:, 0][None, :] - (x + w)[:, None]
+        dy = np.abs(dots[:, 1][None, :] - cy[:, None])
+        dotted = ((dx > 0) & (dx <= 1.2 * spacing) & (dy <= 0.75 * spacing)).any(axis=1)
+        durations = np.where(dotted, durations * 1.5, durations)
+    return durations, verticals
+
+
+def find_barlines(verticals, staves, staff_starts, spacing, boxes):
+    """Barline x positions for each staff, left to right."""
+    count, _labels, stats, _centroids = cv2.connectedComponentsWithStats(verticals, connectivity=8)
+    x, y, w, h = stats[1:, :4].T
+    thin = w <= BARLINE_MAX_WIDTH * spacing
+    centre = x + w / 2
+    # Stems touch a notehead; barlines don't
+    if len(boxes):
+        near_head = ((centre[:, None] >= boxes[:, 0] - spacing)
+                     & (centre[:, None] <= boxes[:, 0] + boxes[:, 2] + spacing)
+                     & (y[:, None] <= boxes[:, 1] + boxes[:, 3])
+                     & (y[:, None] + h[:, None] >= boxes[:, 1])).any(axis=1)
+    else:
+        near_head = np.zeros(len(x), dtype=bool)
+
+    barlines = []
+    for lines, start in zip(staves, staff_starts):
+        spans = (y <= lines[0] + spacing / 2) & (y + h >= lines[-1] - spacing / 2)
+        past_clef = centre > start + CLEF_WIDTH * spacing
+        positions = np.sort(centre[thin & spans & past_clef & ~near_head])
+        # Double and repeat barlines count once
+        if len(positions):
+            positions = positions[np.concatenate(([True], np.diff(positions) > spacing))]
+        barlines.append(positions)
+    return barlines
+
+
+def read_score_image(image_path):
+    """Notes found on a page, staff by staff, as a packed ``notestore.NOTE_DTYPE`` array.
+
+    Also returns the MIDI numbers and quarter lengths the key is estimated from.
+    """
+    binary = load_binary(image_path)
+    staves, thickness = find_staves(binary)
+    spacing = float(np.median(np.diff(staves, axis=1)))
+    clean = remove_staff_lines(binary, staves, thickness)
+
+    boxes, hollow = find_noteheads(clean, spacing)
+    cy = boxes[:, 1] + boxes[:, 3] / 2
+    cx = boxes[:, 0] + boxes[:, 2] / 2
+    # Each head belongs to the staff whose middle line is nearest, and must
+    # sit within a few ledger lines of it
+    distance = np.abs(cy[:, None] - staves[:, 2][None, :])
+    staff = np.argmin(distance, axis=1) if len(boxes) else np.zeros(0, dtype=np.int64)
+    staff_starts = np.argmax(binary[np.rint(staves[:, 0]).astype(np.int64)] > 0, axis=1)
+    on_staff = ((distance[np.arange(len(boxes)), staff] <= 5 * spacing)
+                & (cx > staff_starts[staff] + CLEF_WIDTH * spacing))
+    boxes, hollow, cx, cy, staff = boxes[on_staff], hollow[on_staff], cx[on_staff], cy[on_staff], staff[on_staff]
+
+    durations, verticals = note_durations(clean, boxes, hollow, spacing, thickness)
+    barlines = find_barlines(verticals, staves, staff_starts, spacing, boxes)
+
+    # Diatonic steps above the bottom line, half a spacing each
+    steps = np.rint((staves[staff, 4] - cy) / (spacing / 2)).astype(np.int64) + _BOTTOM_LINE
+    midi = (steps // 7 + 1) * 12 + _STEP_SEMITONES[steps % 7]
+
+    measures = np.zeros(len(boxes), dtype=np.int64)
+    first = 1
+    for index, positions in enumerate(barlines):
+        mine = staff == index
+        local = np.searchsorted(positions, cx[mine])
+        measures[mine] = first + local
+        # A staff ends on a barline unless notes follow the last one
+        first += len(positions) + int(bool(mine.any()) and local.max(initial=0) == len(positions))
+
+    order = np.lexsort((cx, staff))
+    steps = steps[order]
+    notes = note_array(steps % 7, 0, steps // 7, durations[order], measures[order])
+    return notes, midi[order], durations[order]
@@ -0,0 +1,179 @@
+import numpy as np
+
+from metrics import stage
+from templates.audioanalysis import (ANALYSIS_SR, FRAME_LENGTH, HOP_LENGTH, ONSET_COMPRESSION, detect_onsets,
+                                     stream_frames)
+
+# A tap this far from its note (in beats) earns nothing and can't be
+# matched to it; same scale as the old in-page score
+MATCH_WINDOW_BEATS = 0.3
+# Assignment costs: a matched tap costs its deviation as a fraction of the
+# window (0-1), a missed note or an extra tap a full point each
+MISS_COST = 1.0
+EXTRA_COST = 1.0
+# Per-note bands the rhythm page colours by
+GOOD_ACCURACY = 85
+OKAY_ACCURACY = 60
+# Offsets tried when the client doesn't say where the first note fell:
+# each of the first few taps against each of the first notes, so a student
+# may come in up to OFFSET_NOTES notes late
+OFFSET_TAPS = 4
+OFFSET_NOTES = 32
+
+
+def onset_grid(reference, tempo):
+    """Seconds from the first note to every note of ``reference`` at ``tempo`` BPM."""
+    beats = reference['beat'] - (reference['beat'][0] if len(reference) else 0.0)
+    return beats * (60.0 / tempo)
+
+
+def assign_taps(taps, onsets, window):
+    """Optimal order-preserving assignment of taps to expected onsets.
+
+    A DP over notes (rows) and taps (columns) where each note is matched to
+    one tap at ``|deviation| / window`` or missed at MISS_COST, and every tap
+    left over costs EXTRA_COST. Taps and notes are both in time order, so the
+    order-preserving optimum is the optimal assignment; the skip-a-tap term
+    is a running minimum, which makes each row a few vectorized passes.
+
+    Returns ``(tap index per note or -1, total cost)``.
+    """
+    m, n = len(onsets), len(taps)
+    columns = np.arange(n + 1)
+    # Row 0: no notes yet, the first j taps are extra
+    row = columns * EXTRA_COST
+    moves = np.empty((m, n + 1), dtype=np.int8)
+    for i in range(m):
+        deviation = np.abs(taps - onsets[i]) / window
+        match = np.full(n + 1, np.inf)
+        match[1:] = np.where(deviation < 1.0, row[:-1] + deviation, np.inf)
+        miss = row + MISS_COST
+        entered = np.minimum(match, miss)
+        # row[j] = min over k <= j of entered[k] + (j - k) extra taps
+        best = np.minimum.accumulate(entered - columns * EXTRA_COST)
+        row = best + columns * EXTRA_COST
+        # 0: note matched to tap j - 1, 1: note missed, 2: tap j - 1 extra
+        moves[i] = np.where(entered - columns * EXTRA_COST > best, 2, np.where(match <= miss, 0, 1))
+
+    assigned = np.full(m, -1, dtype=np.int64)
+    i, j = m - 1, n
+    while i >= 0:
+        move = moves[i, j]
+        if move == 2:
+            j -= 1
+        elif move == 1:
+            i -= 1
+        else:
+            assigned[i] = j - 1
+            i, j = i - 1, j - 1
+    return assigned, float(row[n])
+
+
+def _best_offset(taps, onsets, window):
+    """Time of the first note on the taps' clock, when the client didn't send it.
+
+    Each candidate lines one of the first taps up with one of the first
+    notes and is scored without the full DP: every tap costs its distance to
+    the nearest note (capped at one window) and every note with no tap
+    within a window counts as missed. Earlier candidates win ties, so a
+    repeating rhythm is read as starting at the top.
+    """
+    candidates = (taps[:OFFSET_TAPS, None] - onsets[None, :OFFSET_NOTES]).T.ravel()
+    shifted = taps[None, :] - candidates[:, None]
+    nearest = np.clip(np.searchsorted(onsets, shifted), 1, len(onsets) - 1) if len(onsets) > 1 else np.zeros(
+        shifted.shape, dtype=int)
+    distance = np.abs(shifted - onsets[nearest])
+    if len(onsets) > 1:
+        distance = np.minimum(distance, np.abs(shifted - onsets[nearest - 1]))
+    tap_cost = np.minimum(distance / window, 1.0).sum(axis=1)
+
+    placed = onsets[None, :] + candidates[:, None]
+    after = np.clip(np.searchsorted(taps, placed), 0, len(taps) - 1)
+    gap = np.minimum(np.abs(taps[after] - placed), np.abs(taps[np.maximum(after - 1, 0)] - placed))
+    missed = (gap >= window).sum(axis=1)
+
+    offset = float(candidates[np.argmin(tap_cost + MISS_COST * missed)])
+    # Centre the matched taps on their notes
+    assigned, _cost = assign_taps(taps - offset, onsets, window)
+    matched = assigned >= 0
+    if matched.any():
+        offset += float(np.median(taps[assigned[matched]] - offset - onsets[matched]))
+    return offset
+
+
+def score_taps(taps, reference, tempo, offset=None):
+    """Score tap times (seconds, any origin) against a score's ``reference`` records.
+
+    ``offset`` is when the score's first note fell on the taps' clock; it is
+    estimated from the taps when omitted. Returns a dict with ``accuracy``
+    (0-100: the mean per-note accuracy, counting missed notes and extra
+    taps as 0), ``offset``, ``missed``, ``extra_taps`` and ``notes``, one
+    entry per note with its deviation in seconds and beats.
+    """
+    taps = np.sort(np.asarray(taps, dtype=np.float64))
+    onsets = onset_grid(reference, tempo)
+    beat_seconds = 60.0 / tempo
+    window = MATCH_WINDOW_BEATS * beat_seconds
+    if offset is None:
+        offset = _best_offset(taps, onsets, window) if len(taps) and len(onsets) else 0.0
+    assigned, _cost = assign_taps(taps - offset, onsets, window)
+
+    matched = assigned >= 0
+    deviation = np.full(len(onsets), np.nan)
+    deviation[matched] = taps[assigned[matched]] - offset - onsets[matched]
+    accuracy = np.where(matched, np.maximum(0.0, 100.0 * (1.0 - np.abs(np.nan_to_num(deviation)) / window)), 0.0)
+    extra = len(taps) - int(matched.sum())
+
+    notes = []
+    for i in range(len(onsets)):
+        note = {
+            'index': int(reference['position'][i]),
+            'expected': round(float(onsets[i] + offset), 3),
+            'tap': round(float(taps[assigned[i]]), 3) if matched[i] else None,
+            'deviation': round(float(deviation[i]), 3) if matched[i] else None,
+            'deviation_beats': round(float(deviation[i] / beat_seconds), 3) if matched[i] else None,
+            'accuracy': round(float(accuracy[i]), 1),
+        }
+        if not matched[i]:
+            note['grade'] = 'missed'
+        elif accuracy[i] >= GOOD_ACCURACY:
+            note['grade'] = 'good'
+        elif accuracy[i] >= OKAY_ACCURACY:
+            note['grade'] = 'okay'
+        else:
+            note['grade'] = 'bad'
+        notes.append(note)
+
+    total = len(onsets) + extra
+    return {
+        'accuracy': round(float(accuracy.sum() / total), 1) if total else 0.0,
+        'tempo': tempo,
+        'offset': round(float(offset), 3),
+        'missed': int((~matched).sum()),
+        'extra_taps': extra,
+        'notes': notes,
+    }
+
+
+def tap_times_from_audio(y, sr=ANALYSIS_SR):
+    """Onset times in seconds of claps or taps in a mono buffer at ANALYSIS_SR."""
+    return tap_times_from_stream([y], sr)
+
+
+def tap_times_from_stream(chunks, sr=ANALYSIS_SR):
+    """``tap_times_from_audio`` for a take arriving as chunks of samples.
+
+    Spectral flux over Hann-windowed frames, batched like ``track_pitch``
+    but without the pitch tracking, then the same peak picking.
+    """
+    window = np.hanning(FRAME_LENGTH + 1)[:-1].astype(np.float32)
+    fluxes = []
+    previous = None
+    with stage('rhythm_onsets'):
+        for frames in stream_frames(chunks):
+            log_mag = np.log1p(ONSET_COMPRESSION * np.abs(np.fft.rfft(frames * window, axis=1)))
+            stacked = np.vstack([log_mag[:1] if previous is None else previous, log_mag])
+            fluxes.append(np.maximum(np.diff(stacked, axis=0), 0.0).sum(axis=1))
+            previous = log_mag[-1:]
+        onsets = detect_onsets(np.concatenate(fluxes), sr)
+    return onsets * (HOP_LENGTH / sr)
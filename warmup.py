@@ -0,0 +1,108 @@
+import importlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Loaded on first use by the upload path (OpenCV, music21) rather than when
+# a web worker boots; login and dashboard requests never need them
+UPLOAD_MODULES = ('templates.notedetection',)
+
+# What `flask import-report` measures, each in a fresh interpreter
+REPORT_MODULES = (
+    'numpy',
+    'scipy.signal',
+    'soundfile',
+    'cv2',
+    'music21',
+    'flask_migrate',
+    'jobs',
+    'templates.notedetection',
+    'templates.audioanalysis',
+    'app',
+)
+
+_MEASURE_SCRIPT = '''
+import importlib, json, resource, sys, time
+
+def peak_rss_kb():
+    # ru_maxrss survives exec on Linux and would report the parent's peak
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+before = peak_rss_kb()
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'seconds': time.perf_counter() - started, 'rss_kb': peak_rss_kb(), 'base_rss_kb': before}))
+'''
+
+
+def import_modules(modules):
+    for name in modules:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        logger.info(f"Imported {name} in {time.perf_counter() - started:.2f}s")
+
+
+def measure_import(name, cwd=None, env=None):
+    """Import ``name`` in a new interpreter; returns seconds and peak RSS in KB."""
+    proc = subprocess.run([sys.executable, '-c', _MEASURE_SCRIPT, name],
+                          cwd=cwd, env=dict(os.environ, **(env or {})), capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {'module': name, 'error': proc.stderr.strip().splitlines()[-1:] or ['failed']}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['module'] = name
+    return result
+
+
+class ImportWarmer:
+    """Imports the heavy upload/analysis modules in the background after boot.
+
+    Off by default so idle workers stay small; with ``WARM_IMPORTS`` set,
+    each web worker loads them ``WARM_IMPORTS_DELAY`` seconds after start
+    and the analysis pool starts its worker processes, so the first upload
+    and the first recording don't pay the import cost.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WARM_IMPORTS', os.environ.get('WARM_IMPORTS', '0') != '0')
+        app.config.setdefault('WARM_IMPORTS_DELAY', float(os.environ.get('WARM_IMPORTS_DELAY', 5)))
+        self.app = app
+        app.extensions['import_warmer'] = self
+        if app.config['WARM_IMPORTS']:
+            self.start()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._warm, name='import-warmer', daemon=True)
+        self.thread.start()
+
+    def _warm(self):
+        time.sleep(self.app.config['WARM_IMPORTS_DELAY'])
+        try:
+            import_modules(UPLOAD_MODULES)
+            analysis_queue = self.app.extensions.get('analysis_queue')
+            if analysis_queue is not None:
+                analysis_queue.warm()
+        except Exception as e:
+            logger.warning(f"Background import warm-up failed: {str(e)}")
+
+
+import_warmer = ImportWarmer()